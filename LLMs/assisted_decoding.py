@@ -0,0 +1,93 @@
+from metrics import metrics
+
+# Assisted (speculative) generation: a small draft model of the target's family proposes a few tokens that the target
+# model verifies in one forward pass, so a response costs fewer target decode steps. Under greedy decoding the output
+# is the same as plain decoding; with sampling (the models' generation configs sample) only its distribution is. The
+# draft must share the target's tokenizer and its vocabulary size: transformers rejects an assistant with another
+# vocabulary size, and speculative sampling compares the two distributions token by token.
+
+# Draft model of each target model; None means no compatible draft exists and the model decodes on its own.
+# (EXAONE 3.0 and Mistral v0.3 have no small release sharing their tokenizer; Qwen2-0.5B shares Qwen2-7B's tokenizer
+# but not its embedding size, 151936 vs 152064.)
+DRAFT_MODELS = {
+    "meta-llama/Meta-Llama-3.1-8B-Instruct": "meta-llama/Llama-3.2-1B-Instruct",
+    "Qwen/Qwen2-7B-Instruct": None,
+    "LGAI-EXAONE/EXAONE-3.0-7.8B-Instruct": None,
+    "mistralai/Mistral-7B-Instruct-v0.3": None,
+}
+
+# Target model paired with its draft model, with acceptance statistics.
+# Forward passes of both models during assisted generations are counted with hooks: every draft forward proposes one
+# token, and every target forward yields its accepted draft tokens plus one token of its own, so
+# accepted = new tokens - target forwards.
+# A draft with another vocabulary size than the target is dropped, and the target then decodes on its own.
+class AssistedDecoder:
+    def __init__(self, model, draft_model):
+        if draft_model.config.vocab_size != model.config.vocab_size:
+            print(f"Draft vocabulary size {draft_model.config.vocab_size} differs from the target's {model.config.vocab_size}; "
+                  f"decoding without assistance.")
+            draft_model = None
+        self.model = model
+        self.draft_model = draft_model
+        self.target_forwards = 0
+        self.draft_forwards = 0
+        self.new_tokens = 0
+        self.generations = 0
+        self._target_calls = 0
+        self._draft_calls = 0
+        self._hooks = []
+        if draft_model is not None:
+            self._hooks = [
+                model.register_forward_hook(self._count_target),
+                draft_model.register_forward_hook(self._count_draft),
+            ]
+
+    def _count_target(self, module, args, output):
+        self._target_calls += 1
+
+    def _count_draft(self, module, args, output):
+        self._draft_calls += 1
+
+    # model.generate with the draft model as assistant (transformers supports one sequence at a time)
+    def generate(self, **kwargs):
+        if self.draft_model is None:
+            return self.model.generate(**kwargs)
+        target_before, draft_before = self._target_calls, self._draft_calls
+        generated = self.model.generate(assistant_model=self.draft_model, **kwargs)
+        new_tokens = generated.shape[1] - kwargs["input_ids"].shape[1]
+        target_forwards = self._target_calls - target_before
+        draft_forwards = self._draft_calls - draft_before
+        self.target_forwards += target_forwards
+        self.draft_forwards += draft_forwards
+        self.new_tokens += new_tokens
+        self.generations += 1
+        metrics.count("assisted_tokens", draft_forwards, kind="drafted")
+        metrics.count("assisted_tokens", max(0, new_tokens - target_forwards), kind="accepted")
+        metrics.count("assisted_tokens", target_forwards, kind="target_forwards")
+        return generated
+
+    def stats(self):
+        accepted = max(0, self.new_tokens - self.target_forwards)
+        return {
+            "generations": self.generations,
+            "new_tokens": self.new_tokens,
+            "target_forwards": self.target_forwards,
+            "drafted_tokens": self.draft_forwards,
+            "accepted_tokens": accepted,
+            "acceptance_rate": accepted / self.draft_forwards if self.draft_forwards else 0.0,
+            "tokens_per_target_forward": self.new_tokens / self.target_forwards if self.target_forwards else 0.0,
+        }
+
+    def report(self, model_name):
+        stats = self.stats()
+        print(f"Assisted generation for {model_name}: {stats['generations']} generations, "
+              f"acceptance rate {stats['acceptance_rate']:.1%} ({stats['accepted_tokens']}/{stats['drafted_tokens']} drafted tokens), "
+              f"{stats['tokens_per_target_forward']:.2f} tokens per target forward pass")
+
+    # Remove the hooks and drop the references to both models
+    def close(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        self.model = None
+        self.draft_model = None
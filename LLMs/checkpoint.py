@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import threading
+from metrics import metrics
+
+def set_key(data, key, value):
+    node = data
+    for part in key[:-1]:
+        node = node.setdefault(part, {})
+    node[key[-1]] = value
+
+def delete_key(data, key):
+    node = data
+    for part in key[:-1]:
+        if not isinstance(node, dict) or part not in node:
+            return
+        node = node[part]
+    node.pop(key[-1], None)
+    if len(key) > 1 and not node:
+        delete_key(data, key[:-1])
+
+# Apply the records of a checkpoint log to the results
+def replay_log(data, log_path):
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A corrupted record; the unit is simply redone
+                continue
+            if record.get('deleted'):
+                delete_key(data, record['key'])
+            else:
+                set_key(data, record['key'], record['value'])
+
+# Results of a results file and its checkpoint log, without opening the log for writing (for readers)
+def read_results(json_path):
+    data = {}
+    if os.path.exists(json_path):
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    log_path = os.path.splitext(json_path)[0] + '.jsonl'
+    if os.path.exists(log_path):
+        replay_log(data, log_path)
+    return data
+
+# Append-only checkpoint store for results files.
+# Every completed unit (a dialogue, or a conv_id + scenario evaluation) is appended as one JSON line to
+# '<results>.jsonl' and the log is fsynced every `batch_size` records, so a crash loses at most one batch.
+# On startup the compacted JSON file and the log are replayed to rebuild the results and the resume set;
+# compact() rewrites the JSON file in its usual layout and truncates the log. remove() logs a deletion record, so
+# that a unit can be invalidated and redone by the next run.
+class CheckpointStore:
+    def __init__(self, json_path, key_depth=1, batch_size=16):
+        self.json_path = json_path
+        self.log_path = os.path.splitext(json_path)[0] + '.jsonl'
+        self.key_depth = key_depth
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(json_path)), exist_ok=True)
+
+        # Load the last compacted results, then replay the records appended since
+        if os.path.exists(json_path):
+            with open(json_path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+        else:
+            self.data = {}
+        self._replay()
+
+        self._log = open(self.log_path, 'a', encoding='utf-8')
+
+    def _replay(self):
+        if not os.path.exists(self.log_path):
+            return
+
+        # Cut a torn last line left by a crash mid-write so that new records start on a fresh line
+        with open(self.log_path, 'rb+') as f:
+            content = f.read()
+            if content and not content.endswith(b'\n'):
+                f.truncate(content.rfind(b'\n') + 1)
+
+        replay_log(self.data, self.log_path)
+
+    def _set(self, key, value):
+        set_key(self.data, key, value)
+
+    # Check whether a unit (e.g. conv_id, or conv_id and scenario) is already done
+    def has(self, *key):
+        node = self.data
+        for part in key:
+            if not isinstance(node, dict) or part not in node:
+                return False
+            node = node[part]
+        return True
+
+    def get(self, *key):
+        node = self.data
+        for part in key:
+            node = node[part]
+        return node
+
+    # Record one completed unit
+    def add(self, value, *key):
+        if len(key) != self.key_depth:
+            raise ValueError(f"Expected a key of depth {self.key_depth}, got {key}")
+        with self._lock, metrics.span("file_write", op="append"):
+            self._set(list(key), value)
+            self._log.write(json.dumps({"key": list(key), "value": value}, ensure_ascii=False) + '\n')
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._sync()
+
+    # Invalidate a unit (and drop parents left empty); nothing happens if it is not there
+    def remove(self, *key):
+        with self._lock, metrics.span("file_write", op="append"):
+            if not self.has(*key):
+                return
+            delete_key(self.data, list(key))
+            self._log.write(json.dumps({"key": list(key), "deleted": True}, ensure_ascii=False) + '\n')
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._sync()
+
+    def _sync(self):
+        with metrics.span("file_write", op="fsync"):
+            self._log.flush()
+            os.fsync(self._log.fileno())
+        self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            self._sync()
+
+    # Rewrite the results in the usual JSON layout (optionally ordering the top-level keys) and truncate the log
+    def compact(self, order=None):
+        with self._lock:
+            self._sync()
+            data = self.data
+            if order is not None:
+                data = {key: self.data[key] for key in order if key in self.data}
+                data.update({key: value for key, value in self.data.items() if key not in data})
+                self.data = data
+
+            tmp_path = self.json_path + '.tmp'
+            with metrics.span("file_write", op="compact"):
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.json_path)
+
+            self._log.close()
+            self._log = open(self.log_path, 'w', encoding='utf-8')
+
+    def close(self, compact=True):
+        if compact:
+            self.compact()
+        else:
+            self.flush()
+        self._log.close()
+
+# Compact the checkpoint logs of the given results files on request
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        key_depth = 2 if path.endswith('_evaluation.json') else 1
+        store = CheckpointStore(path, key_depth=key_depth)
+        store.close()
+        print(f"Compacted {path}")
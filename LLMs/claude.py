@@ -1,161 +1,309 @@
 import os
 import json
+import time
+import asyncio
 import anthropic
 from tqdm import tqdm
+from rate_limiter import RateLimiter, estimate_tokens
+from checkpoint import CheckpointStore
+from claude_batches import MessageBatchClient
+from prompt_corpus import LANGUAGES, open_prompt_corpus, add_identified_emotions
+from metrics import metrics
 
 # Set Claude API key (replace 'YOUR_ANTHROPIC_API_KEY_HERE' with the actual API key)
 ANTHROPIC_API_KEY = "YOUR_ANTHROPIC_API_KEY_HERE"  # Placeholder for the API key
-claude_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+ANTHROPIC_BASE_URL = os.environ.get("ANTHROPIC_BASE_URL", "https://api.anthropic.com")
+claude_client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, base_url=ANTHROPIC_BASE_URL)
+
+CLAUDE_MODEL = "claude-3-5-sonnet-20240620"
+MAX_TOKENS = 256
+
+# Mark the shared system instruction as cacheable (prompt caching beta).
+# Anthropic only caches prompts above a minimum length (1024 tokens for Sonnet); check the cache_read_input_tokens total.
+PROMPT_CACHING = True
+
+# "online": concurrent Messages API calls; "batch": Message Batches jobs for step 1, then for step 2
+GENERATION_MODE = "online"
+BATCH_POLL_INTERVAL = 30
+
+# Concurrency and rate limits of the async generation engine (match them to the account's API tier)
+MAX_CONCURRENCY = 16
+REQUESTS_PER_MINUTE = 50
+TOKENS_PER_MINUTE = 40000
+
+# Per-call metrics (Prometheus textfile, or CSV for a .csv path) and Chrome-trace JSON of the run; None disables them
+METRICS_FILE = None
+TRACE_FILE = None
 
 # Get the current script's directory and build a relative path to the data file
 current_dir = os.path.dirname(os.path.abspath(__file__))
 data_file_path = os.path.join(current_dir, '..', 'data', 'KoED_sample_100.json')
 
-# Load dialogue data from the specified JSON file
-with open(data_file_path, 'r', encoding='utf-8') as f:
-    dialogues_data = json.load(f)
-
-# Function to generate a response using the Claude API
-def get_response_from_claude(prompt, system_instruction):
-    try:
-        response = claude_client.messages.create(
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=256,  
-            temperature=0.1,  
-            system=system_instruction,  
-            messages=[{"role": "user", "content": prompt}]  
-        )
+# Prompts of every dialogue, rendered once from the data file (see prompt_corpus.py)
+prompt_corpus = open_prompt_corpus(data_file_path)
+
+# Token usage of the run, including prompt-cache writes and reads
+usage_totals = {"input_tokens": 0, "output_tokens": 0, "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+
+def record_usage(usage):
+    for key in usage_totals:
+        value = usage.get(key) if isinstance(usage, dict) else getattr(usage, key, None)
+        usage_totals[key] += value or 0
+        metrics.count("tokens", value, api="anthropic", kind=key)
+    if PROMPT_CACHING:
+        cache_read = usage.get("cache_read_input_tokens") if isinstance(usage, dict) else getattr(usage, "cache_read_input_tokens", None)
+        metrics.count("prompt_cache", 1, api="anthropic", result="hit" if cache_read else "miss")
+
+# System parameter of a request; the shared instruction becomes a cacheable block with prompt caching
+def build_system(system_instruction):
+    if PROMPT_CACHING:
+        return [{"type": "text", "text": system_instruction, "cache_control": {"type": "ephemeral"}}]
+    return system_instruction
+
+# Function to generate a response using the Claude API (bounded by the shared semaphore and rate limiter)
+async def get_response_from_claude(prompt, system_instruction, semaphore, limiter, step=None):
+    messages_api = claude_client.beta.prompt_caching.messages if PROMPT_CACHING else claude_client.messages
+    queued = time.perf_counter()
+    async with semaphore:
+        estimated_tokens = estimate_tokens(system_instruction + prompt) + MAX_TOKENS
+        await limiter.acquire(estimated_tokens)
+        metrics.observe("queue_wait", time.perf_counter() - queued, api="anthropic")
+        try:
+            with metrics.span("api_call", api="anthropic", step=step):
+                response = await messages_api.create(
+                    model=CLAUDE_MODEL,
+                    max_tokens=MAX_TOKENS,
+                    temperature=0.1,
+                    system=build_system(system_instruction),
+                    messages=[{"role": "user", "content": prompt}]
+                )
+        except Exception as e:
+            metrics.count("api_errors", 1, api="anthropic", error=type(e).__name__)
+            return {"error": str(e)}
+        record_usage(response.usage)
+        limiter.adjust(estimated_tokens, response.usage.input_tokens + response.usage.output_tokens)
         return response
-    except Exception as e:
-        return {"error": str(e)}
 
 # Function to extract text from a list of TextBlock objects
 def extract_text_blocks(content):
     return "\n".join(block.text for block in content)
 
-# Generate empathetic dialogues in (KoED & ED)
-for lang, lang_key in [("Korean", "ko_utter"), ("English", "utter")]:
-    # Build the output file path relative to the current script
-    output_file = os.path.join(current_dir, '..', 'output', 'experiment_results', 'sample', f'results_claude-3-5-sonnet-20240620_{lang}.json')
-    
-    # Load existing results if available; if not, initialize as an empty dictionary
-    try:
-        with open(output_file, 'r', encoding='utf-8') as f:
-            outputs_summary = json.load(f)
-    except FileNotFoundError:
-        outputs_summary = {}  
-
-    common_task_definition = f"""Task Definition: This is a/an {lang.lower()} empathetic dialogue task: The first worker (Speaker) is given an emotion label and writes his own description of a situation when he has felt that way. Then, Speaker tells his story in a conversation with a second worker (Listener). The emotion label and situation of Speaker are invisible to Listener. Listener should recognize and acknowledge others' feelings in a conversation as much as possible. Guideline Instruction: Now you play the role of Listener, please give the corresponding response according to the existing context. You only need to provide the next round of response of Listener."""
-
-    # Iterate over each dialogue
-    for index, dialogue_data in enumerate(tqdm(dialogues_data, desc=f"Processing {lang} Dialogues for Claude")):
-        conv_id = dialogue_data['conv_id'] 
-
-        # Skip previously processed dialogues or specific ones (re-experiment parts)
-        if conv_id in outputs_summary:
+# Run both steps of one scenario; step 2 depends on the emotions identified in step 1
+async def process_scenario(scenario_name, scenario_content, lang, semaphore, limiter):
+    # Step 1: Identify emotions
+    if scenario_name in ["34개의 단일 감정", "34개의 멀티 감정"]:
+        identified_emotions_response = await get_response_from_claude(scenario_content[1], scenario_content[0], semaphore, limiter, step="identify")
+        if isinstance(identified_emotions_response, dict):
+            raise RuntimeError(identified_emotions_response["error"])
+        identified_emotions_text = extract_text_blocks(identified_emotions_response.content)
+        identified_emotions = {"role": "assistant", "content": identified_emotions_text}
+    else:
+        identified_emotions = None
+
+    # Step 2: Generate empathetic response
+    if identified_emotions:
+        scenario_content[1] = add_identified_emotions(scenario_name, scenario_content[1], identified_emotions['content'], lang)
+    empathetic_response = await get_response_from_claude(scenario_content[1], scenario_content[0], semaphore, limiter, step="respond")
+    if isinstance(empathetic_response, dict):
+        raise RuntimeError(empathetic_response["error"])
+    empathetic_response_text = extract_text_blocks(empathetic_response.content)
+    empathetic_response_content = {"role": "assistant", "content": f"Listener: {empathetic_response_text}"}
+
+    return {
+        "scenario": scenario_name,
+        "identified_emotions": identified_emotions,
+        "empathetic_response": empathetic_response_content
+    }
+
+# Process one dialogue with all of its scenarios running concurrently
+async def process_dialogue(record, lang, semaphore, limiter):
+    scenario_results = await asyncio.gather(*[
+        process_scenario(scenario["scenario"], list(prompt_corpus.prompts(scenario)), lang, semaphore, limiter)
+        for scenario in record["scenarios"]
+    ])
+
+    # Dictionary to store dialogue results
+    return {
+        "conv_id": record["conv_id"],
+        "dialogue": record["dialogue"],
+        "scenarios": list(scenario_results)
+    }
+
+# Build the output file path relative to the current script
+def get_output_file(lang):
+    return os.path.join(current_dir, '..', 'output', 'experiment_results', 'sample', f'results_{CLAUDE_MODEL}_{lang}.json')
+
+# Generate all pending dialogues of one language concurrently
+async def generate_language(lang, semaphore, limiter):
+    output_file = get_output_file(lang)
+
+    # Load existing results and the checkpoint log if available
+    outputs_summary = CheckpointStore(output_file)
+
+    # Skip previously processed dialogues or specific ones (re-experiment parts)
+    pending = [record for record in prompt_corpus.records(lang) if not outputs_summary.has(record["conv_id"])]
+    tasks = [asyncio.ensure_future(process_dialogue(record, lang, semaphore, limiter)) for record in pending]
+
+    for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=f"Processing {lang} Dialogues for Claude"):
+        try:
+            dialogue_results = await task
+        except Exception as e:
+            # Failed dialogues are left out of the file so that the next run retries them
+            print(f"Error generating dialogue for Claude ({lang}): {e}")
             continue
 
-        # Initialize dialogue text with alternating turns (Speaker/Listener)
-        dialogue_text = ""
-        speaker_turn = True  # Assume Speaker starts first
-
-        for utterance in dialogue_data['dialogue']:
-            if lang_key in utterance and utterance[lang_key]: 
-                if speaker_turn:
-                    dialogue_text += f"Speaker: {utterance[lang_key]}\n"
-                else:
-                    dialogue_text += f"Listener: {utterance[lang_key]}\n"
-                speaker_turn = not speaker_turn 
-
-        # If the number of utterances is even, remove the last one for balance
-        num_utterances = dialogue_text.count('\n')
-        if num_utterances % 2 == 0:
-            dialogue_text = '\n'.join(dialogue_text.split('\n')[:-2]) + '\n'
-
-        # Format the multi-turn dialogue
-        multi_turn_dialogue = f"\n    Multi-Turn Dialogue:\n        {dialogue_text}"
-
-        ## Scenario generation
-        scenarios = [
-            ("34개의 단일 감정", [ # 34-Single
-                common_task_definition + """
-                List of 34 Emotions:
-                    Afraid (두려움), Angry (화남), Annoyed (짜증남), Anticipating (기대됨), Anxious (불안함), Apprehensive (염려됨), Ashamed (부끄러움), Caring (보살핌), Confident (자신감), Content (만족함), Devastated (충격받음), Disappointed (실망함), Disgusted (역겨움), Embarrassed (당황함), Excited (흥분됨), Faithful (충실함), Furious (격노함), Grateful (감사함), Guilty (죄책감), Hopeful (희망적), Impressed (감명받음), Jealous (질투남), Joyful (기쁨), Lonely (외로움), Nostalgic (향수에 젖음), Prepared (준비됨), Proud (자랑스러움), Sad (슬픔), Sentimental (감상적), Surprised (놀람), Terrified (겁에 질림), Trusting (신뢰함), 정 (a feeling that arises in one's heart, or a feeling of love or affinity), 한 (a feeling of bitter resentment, injustice, pity, or sadness)
-
-                Important Guidelines:
-                    - Do not use any emotion terms other than the 34 basic emotions listed above.
-                    - Combinations or mixtures of emotions are not allowed. Choose and use only one emotion.
-                    - Even for complex or subtle emotions, you must express them using only one of the 34 emotions that is closest in meaning.""",
-                f"""
-                    {multi_turn_dialogue}
-
-                Step-by-Step Instructions:
-                    1. Analyze the given dialogue to identify the Speaker's emotional state.
-                    2. Specify the identified emotion using only one of the 34 basic emotions listed above.
-                    (STOP HERE. Do NOT proceed to steps 3 and 4 yet. Only identify the emotion at this stage.)
-                """,
-            ]),
-            ("34개의 멀티 감정", [ # 34-Multi
-                common_task_definition + """
-                List of 34 Emotions:
-                    Afraid (두려움), Angry (화남), Annoyed (짜증남), Anticipating (기대됨), Anxious (불안함), Apprehensive (염려됨), Ashamed (부끄러움), Caring (보살핌), Confident (자신감), Content (만족함), Devastated (충격받음), Disappointed (실망함), Disgusted (역겨움), Embarrassed (당황함), Excited (흥분됨), Faithful (충실함), Furious (격노함), Grateful (감사함), Guilty (죄책감), Hopeful (희망적), Impressed (감명받음), Jealous (질투남), Joyful (기쁨), Lonely (외로움), Nostalgic (향수에 젖음), Prepared (준비됨), Proud (자랑스러움), Sad (슬픔), Sentimental (감상적), Surprised (놀람), Terrified (겁에 질림), Trusting (신뢰함), 정 (a feeling that arises in one's heart, or a feeling of love or affinity), 한 (a feeling of bitter resentment, injustice, pity, or sadness)
-
-                Important Guidelines:
-                    - Do not use any emotion terms other than the 34 basic emotions listed above.
-                    - Combinations or mixtures of emotions are allowed. Select up to 4 emotions that best describe the Speaker's emotional state.""",
-                f"""
-                {multi_turn_dialogue}
-
-                Step-by-Step Instructions:
-                    1. Analyze the given dialogue to identify the Speaker's complex emotional state.
-                    2. Specify the identified emotions using multiple labels from the 34 emotions listed above. Select all that apply, with no minimum or maximum limit.
-                    (STOP HERE. Do NOT proceed to steps 3 and 4 yet. Only identify the emotion at this stage.)
-                """
-            ]),
-        ]
-
-        # Dictionary to store dialogue results
-        dialogue_results = {
-            "conv_id": conv_id,
-            "dialogue": dialogue_text,
-            "scenarios": []
-        }
+        # Append the current dialogue results to the checkpoint log
+        outputs_summary.add(dialogue_results, dialogue_results['conv_id'])
+
+    # Rewrite the results file in dataset order
+    outputs_summary.compact(order=prompt_corpus.conv_ids)
+    outputs_summary.close(compact=False)
+    print(f"Results saved to {output_file} successfully.")
 
-        scenario_next_steps = {
-            "34개의 단일 감정": 3,
-            "34개의 멀티 감정": 3
+# One Message Batches request (custom ids must match ^[a-zA-Z0-9_-]{1,64}$, so they are built from dataset indices)
+def build_batch_request(custom_id, prompt, system_instruction):
+    return {
+        "custom_id": custom_id,
+        "params": {
+            "model": CLAUDE_MODEL,
+            "max_tokens": MAX_TOKENS,
+            "temperature": 0.1,
+            "system": build_system(system_instruction),
+            "messages": [{"role": "user", "content": prompt}]
         }
+    }
 
-        # Process each scenario for the current dialogue
-        for scenario_name, scenario_content in scenarios:
-            # Step 1: Identify emotions
-            if scenario_name in ["34개의 단일 감정", "34개의 멀티 감정"]:
-                identified_emotions_response = get_response_from_claude(scenario_content[1], system_instruction=scenario_content[0])
-                identified_emotions_text = extract_text_blocks(identified_emotions_response.content)
-                identified_emotions = {"role": "assistant", "content": identified_emotions_text}
-            else:
-                identified_emotions = None
-
-            # Step 2: Generate empathetic response
-            if identified_emotions:
-                scenario_content[1] += f"\n\nIdentified Emotions: {identified_emotions['content']}\n\n{scenario_next_steps[scenario_name]}. Proceeding with the next {lang} empathetic response based on the identified emotions."
-               
-            empathetic_response = get_response_from_claude(scenario_content[1], system_instruction=scenario_content[0])
-            empathetic_response_text = extract_text_blocks(empathetic_response.content)
-            empathetic_response_content = {"role": "assistant", "content": f"Listener: {empathetic_response_text}"}
-
-            # Append scenario results to dialogue results
-            dialogue_results["scenarios"].append({
-                "scenario": scenario_name,
-                "identified_emotions": identified_emotions,
-                "empathetic_response": empathetic_response_content
-            })
-
-        # Add the current dialogue results to the overall output
-        outputs_summary[conv_id] = dialogue_results
-
-        # Save the results to the output file
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(outputs_summary, f, ensure_ascii=False, indent=4)
+# Text of a batch result, or None if the request did not succeed
+def extract_batch_result_text(result):
+    if result is None or result["type"] != "succeeded":
+        return None
+    record_usage(result["message"]["usage"])
+    return "\n".join(block["text"] for block in result["message"]["content"] if block["type"] == "text")
 
+def save_batch_state(state_file, state):
+    with open(state_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=4)
+
+# Generate all pending dialogues of one language with two batch jobs: every step-1 request first,
+# then the step-2 requests built from their results. Submitted batch ids are kept next to the results
+# file so that an interrupted run resumes polling instead of submitting again.
+def generate_language_batch(lang, batch_client):
+    output_file = get_output_file(lang)
+    state_file = os.path.splitext(output_file)[0] + '.batches.json'
+    outputs_summary = CheckpointStore(output_file)
+
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+
+    # Collect the prompts of every scenario of every pending dialogue
+    dialogue_texts = {}
+    units = {}
+    conv_ids = prompt_corpus.conv_ids
+    for index, record in enumerate(prompt_corpus.records(lang)):
+        if outputs_summary.has(record["conv_id"]):
+            continue
+        dialogue_texts[index] = record["dialogue"]
+        for scenario_index, scenario in enumerate(record["scenarios"]):
+            units[f"{lang}-{index}-{scenario_index}"] = (index, scenario["scenario"], list(prompt_corpus.prompts(scenario)))
+
+    if not units:
+        outputs_summary.close(compact=False)
+        print(f"No pending {lang} dialogues for Claude.")
+        return
+
+    # Step 1: Identify emotions
+    with metrics.span("batch_job", api="anthropic", step="identify"):
+        if "step_one_batches" in state:
+            step_one_results = batch_client.collect(state["step_one_batches"], BATCH_POLL_INTERVAL)
+        else:
+            def on_step_one_submit(batch_ids):
+                state["step_one_batches"] = batch_ids
+                save_batch_state(state_file, state)
+            step_one_results = batch_client.run(
+                [build_batch_request(custom_id, scenario_content[1], scenario_content[0]) for custom_id, (_, _, scenario_content) in units.items()],
+                BATCH_POLL_INTERVAL,
+                on_step_one_submit,
+            )
+
+    identified = {}
+    for custom_id, (_, scenario_name, scenario_content) in units.items():
+        text = extract_batch_result_text(step_one_results.get(custom_id))
+        if text is None:
+            continue
+        identified[custom_id] = {"role": "assistant", "content": text}
+        scenario_content[1] = add_identified_emotions(scenario_name, scenario_content[1], text, lang)
+
+    # Step 2: Generate empathetic responses based on the identified emotions
+    with metrics.span("batch_job", api="anthropic", step="respond"):
+        if "step_two_batches" in state:
+            step_two_results = batch_client.collect(state["step_two_batches"], BATCH_POLL_INTERVAL)
+        else:
+            def on_step_two_submit(batch_ids):
+                state["step_two_batches"] = batch_ids
+                save_batch_state(state_file, state)
+            step_two_results = batch_client.run(
+                [build_batch_request(custom_id, units[custom_id][2][1], units[custom_id][2][0]) for custom_id in identified],
+                BATCH_POLL_INTERVAL,
+                on_step_two_submit,
+            )
+
+    # Merge both steps per dialogue; dialogues with a failed request are left for the next run
+    scenario_results = {}
+    failed = set()
+    for custom_id, (index, scenario_name, _) in units.items():
+        text = extract_batch_result_text(step_two_results.get(custom_id)) if custom_id in identified else None
+        if text is None:
+            failed.add(index)
+            continue
+        scenario_results.setdefault(index, []).append({
+            "scenario": scenario_name,
+            "identified_emotions": identified[custom_id],
+            "empathetic_response": {"role": "assistant", "content": f"Listener: {text}"}
+        })
+
+    for index, dialogue_text in dialogue_texts.items():
+        if index in failed:
+            continue
+        conv_id = conv_ids[index]
+        outputs_summary.add({"conv_id": conv_id, "dialogue": dialogue_text, "scenarios": scenario_results[index]}, conv_id)
+
+    if failed:
+        print(f"{len(failed)} {lang} dialogues failed in the batch jobs and will be retried on the next run.")
+
+    outputs_summary.compact(order=prompt_corpus.conv_ids)
+    outputs_summary.close(compact=False)
+    if os.path.exists(state_file):
+        os.remove(state_file)
     print(f"Results saved to {output_file} successfully.")
+
+async def main():
+    metrics.enable(METRICS_FILE, TRACE_FILE)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+    # Generate empathetic dialogues in (KoED & ED)
+    for lang, _ in LANGUAGES:
+        with metrics.span("stage", stage="generate", lang=lang):
+            await generate_language(lang, semaphore, limiter)
+    metrics.write()
+
+def main_batch():
+    metrics.enable(METRICS_FILE, TRACE_FILE)
+    batch_client = MessageBatchClient(ANTHROPIC_API_KEY, ANTHROPIC_BASE_URL, prompt_caching=PROMPT_CACHING)
+
+    # Generate empathetic dialogues in (KoED & ED)
+    for lang, _ in LANGUAGES:
+        with metrics.span("stage", stage="generate", lang=lang):
+            generate_language_batch(lang, batch_client)
+
+    batch_client.close()
+    metrics.write()
+
+if __name__ == "__main__":
+    if GENERATION_MODE == "batch":
+        main_batch()
+    else:
+        asyncio.run(main())
+    print(f"Token usage: {usage_totals}")
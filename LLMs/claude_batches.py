@@ -0,0 +1,74 @@
+import time
+import json
+import httpx
+
+MESSAGE_BATCHES_BETA = "message-batches-2024-09-24"
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+
+# Maximum number of requests in one batch job
+MAX_BATCH_REQUESTS = 10000
+
+# Minimal client for the Anthropic Message Batches API (not covered by the pinned SDK version)
+class MessageBatchClient:
+    def __init__(self, api_key, base_url="https://api.anthropic.com", prompt_caching=False, timeout=60.0):
+        betas = [MESSAGE_BATCHES_BETA] + ([PROMPT_CACHING_BETA] if prompt_caching else [])
+        self.client = httpx.Client(
+            base_url=base_url,
+            timeout=timeout,
+            headers={
+                "x-api-key": api_key,
+                "anthropic-version": "2023-06-01",
+                "anthropic-beta": ",".join(betas),
+                "content-type": "application/json",
+            },
+        )
+
+    # Submit a list of {"custom_id": ..., "params": {...}} requests as one batch job
+    def submit(self, requests):
+        response = self.client.post("/v1/messages/batches", json={"requests": requests})
+        response.raise_for_status()
+        return response.json()
+
+    def retrieve(self, batch_id):
+        response = self.client.get(f"/v1/messages/batches/{batch_id}")
+        response.raise_for_status()
+        return response.json()
+
+    # Poll a batch job until it has ended
+    def wait(self, batch_id, poll_interval=30.0):
+        while True:
+            batch = self.retrieve(batch_id)
+            if batch["processing_status"] == "ended":
+                return batch
+            print(f"Batch {batch_id}: {batch.get('request_counts', {})}")
+            time.sleep(poll_interval)
+
+    # Results of an ended batch as {custom_id: result}
+    def results(self, batch):
+        response = self.client.get(batch["results_url"])
+        response.raise_for_status()
+        results = {}
+        for line in response.text.splitlines():
+            if line.strip():
+                record = json.loads(line)
+                results[record["custom_id"]] = record["result"]
+        return results
+
+    # Submit the requests (split into jobs of at most MAX_BATCH_REQUESTS), wait for every job and merge the results
+    def run(self, requests, poll_interval=30.0, on_submit=None):
+        batch_ids = []
+        for start in range(0, len(requests), MAX_BATCH_REQUESTS):
+            batch_ids.append(self.submit(requests[start:start + MAX_BATCH_REQUESTS])["id"])
+        if on_submit is not None:
+            on_submit(batch_ids)
+        return self.collect(batch_ids, poll_interval)
+
+    # Wait for already submitted jobs and merge their results
+    def collect(self, batch_ids, poll_interval=30.0):
+        results = {}
+        for batch_id in batch_ids:
+            results.update(self.results(self.wait(batch_id, poll_interval)))
+        return results
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,442 @@
+import os
+import sys
+import json
+import glob
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+# Compact storage of the whole experiment tree (results and evaluation files of every model, language and dataset).
+# The JSON files repeat the same dialogue in every model's results, the same statement in the results and the
+# evaluation, and the same scenario and criterion names everywhere, all pretty-printed. Here every string is stored
+# once in one of two shared string pools and referenced by its index, and the files are flattened into Arrow tables
+# (zstd-compressed IPC files in COMPACT_DIR):
+#   names          every distinct short string: conv_ids, scenario and criterion names, emotion labels, key layouts
+#   texts          every distinct text: dialogues, statements, feedback
+#   files          one row per JSON file: path relative to output/, kind, dataset/model/language of evaluation files
+#   conversations  one row per top-level entry: file, key, dialogue
+#   scenarios      one row per scenario: conversation, key (evaluation files), name, final statement, emotion labels
+#   criteria       one row per criterion of an evaluation: scenario, criterion, feedback, score
+# The key order of every object is kept as an interned layout, and fields the tables have no column for are kept as
+# JSON, so export() writes every file back byte for byte. A file that was not written with the usual
+# json.dump(..., ensure_ascii=False, indent=4) is kept verbatim. pack() checks every file against its export.
+#
+#     python compact_store.py pack             pack the JSON files of output/ into COMPACT_DIR
+#     python compact_store.py export [dir]     write the JSON files back (under dir, output/ by default)
+#     python compact_store.py stats            disk use and load times of the JSON files and the compact store
+
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'output')
+COMPACT_DIR = os.path.join(OUTPUT_DIR, 'compact')
+
+# JSON files of the experiment tree, relative to OUTPUT_DIR (open_source.py writes its raw results next to the
+# evaluation results)
+RESULT_GLOBS = [
+    os.path.join('experiment_results', '*', 'results_*.json'),
+    os.path.join('eval_results', '*', 'results_*.json'),
+    os.path.join('eval_results', '*', '*', '*', '*_evaluation.json'),
+]
+
+COMPRESSION = "zstd"
+TABLES = ["names", "texts", "files", "conversations", "scenarios", "criteria"]
+
+# Missing string reference
+NONE = -1
+
+def dump_json(data):
+    return json.dumps(data, ensure_ascii=False, indent=4)
+
+# Every distinct string once; strings are referred to by their index
+class StringPool:
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def intern(self, text):
+        index = self.ids.get(text)
+        if index is None:
+            index = self.ids[text] = len(self.strings)
+            self.strings.append(text)
+        return index
+
+# Columns of the tables while packing
+class CompactWriter:
+    def __init__(self):
+        self.names = StringPool()
+        self.texts = StringPool()
+        self.files = {"path": [], "kind": [], "dataset": [], "model": [], "language": [], "verbatim": []}
+        self.conversations = {"file": [], "key": [], "layout": [], "dialogue": [], "extra": []}
+        self.scenarios = {"conversation": [], "key": [], "layout": [], "scenario": [], "statement": [], "emotions": [], "extra": []}
+        self.criteria = {"scenario": [], "criterion": [], "feedback": [], "score": [], "score_text": []}
+
+    def name(self, name):
+        return NONE if name is None else self.names.intern(name)
+
+    def text(self, text):
+        return NONE if text is None else self.texts.intern(text)
+
+    # Key order of an object and the JSON of the fields without a column
+    def layout(self, fields, extra):
+        return self.name(json.dumps(fields, ensure_ascii=False)), self.text(json.dumps(extra, ensure_ascii=False) if extra else None)
+
+    def add_file(self, relative_path, text):
+        data = json.loads(text)
+        kind = "evaluations" if relative_path.endswith('_evaluation.json') else "results"
+        if not isinstance(data, dict) or dump_json(data) != text:
+            kind = "verbatim"
+        dataset = model = language = None
+        if kind == "evaluations":
+            dataset, model, language = relative_path.replace(os.sep, '/').split('/')[1:4]
+
+        file_index = len(self.files["path"])
+        self.files["path"].append(relative_path.replace(os.sep, '/'))
+        self.files["kind"].append(kind)
+        self.files["dataset"].append(dataset)
+        self.files["model"].append(model)
+        self.files["language"].append(language)
+        self.files["verbatim"].append(text.encode('utf-8') if kind == "verbatim" else None)
+        if kind != "verbatim":
+            for key, conv_data in data.items():
+                self.add_conversation(file_index, kind, key, conv_data)
+
+    def add_conversation(self, file_index, kind, key, conv_data):
+        conversation = len(self.conversations["file"])
+        fields, extra, dialogue, scenarios = [], {}, None, []
+        if kind == "evaluations" and isinstance(conv_data, dict):
+            # {scenario name: evaluation}
+            for scenario_key, scenario in conv_data.items():
+                fields.append(scenario_key)
+                if isinstance(scenario, dict):
+                    scenarios.append((scenario_key, scenario))
+                else:
+                    extra[scenario_key] = scenario
+        elif isinstance(conv_data, dict):
+            for field, value in conv_data.items():
+                fields.append(field)
+                if field == "conv_id" and value == key:
+                    continue
+                if field == "dialogue" and isinstance(value, str):
+                    dialogue = value
+                elif field == "scenarios" and isinstance(value, list) and all(isinstance(scenario, dict) for scenario in value):
+                    scenarios += [(None, scenario) for scenario in value]
+                else:
+                    extra[field] = value
+        else:
+            fields, extra = None, {"value": conv_data}
+
+        layout, extra_id = self.layout(fields, extra)
+        self.conversations["file"].append(file_index)
+        self.conversations["key"].append(self.name(key))
+        self.conversations["layout"].append(layout)
+        self.conversations["dialogue"].append(self.text(dialogue))
+        self.conversations["extra"].append(extra_id)
+        for scenario_key, scenario in scenarios:
+            self.add_scenario(conversation, scenario_key, scenario)
+
+    def add_scenario(self, conversation, scenario_key, scenario):
+        index = len(self.scenarios["conversation"])
+        fields, extra = [], {}
+        name = statement = emotions = None
+        evaluations, scores = scenario.get("evaluations"), scenario.get("scores")
+        criteria = isinstance(evaluations, dict) and isinstance(scores, dict) and list(evaluations) == list(scores) \
+            and all(isinstance(feedback, str) for feedback in evaluations.values()) \
+            and all(isinstance(score, str) or (isinstance(score, int) and not isinstance(score, bool)) for score in scores.values())
+        for field, value in scenario.items():
+            fields.append(field)
+            if field == "scenario" and isinstance(value, str):
+                name = value
+            elif field == "final_empathetic_statement" and isinstance(value, str):
+                statement = value
+            elif field == "emotion inference" and isinstance(value, list) and all(isinstance(label, str) for label in value):
+                emotions = [self.name(label) for label in value]
+            elif field in ("evaluations", "scores") and criteria:
+                continue
+            else:
+                extra[field] = value
+
+        layout, extra_id = self.layout(fields, extra)
+        self.scenarios["conversation"].append(conversation)
+        self.scenarios["key"].append(self.name(scenario_key))
+        self.scenarios["layout"].append(layout)
+        self.scenarios["scenario"].append(self.name(name))
+        self.scenarios["statement"].append(self.text(statement))
+        self.scenarios["emotions"].append(emotions)
+        self.scenarios["extra"].append(extra_id)
+        if criteria:
+            for criterion, feedback in evaluations.items():
+                score = scores[criterion]
+                self.criteria["scenario"].append(index)
+                self.criteria["criterion"].append(self.name(criterion))
+                self.criteria["feedback"].append(self.text(feedback))
+                self.criteria["score"].append(None if isinstance(score, str) else score)
+                self.criteria["score_text"].append(self.name(score) if isinstance(score, str) else NONE)
+
+    def tables(self):
+        references = lambda values: pa.array(values, pa.int32())
+        return {
+            "names": pa.table({"text": pa.array(self.names.strings, pa.string())}),
+            "texts": pa.table({"text": pa.array(self.texts.strings, pa.large_string())}),
+            "files": pa.table({
+                "path": pa.array(self.files["path"], pa.string()),
+                "kind": pa.array(self.files["kind"], pa.string()).dictionary_encode(),
+                "dataset": pa.array(self.files["dataset"], pa.string()).dictionary_encode(),
+                "model": pa.array(self.files["model"], pa.string()).dictionary_encode(),
+                "language": pa.array(self.files["language"], pa.string()).dictionary_encode(),
+                "verbatim": pa.array(self.files["verbatim"], pa.large_binary()),
+            }),
+            "conversations": pa.table({column: references(values) for column, values in self.conversations.items()}),
+            "scenarios": pa.table({
+                column: pa.array(values, pa.list_(pa.int32())) if column == "emotions" else references(values)
+                for column, values in self.scenarios.items()
+            }),
+            "criteria": pa.table({
+                "scenario": references(self.criteria["scenario"]),
+                "criterion": references(self.criteria["criterion"]),
+                "feedback": references(self.criteria["feedback"]),
+                "score": pa.array(self.criteria["score"], pa.int64()),
+                "score_text": references(self.criteria["score_text"]),
+            }),
+        }
+
+def write_tables(tables, directory):
+    os.makedirs(directory, exist_ok=True)
+    for name, table in tables.items():
+        path = os.path.join(directory, f'{name}.arrow')
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with ipc.new_file(sink, table.schema, options=ipc.IpcWriteOptions(compression=COMPRESSION)) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+
+def read_table(directory, name):
+    with pa.memory_map(os.path.join(directory, f'{name}.arrow'), 'r') as source:
+        return ipc.open_file(source).read_all()
+
+# Tables of a compact store, each read on first use (the scores never need the texts)
+class LazyTables(dict):
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+
+    def __missing__(self, name):
+        self[name] = read_table(self.directory, name)
+        return self[name]
+
+# Start offsets of the rows of every parent in a child table ordered by parent
+def row_offsets(parents, count):
+    return np.searchsorted(parents, np.arange(count + 1))
+
+# Codes of sorted categories (as ScoresTable.from_rows encodes them)
+def sorted_categories(codes, categories):
+    order = sorted(range(len(categories)), key=categories.__getitem__)
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    return rank[codes.astype(np.int64)], [categories[index] for index in order]
+
+def column_list(table, column):
+    return table.column(column).to_numpy().tolist()
+
+# Reader of a packed tree: the JSON data of any file, and the judge scores as a results_store.ScoresTable.
+# Tables are read as they are needed, and the row indexes that read() needs are built on its first call.
+class CompactStore:
+    def __init__(self, tables):
+        self.tables = tables
+        files = tables["files"]
+        self.paths = files.column("path").to_pylist()
+        self.file_index = {path: index for index, path in enumerate(self.paths)}
+        self.kinds = files.column("kind").to_pylist()
+        self.names = None
+        self.layouts = {}
+
+    @classmethod
+    def load(cls, directory=COMPACT_DIR):
+        return cls(LazyTables(directory))
+
+    def build_index(self):
+        tables = self.tables
+        self.names = tables["names"].column("text").to_pylist()
+        self.texts = tables["texts"].column("text").to_pylist()
+        conversations, scenarios, criteria = tables["conversations"], tables["scenarios"], tables["criteria"]
+        self.conversations = {column: column_list(conversations, column) for column in conversations.column_names}
+        self.scenarios = {column: column_list(scenarios, column) for column in scenarios.column_names if column != "emotions"}
+        emotions = scenarios.column("emotions").combine_chunks()
+        self.emotion_offsets = emotions.offsets.to_numpy().tolist()
+        self.emotion_values = emotions.flatten().to_numpy().tolist()
+        self.criteria = {column: column_list(criteria, column) for column in ("scenario", "criterion", "feedback", "score_text")}
+        self.criteria["score"] = criteria.column("score").to_pylist()
+
+        self.file_rows = row_offsets(np.asarray(self.conversations["file"]), len(self.paths)).tolist()
+        self.conversation_rows = row_offsets(np.asarray(self.scenarios["conversation"]), len(self.conversations["file"])).tolist()
+        self.scenario_rows = row_offsets(np.asarray(self.criteria["scenario"]), len(self.scenarios["conversation"])).tolist()
+
+    def layout(self, index):
+        if index not in self.layouts:
+            self.layouts[index] = json.loads(self.names[index])
+        return self.layouts[index]
+
+    def extra(self, index):
+        return {} if index == NONE else json.loads(self.texts[index])
+
+    def scenario(self, row):
+        scenarios = self.scenarios
+        extra = self.extra(scenarios["extra"][row])
+        data = {}
+        for field in self.layout(scenarios["layout"][row]):
+            if field in extra:
+                data[field] = extra[field]
+            elif field == "scenario":
+                data[field] = self.names[scenarios["scenario"][row]]
+            elif field == "final_empathetic_statement":
+                data[field] = self.texts[scenarios["statement"][row]]
+            elif field == "emotion inference":
+                start, end = self.emotion_offsets[row], self.emotion_offsets[row + 1]
+                data[field] = [self.names[label] for label in self.emotion_values[start:end]]
+            elif field == "evaluations":
+                data[field] = {self.names[self.criteria["criterion"][index]]: self.texts[self.criteria["feedback"][index]]
+                               for index in range(self.scenario_rows[row], self.scenario_rows[row + 1])}
+            elif field == "scores":
+                data[field] = {self.names[self.criteria["criterion"][index]]: self.criteria["score"][index]
+                               if self.criteria["score_text"][index] == NONE else self.names[self.criteria["score_text"][index]]
+                               for index in range(self.scenario_rows[row], self.scenario_rows[row + 1])}
+        return data
+
+    def conversation(self, row, kind):
+        conversations = self.conversations
+        extra = self.extra(conversations["extra"][row])
+        fields = self.layout(conversations["layout"][row])
+        if fields is None:
+            return extra["value"]
+        scenario_rows = range(self.conversation_rows[row], self.conversation_rows[row + 1])
+        data = {}
+        if kind == "evaluations":
+            scenarios = {self.names[self.scenarios["key"][index]]: index for index in scenario_rows}
+            for field in fields:
+                data[field] = extra[field] if field in extra else self.scenario(scenarios[field])
+            return data
+        for field in fields:
+            if field in extra:
+                data[field] = extra[field]
+            elif field == "conv_id":
+                data[field] = self.names[conversations["key"][row]]
+            elif field == "dialogue":
+                data[field] = self.texts[conversations["dialogue"][row]]
+            elif field == "scenarios":
+                data[field] = [self.scenario(index) for index in scenario_rows]
+        return data
+
+    # JSON data of a file (path relative to output/)
+    def read(self, path):
+        index = self.file_index[path]
+        if self.kinds[index] == "verbatim":
+            return json.loads(self.tables["files"].column("verbatim")[index].as_py().decode('utf-8'))
+        if self.names is None:
+            self.build_index()
+        return {
+            self.names[self.conversations["key"][row]]: self.conversation(row, self.kinds[index])
+            for row in range(self.file_rows[index], self.file_rows[index + 1])
+        }
+
+    # Text of a file exactly as it was packed
+    def export(self, path):
+        index = self.file_index[path]
+        if self.kinds[index] == "verbatim":
+            return self.tables["files"].column("verbatim")[index].as_py().decode('utf-8')
+        return dump_json(self.read(path))
+
+    # Every judge score as a ScoresTable (see results_store.py), without rebuilding any JSON
+    def scores_table(self):
+        from results_store import ScoresTable, KEY_COLUMNS
+        tables = self.tables
+        names = tables["names"].column("text")
+        criteria = tables["criteria"]
+        scenario = criteria.column("scenario").to_numpy()
+        conversation = tables["scenarios"].column("conversation").to_numpy()[scenario]
+        file_index = tables["conversations"].column("file").to_numpy()[conversation]
+        references = {
+            "scenario": tables["scenarios"].column("key").to_numpy()[scenario],
+            "criterion": criteria.column("criterion").to_numpy(),
+            "conv_id": tables["conversations"].column("key").to_numpy()[conversation],
+        }
+        codes, categories = {}, {}
+        for column in KEY_COLUMNS:
+            if column in references:
+                unique, codes[column] = np.unique(references[column], return_inverse=True)
+                categories[column] = names.take(pa.array(unique)).to_pylist()
+            else:
+                # dataset, model and language are dictionary-encoded per file
+                array = tables["files"].column(column).combine_chunks()
+                categories[column] = array.dictionary.to_pylist()
+                codes[column] = array.indices.to_numpy(zero_copy_only=False)[file_index]
+            codes[column], categories[column] = sorted_categories(codes[column], categories[column])
+        scores = criteria.column("score").to_numpy(zero_copy_only=False).astype(np.float64)
+        return ScoresTable(codes, categories, scores)
+
+def result_files(output_dir=OUTPUT_DIR):
+    paths = []
+    for pattern in RESULT_GLOBS:
+        paths += glob.glob(os.path.join(output_dir, pattern))
+    return sorted(os.path.relpath(path, output_dir) for path in set(paths))
+
+# Pack the JSON files of output_dir and check that every one of them is exported unchanged
+def pack(output_dir=OUTPUT_DIR, compact_dir=COMPACT_DIR):
+    writer = CompactWriter()
+    texts = {}
+    for relative_path in result_files(output_dir):
+        with open(os.path.join(output_dir, relative_path), 'r', encoding='utf-8') as f:
+            text = f.read()
+        if os.path.exists(os.path.join(output_dir, relative_path) + 'l') and os.path.getsize(os.path.join(output_dir, relative_path) + 'l'):
+            print(f"{relative_path} has an uncompacted checkpoint log; only the JSON file is packed.")
+        writer.add_file(relative_path, text)
+        texts[relative_path.replace(os.sep, '/')] = text
+    write_tables(writer.tables(), compact_dir)
+
+    store = CompactStore.load(compact_dir)
+    mismatched = [path for path, text in texts.items() if store.export(path) != text]
+    if mismatched:
+        raise ValueError(f"Exported files differ from the originals: {mismatched}")
+    verbatim = sum(kind == "verbatim" for kind in store.kinds)
+    print(f"Packed {len(texts)} files ({verbatim} verbatim) into {compact_dir}: {store.tables['names'].num_rows} distinct names, {store.tables['texts'].num_rows} distinct texts")
+    return store
+
+def export_all(store, output_dir=OUTPUT_DIR):
+    for path in store.paths:
+        target = os.path.join(output_dir, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'w', encoding='utf-8') as f:
+            f.write(store.export(path))
+    print(f"Exported {len(store.paths)} files to {output_dir}")
+
+def directory_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+def print_stats(output_dir=OUTPUT_DIR, compact_dir=COMPACT_DIR):
+    paths = [os.path.join(output_dir, path) for path in result_files(output_dir)]
+    json_bytes = directory_size(paths)
+    compact_bytes = directory_size([os.path.join(compact_dir, f'{name}.arrow') for name in TABLES])
+    print(f"Disk: {len(paths)} JSON files {json_bytes / 1e6:.1f} MB, compact store {compact_bytes / 1e6:.1f} MB ({json_bytes / max(compact_bytes, 1):.1f}x smaller)")
+
+    start = time.perf_counter()
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            json.load(f)
+    json_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    store = CompactStore.load(compact_dir)
+    load_seconds = time.perf_counter() - start
+    for path in store.paths:
+        store.read(path)
+    read_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    table = CompactStore.load(compact_dir).scores_table()
+    scores_seconds = time.perf_counter() - start
+    print(f"Load: JSON files {json_seconds:.2f} s; compact store {load_seconds:.2f} s (every file as JSON data {read_seconds:.2f} s, "
+          f"{len(table)} judge scores as a ScoresTable {scores_seconds:.2f} s)")
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if mode == "pack":
+        pack()
+    elif mode == "export":
+        export_all(CompactStore.load(), sys.argv[2] if len(sys.argv) > 2 else OUTPUT_DIR)
+    else:
+        print_stats()
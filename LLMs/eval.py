@@ -1,14 +1,73 @@
 import os
 import openai
 import json
+import asyncio
+import aiohttp
 from tqdm import tqdm
 import time
 import re
+from checkpoint import CheckpointStore
+from rate_limiter import RateLimiter, estimate_tokens, backoff_delay, parse_retry_after
+from judge_cache import JudgeCache
+from judge_parsing import parse_judge_answer, parse_score
+from koed_dataset import KoEDDataset
+from metrics import metrics
 
 # Set OpenAI API keys (researcher-specific)
 OPENAI_API_KEY = "YOUR_OPENAI_API_KEY_HERE"
 openai.api_key = OPENAI_API_KEY
 
+JUDGE_MODEL = "gpt-4o"
+MAX_TOKENS = 256
+
+# Global cap on in-flight judge calls and the account's rate limits
+MAX_CONCURRENCY = 32
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 300000
+
+# Retry mechanism to handle potential API errors (and answers without any recoverable score)
+MAX_RETRIES = 5
+
+# Fused judge: one request per response rates every criterion and answers in JSON; criteria missing from (or invalid
+# in) the fused answer fall back to per-criterion requests
+FUSED_JUDGE = False
+FUSED_MAX_TOKENS = 1024
+
+# Evaluation results go to output/eval_results/<EVAL_OUTPUT_NAME> (e.g. "sample_fused" to keep a fused run next to a
+# per-criterion run for judge_agreement.py)
+EVAL_OUTPUT_NAME = "sample"
+
+# Dataset the results were generated from; results are evaluated and written in its conv_id order
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'KoED_sample_100.json')
+
+# Persistent judge cache shared by every dataset and model (None disables it)
+JUDGE_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'output', 'eval_results', 'judge_cache.sqlite')
+JUDGE_CACHE_MAX_ENTRIES = 1000000
+JUDGE_CACHE_MAX_AGE_DAYS = 365
+
+# Per-call metrics (Prometheus textfile, or CSV for a .csv path) and Chrome-trace JSON of the run; None disables them
+METRICS_FILE = None
+TRACE_FILE = None
+
+# Models and languages whose results are evaluated
+EVAL_MODELS = [
+    "claude-3-5-sonnet-20240620",
+    "Meta-Llama-3.1-8B-Instruct",
+    "Mistral-7B-Instruct-v0.3",
+    "Qwen2-7B-Instruct",
+    "EXAONE-3.0-7.8B-Instruct"
+]
+EVAL_LANGUAGES = ["Korean","English"]
+
+# List of evaluation criteria
+CRITERIA = [
+    "Explorations (EX)",
+    "Interpretations (IP)",
+    "Emotional Reactions (ER)",
+    "Evoked Emotion Alignment (EEA)",
+    "Cultural Appropriateness (CA)"
+]
+
 # Load JSON data from the specified file path
 def load_json_data(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
@@ -20,8 +79,8 @@ def sanitize_filename(name):
     # Replace invalid characters in the filename
     return re.sub(r'[\\/*?:"<>|]', '_', name)
 
-# Save evaluation results to a file
-def save_evaluation_to_file(results, output_directory, model_name, language):
+# Open the evaluation results of a model and language as an append-only checkpoint store
+def open_evaluation_store(output_directory, model_name, language):
     model_dir = os.path.join(output_directory, sanitize_filename(model_name), sanitize_filename(language))
     os.makedirs(model_dir, exist_ok=True)
 
@@ -29,33 +88,161 @@ def save_evaluation_to_file(results, output_directory, model_name, language):
     file_name = f"{sanitize_filename(model_name)}_{sanitize_filename(language)}_evaluation.json"
     file_path = os.path.join(model_dir, file_name)
 
-    # Save results as a JSON file
-    with open(file_path, 'w', encoding='utf-8') as file:
-        json.dump(results, file, ensure_ascii=False, indent=4)
-
-# Load already evaluated results from a file if available
-def load_evaluated_results(output_directory, model_name, language):
-    model_dir = os.path.join(output_directory, sanitize_filename(model_name), sanitize_filename(language))
-    file_name = f"{sanitize_filename(model_name)}_{sanitize_filename(language)}_evaluation.json"
-    file_path = os.path.join(model_dir, file_name)
-
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as file:
-            return json.load(file)
-    else:
+    # Previously evaluated results (if any) are rebuilt from the file and its checkpoint log
+    return CheckpointStore(file_path, key_depth=2)
+
+# Shared state of a judge run: concurrency cap, rate limiter and progress bar with call statistics
+class JudgeRunner:
+    def __init__(self, total_calls, cache=None):
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        self.limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+        self.cache = cache
+        self.progress = tqdm(total=total_calls, desc="Judge calls", unit="call")
+        self.started = time.monotonic()
+        self.api_calls = 0
+        self.retries = 0
+        # Malformed answers whose score was recovered locally / that had to be asked again
+        self.repaired = 0
+        self.requeried = 0
+
+    def call_done(self):
+        self.progress.update(1)
+        elapsed = time.monotonic() - self.started
+        postfix = {"api calls/s": f"{self.api_calls / elapsed:.1f}" if elapsed > 0 else "-", "retries": self.retries,
+                   "repaired": self.repaired, "re-queried": self.requeried}
+        if self.cache is not None:
+            postfix["cache hits"] = self.cache.hits
+        self.progress.set_postfix(postfix)
+
+# One judge request (bounded by the shared semaphore and rate limiter); returns the answer text
+async def request_judge(runner, system_prompt, user_prompt, label, max_tokens=MAX_TOKENS, **options):
+    queued = time.perf_counter()
+    async with runner.semaphore:
+        estimated_tokens = estimate_tokens(system_prompt + user_prompt) + max_tokens
+        await runner.limiter.acquire(estimated_tokens)
+        metrics.observe("queue_wait", time.perf_counter() - queued, api="openai")
+        runner.api_calls += 1
+        with metrics.span("api_call", api="openai", criterion=label):
+            response = await openai.ChatCompletion.acreate(
+                model=JUDGE_MODEL,
+                messages=[
+                    {"role": "system", "content": system_prompt.strip()},
+                    {"role": "user", "content": user_prompt.strip()}
+                ],
+                temperature=0.7,
+                max_tokens=max_tokens,
+                **options
+            )
+        runner.limiter.adjust(estimated_tokens, response['usage']['total_tokens'])
+        metrics.count("tokens", response['usage'].get('prompt_tokens'), api="openai", kind="input_tokens")
+        metrics.count("tokens", response['usage'].get('completion_tokens'), api="openai", kind="output_tokens")
+    return response['choices'][0]['message']['content'].strip()
+
+# Ask the judge model for one criterion. API errors (network, rate limits) are retried with exponential backoff
+# (honouring Retry-After); a malformed answer is repaired locally and asked again only if it holds no score at all.
+async def evaluate_criterion(runner, conv_id, scenario_name, criterion, system_prompt, user_prompt, language):
+    # Reuse the answer to an identical judge request from an earlier run
+    cache_key = None
+    if runner.cache is not None:
+        cache_key = JudgeCache.make_key(JUDGE_MODEL, system_prompt, user_prompt, language)
+        cached = runner.cache.get(cache_key)
+        metrics.count("judge_cache", 1, result="hit" if cached is not None else "miss")
+        if cached is not None:
+            return cached
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            assistant_content = await request_judge(runner, system_prompt, user_prompt, criterion)
+        except Exception as e:
+            tqdm.write(f"Error evaluating {criterion} for conv_id {conv_id}, scenario {scenario_name}: {e}")
+            if attempt == MAX_RETRIES - 1:
+                metrics.count("judge_failures", 1, error=type(e).__name__)
+                return f"Error: {e}", "Error"
+            runner.retries += 1
+            metrics.count("retries", 1, api="openai", error=type(e).__name__)
+            retry_after = parse_retry_after(getattr(e, "headers", None))
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
+            continue
+
+        # Extract and process the GPT response
+        parsed = parse_judge_answer(assistant_content)
+        if parsed is not None:
+            feedback, score, parse_result = parsed
+            metrics.count("judge_answers", 1, result=parse_result)
+            if parse_result == "repaired":
+                runner.repaired += 1
+            if cache_key is not None:
+                runner.cache.put(cache_key, criterion, feedback, score)
+            return feedback, score
+
+        # No score anywhere in the answer: ask again right away (nothing to back off from)
+        tqdm.write(f"No score in the answer for {criterion} for conv_id {conv_id}, scenario {scenario_name}")
+        metrics.count("judge_answers", 1, result="unparsed")
+        if attempt == MAX_RETRIES - 1:
+            metrics.count("judge_failures", 1, error="unparsed")
+            return assistant_content, "Error"
+        runner.requeried += 1
+
+# Criteria of a fused judge answer that come with a feedback and a 1-5 score: {criterion: (feedback, score)}
+def parse_fused_answer(content, criteria):
+    try:
+        answer = json.loads(content)
+    except ValueError:
+        return {}
+    if not isinstance(answer, dict):
         return {}
 
-# Perform evaluation of each scenario's empathetic response using GPT model
-def evaluate_scenario(conv_id, dialogue, scenario_name, empathetic_response, criteria, language):
-    result = {
-        "scenario": scenario_name,
-        "final_empathetic_statement": empathetic_response,
-        "evaluations": {},
-        "scores": {}
-    }
-
-    # General prompt shared across evaluations
-    common_prompt = """
+    parsed = {}
+    for criterion in criteria:
+        entry = answer.get(criterion)
+        if not isinstance(entry, dict) or not isinstance(entry.get("feedback"), str):
+            continue
+        score = parse_score(entry.get("score"))
+        if score is not None:
+            parsed[criterion] = (entry["feedback"].strip(), score)
+    return parsed
+
+# Ask the judge model for every criterion in one request (API errors are retried like per-criterion requests).
+# Returns the criteria it answered validly; the others are left to per-criterion requests.
+async def evaluate_fused(runner, conv_id, scenario_name, criteria, system_prompt, user_prompt, language):
+    # Criteria cached from an earlier fused answer; once one is cached, the missing ones already fell back before
+    cache_keys = {}
+    if runner.cache is not None:
+        cached = {}
+        for criterion in criteria:
+            cache_keys[criterion] = JudgeCache.make_key(JUDGE_MODEL, system_prompt, user_prompt, f"{language}|{criterion}")
+            answer = runner.cache.get(cache_keys[criterion])
+            metrics.count("judge_cache", 1, result="hit" if answer is not None else "miss")
+            if answer is not None:
+                cached[criterion] = answer
+        if cached:
+            return cached
+
+    for attempt in range(MAX_RETRIES):
+        retry_after = None
+        try:
+            content = await request_judge(runner, system_prompt, user_prompt, "fused", FUSED_MAX_TOKENS, response_format={"type": "json_object"})
+            break
+        except Exception as e:
+            tqdm.write(f"Error in the fused evaluation of conv_id {conv_id}, scenario {scenario_name}: {e}")
+            if attempt == MAX_RETRIES - 1:
+                metrics.count("judge_failures", 1, error=type(e).__name__)
+                return {}
+            runner.retries += 1
+            metrics.count("retries", 1, api="openai", error=type(e).__name__)
+            retry_after = parse_retry_after(getattr(e, "headers", None))
+        await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+    judged = parse_fused_answer(content, criteria)
+    metrics.count("fused_criteria", len(judged), result="parsed")
+    metrics.count("fused_criteria", len(criteria) - len(judged), result="fallback")
+    for criterion, (feedback, score) in judged.items():
+        if criterion in cache_keys:
+            runner.cache.put(cache_keys[criterion], criterion, feedback, score)
+    return judged
+
+# General prompt shared across evaluations
+COMMON_PROMPT = """
     You will be given one response for one dialogue.
 
     Your task is to rate the response based on the criteria provided.
@@ -63,8 +250,9 @@ def evaluate_scenario(conv_id, dialogue, scenario_name, empathetic_response, cri
     Please make sure you read and understand these criteria carefully. Refer back to them as needed during your evaluation.
     """
 
-    # Detailed descriptions of each evaluation criterion
-    criteria_prompts = {
+# Detailed descriptions of each evaluation criterion
+def build_criteria_prompts(language):
+    return {
         "Explorations (EX)": """
         **Explorations (EX)** (1-5) - This criterion evaluates whether the response shows active interest in further exploring the interlocutor's situation or feelings and attempts to probe emotions or experiences that have not been explicitly stated.
         Score 1: No attempt to explore the interlocutor's emotions or experiences, showing no additional inquiry or interest.
@@ -107,12 +295,9 @@ def evaluate_scenario(conv_id, dialogue, scenario_name, empathetic_response, cri
 
     }
 
-    # Loop through each criterion to evaluate the response
-    for criterion in criteria:
-        system_prompt = common_prompt + criteria_prompts[criterion]
-
-        # Create the user prompt including the dialogue and empathetic response
-        user_prompt = f"""
+# User prompt of a per-criterion judge request, including the dialogue and empathetic response
+def build_user_prompt(dialogue, empathetic_response, criterion):
+    return f"""
         **Dialogue:**
         {dialogue}
 
@@ -125,113 +310,159 @@ def evaluate_scenario(conv_id, dialogue, scenario_name, empathetic_response, cri
         Feedback: [Your feedback here]
         Score: [1-5]"""
 
-        # Retry mechanism to handle potential API errors
-        max_retries = 5
-        for attempt in range(max_retries):
-            try:
-                response = openai.ChatCompletion.create(
-                    model="gpt-4o",  
-                    messages=[
-                        {"role": "system", "content": system_prompt.strip()},
-                        {"role": "user", "content": user_prompt.strip()}
-                    ],
-                    temperature=0.7,  
-                    max_tokens=256  
-                )
-
-                # Extract and process the GPT response
-                assistant_content = response['choices'][0]['message']['content'].strip()
-                feedback, score = assistant_content.split("Score:")  
-                score = int(score.strip()) 
-                result['evaluations'][criterion] = feedback.strip()  
-                result['scores'][criterion] = score  
-
-                break  
-
-            except Exception as e:
-                print(f"Error evaluating {criterion} for conv_id {conv_id}, scenario {scenario_name}: {e}")
-                time.sleep(1)  
-                if attempt == max_retries - 1:
-                    result['evaluations'][criterion] = f"Error: {e}"
-                    result['scores'][criterion] = "Error"
+# System and user prompt of a fused judge request: every criterion rubric in one request, answered as JSON
+def build_fused_prompts(dialogue, empathetic_response, criteria, criteria_prompts):
+    system_prompt = COMMON_PROMPT + "".join(criteria_prompts[criterion] for criterion in criteria)
+    criteria_keys = ", ".join(f'"{criterion}"' for criterion in criteria)
+    user_prompt = f"""
+        **Dialogue:**
+        {dialogue}
+
+        **Empathetic Response:**
+        {empathetic_response}
+
+        Please give feedback on the listener’s responses for each of the criteria above. Also, provide the listener with a score on a scale of 1 to 5 for each criterion, where a higher score indicates better overall performance. Make sure to give feedback or comments for a criterion first and then write its score.
+
+        **Response Format:**
+        A JSON object with one key per criterion ({criteria_keys}), each mapping to {{"feedback": "[Your feedback here]", "score": [1-5]}}"""
+    return system_prompt, user_prompt
+
+# Perform evaluation of each scenario's empathetic response using GPT model (all criteria in parallel)
+async def evaluate_scenario(runner, conv_id, dialogue, scenario_name, empathetic_response, criteria, language):
+    result = {
+        "scenario": scenario_name,
+        "final_empathetic_statement": empathetic_response,
+        "evaluations": {},
+        "scores": {}
+    }
+
+    criteria_prompts = build_criteria_prompts(language)
+
+    # Fused judge: every criterion rubric in one request, answered as JSON
+    fused = {}
+    if FUSED_JUDGE:
+        fused_system_prompt, fused_user_prompt = build_fused_prompts(dialogue, empathetic_response, criteria, criteria_prompts)
+        fused = await evaluate_fused(runner, conv_id, scenario_name, criteria, fused_system_prompt, fused_user_prompt, language)
+        for _ in fused:
+            runner.call_done()
+
+    # Build the prompts of each criterion to evaluate the response (only those the fused answer did not cover)
+    calls = []
+    call_criteria = []
+    build_start = time.perf_counter()
+    for criterion in criteria:
+        if criterion in fused:
+            continue
+        system_prompt = COMMON_PROMPT + criteria_prompts[criterion]
+        user_prompt = build_user_prompt(dialogue, empathetic_response, criterion)
+        calls.append(evaluate_criterion(runner, conv_id, scenario_name, criterion, system_prompt, user_prompt, language))
+        call_criteria.append(criterion)
+    metrics.observe("prompt_build", time.perf_counter() - build_start)
+
+    async def run_call(call):
+        try:
+            return await call
+        finally:
+            runner.call_done()
+
+    # Results are stored in criteria order whatever order the calls finish in
+    answers = dict(fused)
+    answers.update(zip(call_criteria, await asyncio.gather(*[run_call(call) for call in calls])))
+    for criterion in criteria:
+        feedback, score = answers[criterion]
+        result['evaluations'][criterion] = feedback
+        result['scores'][criterion] = score
 
     return result
 
 # Main function to execute the evaluation process
-def main():
+async def main():
+    metrics.enable(METRICS_FILE, TRACE_FILE)
     project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
     base_directory = os.path.join(project_root, 'output', 'experiment_results', 'sample')
-    output_directory = os.path.join(project_root, 'output', 'eval_results', 'sample')
-
-    models = [
-        "claude-3-5-sonnet-20240620",
-        "Meta-Llama-3.1-8B-Instruct",
-        "Mistral-7B-Instruct-v0.3",
-        "Qwen2-7B-Instruct",
-        "EXAONE-3.0-7.8B-Instruct"
-    ]
-    languages = ["Korean","English"]
-
-    # List of evaluation criteria
-    criteria = [
-        "Explorations (EX)",
-        "Interpretations (IP)",
-        "Emotional Reactions (ER)",
-        "Evoked Emotion Alignment (EEA)",
-        "Cultural Appropriateness (CA)"
-    ]
-
-    # Iterate over each model and language combination
-    for model_name in models:
-        for language in languages:
+    output_directory = os.path.join(project_root, 'output', 'eval_results', EVAL_OUTPUT_NAME)
+
+    # Only the conv_id index of the dataset is needed here; no dialogue is parsed
+    dataset = KoEDDataset(DATA_FILE)
+
+    # Collect the pending scenarios of every model and language combination
+    stores = []
+    pending = []
+    for model_name in EVAL_MODELS:
+        for language in EVAL_LANGUAGES:
             input_file = os.path.join(base_directory, f"results_{model_name}_{language}.json")
-            data = load_json_data(input_file)  
 
             # Check if the input file exists
             if not os.path.exists(input_file):
                 print(f"Input file not found: {input_file}")
                 continue
 
+            with metrics.span("file_read", model=model_name, lang=language):
+                data = load_json_data(input_file)
+
             # Load previously evaluated results (if any)
-            results = load_evaluated_results(output_directory, model_name, language)
+            results = open_evaluation_store(output_directory, model_name, language)
+            stores.append((results, [conv_id for conv_id in dataset.conv_ids if conv_id in data]))
 
             print(f"Processing model: {model_name}, language: {language}")
 
-            # Iterate through the entries in the JSON data
-            for entry in tqdm(data.values(), desc=f"{model_name} - {language}"):
-                conv_id = entry.get("conv_id")  
-                dialogue = entry.get("dialogue", "") 
-                scenarios = entry.get("scenarios", [])  
+            # Iterate through the entries of the dataset that have results
+            for conv_id in dataset.conv_ids:
+                entry = data.get(conv_id)
+                if entry is None:
+                    continue
+                dialogue = entry.get("dialogue", "")
+                scenarios = entry.get("scenarios", [])
 
                 for scenario in scenarios:
-                    scenario_name = scenario.get("scenario")  
-                    empathetic_response = scenario.get("final_empathetic_statement")  
+                    scenario_name = scenario.get("scenario")
+                    empathetic_response = scenario.get("final_empathetic_statement")
 
                     # Skip evaluation if this scenario has already been evaluated
-                    if conv_id in results and scenario_name in results[conv_id]:
-                        print(f"Skipping already evaluated scenario: {scenario_name} for conv_id {conv_id}")
+                    if results.has(conv_id, scenario_name):
                         continue
 
-                    # Perform the evaluation for each scenario
-                    evaluation_result = evaluate_scenario(
-                        conv_id=conv_id,
-                        dialogue=dialogue,
-                        scenario_name=scenario_name,
-                        empathetic_response=empathetic_response,
-                        criteria=criteria,
-                        language=language
-                    )
-
-                    # Update results with the new evaluation and save to file
-                    results = {**results, **{conv_id: {**results.get(conv_id, {}), **{scenario_name: evaluation_result}}}}
-                    save_evaluation_to_file(
-                        results=results,
-                        output_directory=output_directory,
-                        model_name=model_name,
-                        language=language
-                    )
+                    pending.append((results, language, conv_id, dialogue, scenario_name, empathetic_response))
+
+    print(f"{len(pending)} scenarios to evaluate ({len(pending) * len(CRITERIA)} judge calls)")
+    cache = JudgeCache(JUDGE_CACHE_PATH, JUDGE_CACHE_MAX_ENTRIES, JUDGE_CACHE_MAX_AGE_DAYS) if JUDGE_CACHE_PATH else None
+    runner = JudgeRunner(total_calls=len(pending) * len(CRITERIA), cache=cache)
+
+    # One pooled HTTP session shared by every judge call
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=MAX_CONCURRENCY)) as session:
+        openai.aiosession.set(session)
+
+        async def run_scenario(results, language, conv_id, dialogue, scenario_name, empathetic_response):
+            # Perform the evaluation for each scenario
+            evaluation_result = await evaluate_scenario(
+                runner,
+                conv_id=conv_id,
+                dialogue=dialogue,
+                scenario_name=scenario_name,
+                empathetic_response=empathetic_response,
+                criteria=CRITERIA,
+                language=language
+            )
+
+            # Append the new evaluation to the checkpoint log
+            results.add(evaluation_result, conv_id, scenario_name)
+
+        with metrics.span("stage", stage="evaluate"):
+            await asyncio.gather(*[run_scenario(*item) for item in pending])
+
+    runner.progress.close()
+    print(f"Judge answers: {runner.repaired} repaired locally, {runner.requeried} re-queried")
+    if cache is not None:
+        print(f"Judge cache: {cache.stats()}")
+        cache.close()
+
+    # Rewrite the evaluation files from their checkpoint logs in dataset order
+    for results, order in stores:
+        results.compact(order=order)
+        results.close(compact=False)
+    metrics.write()
 
 # Run the main function when the script is executed
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+import os
+import sys
+import json
+import glob
+
+# Agreement report between two evaluation runs of eval.py, typically per-criterion judging (EVAL_OUTPUT_NAME "sample")
+# and fused judging (FUSED_JUDGE = True, EVAL_OUTPUT_NAME "sample_fused") on the same results.
+# For every criterion: number of scenarios scored by both runs, exact agreement, agreement within one point, mean
+# score difference (second run minus first) and Pearson correlation.
+
+EVAL_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'output', 'eval_results')
+
+# {(model, language, conv_id, scenario): {criterion: score}} of every evaluation file of a run
+def load_scores(run_directory):
+    scores = {}
+    for path in glob.glob(os.path.join(run_directory, '*', '*', '*_evaluation.json')):
+        model_name = os.path.basename(os.path.dirname(os.path.dirname(path)))
+        language = os.path.basename(os.path.dirname(path))
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for conv_id, scenarios in data.items():
+            for scenario_name, evaluation in scenarios.items():
+                scores[(model_name, language, conv_id, scenario_name)] = evaluation.get("scores", {})
+    return scores
+
+def pearson(xs, ys):
+    if len(xs) < 2:
+        return None
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    variance_x = sum((x - mean_x) ** 2 for x in xs)
+    variance_y = sum((y - mean_y) ** 2 for y in ys)
+    if variance_x == 0 or variance_y == 0:
+        return None
+    return covariance / (variance_x * variance_y) ** 0.5
+
+# Per-criterion agreement of the scores both runs gave to the same scenarios (failed scores are skipped)
+def agreement(reference_scores, other_scores):
+    pairs = {}
+    for key in reference_scores.keys() & other_scores.keys():
+        for criterion, reference in reference_scores[key].items():
+            other = other_scores[key].get(criterion)
+            if isinstance(reference, int) and isinstance(other, int):
+                pairs.setdefault(criterion, []).append((reference, other))
+
+    report = {}
+    for criterion, criterion_pairs in pairs.items():
+        references = [reference for reference, _ in criterion_pairs]
+        others = [other for _, other in criterion_pairs]
+        report[criterion] = {
+            "n": len(criterion_pairs),
+            "exact": sum(reference == other for reference, other in criterion_pairs) / len(criterion_pairs),
+            "within_one": sum(abs(reference - other) <= 1 for reference, other in criterion_pairs) / len(criterion_pairs),
+            "mean_difference": sum(other - reference for reference, other in criterion_pairs) / len(criterion_pairs),
+            "pearson": pearson(references, others),
+        }
+    return report
+
+def print_report(report, reference_name, other_name):
+    print(f"Agreement of {other_name} with {reference_name}")
+    print(f"{'criterion':<34} {'n':>6} {'exact':>7} {'±1':>7} {'mean diff':>10} {'pearson':>8}")
+    for criterion, row in report.items():
+        pearson_text = "-" if row["pearson"] is None else f"{row['pearson']:.3f}"
+        print(f"{criterion:<34} {row['n']:>6} {row['exact']:>7.1%} {row['within_one']:>7.1%} {row['mean_difference']:>+10.3f} {pearson_text:>8}")
+
+if __name__ == "__main__":
+    reference_name = sys.argv[1] if len(sys.argv) > 1 else "sample"
+    other_name = sys.argv[2] if len(sys.argv) > 2 else "sample_fused"
+    report = agreement(load_scores(os.path.join(EVAL_RESULTS_DIR, reference_name)), load_scores(os.path.join(EVAL_RESULTS_DIR, other_name)))
+    if not report:
+        print(f"No scenarios scored by both {reference_name} and {other_name}.")
+    else:
+        print_report(report, reference_name, other_name)
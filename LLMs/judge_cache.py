@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+# Persistent, content-addressed cache of judge answers.
+# An answer is keyed by a hash of the judge model, the criterion (system) prompt, the user prompt holding the dialogue
+# and the response, and the language, so a rerun only pays for (dialogue, response, criterion) triples it has not seen
+# and editing one criterion rubric only invalidates that criterion.
+class JudgeCache:
+    def __init__(self, path, max_entries=None, max_age_days=None, commit_every=50):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self._uncommitted = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS judgements (
+                key TEXT PRIMARY KEY,
+                criterion TEXT,
+                feedback TEXT,
+                score INTEGER,
+                created REAL,
+                accessed REAL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS judgements_accessed ON judgements (accessed)")
+        self.evict()
+
+    @staticmethod
+    def make_key(judge_model, system_prompt, user_prompt, language):
+        payload = json.dumps([judge_model, system_prompt, user_prompt, language], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    # (feedback, score) of a cached answer, or None
+    def get(self, key):
+        row = self.connection.execute("SELECT feedback, score FROM judgements WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute("UPDATE judgements SET accessed = ? WHERE key = ?", (time.time(), key))
+        self._count_write()
+        return row[0], row[1]
+
+    def put(self, key, criterion, feedback, score):
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO judgements (key, criterion, feedback, score, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, criterion, feedback, score, now, now),
+        )
+        self._count_write()
+
+    def _count_write(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.connection.commit()
+            self._uncommitted = 0
+
+    # Drop answers older than max_age_days, then the least recently used ones beyond max_entries
+    def evict(self):
+        if self.max_age_days is not None:
+            self.connection.execute("DELETE FROM judgements WHERE created < ?", (time.time() - self.max_age_days * 86400,))
+        if self.max_entries is not None:
+            self.connection.execute(
+                "DELETE FROM judgements WHERE key NOT IN (SELECT key FROM judgements ORDER BY accessed DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+        self.connection.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        size = self.connection.execute("SELECT COUNT(*) FROM judgements").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0, "entries": size}
+
+    def close(self):
+        self.evict()
+        self.connection.close()
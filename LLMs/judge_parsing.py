@@ -0,0 +1,96 @@
+import re
+
+# Parsing of per-criterion judge answers ("Feedback: ...\nScore: n").
+# An answer that arrived but does not follow the format exactly is repaired locally when a 1-5 score can still be
+# found in it (markdown bold, "4/5", "4 out of 5", a trailing number); only answers without any recoverable score
+# need another judge request. Transport and rate-limit errors are not handled here: they never produce an answer.
+
+MIN_SCORE = 1
+MAX_SCORE = 5
+
+# Score patterns, most specific first; the last match of the first pattern that matches wins (judges tend to restate
+# the rubric before scoring). "Score" only counts as a label ("Score:", "Score for ...:"), so feedback that merely
+# mentions scores is not read as one.
+SCORE_PATTERNS = [
+    # "Score: **4**", "**Score:** 4", "Score for the **Explorations (EX)**: 4", "Score (1-5): 4", "Score: 4/5"
+    re.compile(r'\bscore\b(?:\s+for\b[^:：\n]{0,80}|\s*\([^)\n]{0,20}\))?\s*\**\s*[:：]\s*\**\s*([1-5])(?:\s*(?:/|out of)\s*5)?(?!\s*[-–]\s*\d)(?![\d.]*\d)', re.IGNORECASE),
+    # "4/5", "4 out of 5"
+    re.compile(r'(?<![\d.\-–/])\b([1-5])\s*(?:/|out of)\s*5\b', re.IGNORECASE),
+    # "**4**"
+    re.compile(r'\*\*\s*([1-5])\s*\*\*'),
+    # a number ending the answer ("... Overall: 4.")
+    re.compile(r'(?<![\d.\-–/])\b([1-5])\s*[.*)\]]*\s*$'),
+]
+
+# Answer in the requested format: exactly one "Score:" followed by an integer in range
+def parse_strict(content):
+    try:
+        feedback, score = content.split("Score:")
+        score = int(score.strip())
+    except ValueError:
+        return None
+    if not MIN_SCORE <= score <= MAX_SCORE:
+        return None
+    return feedback.strip(), score
+
+# Score found anywhere in a malformed answer; the feedback is the text before the line holding the score (or the
+# whole answer when the score is on its first line)
+def repair(content):
+    for pattern in SCORE_PATTERNS:
+        matches = list(pattern.finditer(content))
+        if not matches:
+            continue
+        match = matches[-1]
+        line_start = content.rfind('\n', 0, match.start())
+        feedback = content[:line_start].strip() if line_start > 0 else content.strip()
+        return feedback, int(match.group(1))
+    return None
+
+# (feedback, score, "strict" | "repaired") of a judge answer, or None if it holds no recoverable score
+def parse_judge_answer(content):
+    parsed = parse_strict(content)
+    if parsed is not None:
+        return parsed + ("strict",)
+    parsed = repair(content)
+    if parsed is not None:
+        return parsed + ("repaired",)
+    return None
+
+# Score field of a fused (JSON) answer: an integer or a string such as "4", "4/5" or "**4**"; None if out of range
+def parse_score(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        score = int(value) if float(value).is_integer() else None
+    elif isinstance(value, str):
+        parsed = parse_strict("Score:" + value) or repair(value)
+        score = parsed[1] if parsed is not None else None
+    else:
+        score = None
+    if score is None or not MIN_SCORE <= score <= MAX_SCORE:
+        return None
+    return score
+
+# Malformed answers and the score repair() must find in them (None: re-query the judge)
+REPAIR_EXAMPLES = [
+    ("Feedback: Warm and specific.\nScore: **4**", 4),
+    ("Feedback: Warm and specific.\n**Score:** 4", 4),
+    ("Feedback: Explores the feelings.\nScore for the **Explorations (EX)**: 3", 3),
+    ("Feedback: Good.\nScore (1-5): 5", 5),
+    ("Feedback: Good.\nScore: 2/5", 2),
+    ("Feedback: Reasonable, 4 out of 5.", 4),
+    ("Feedback: The response scores poorly in 2 aspects.", None),
+    ("Feedback: It would score higher with 3 more details.", None),
+    ("Score 5 would need more. Final: 3", 3),
+]
+
+# Check repair() against REPAIR_EXAMPLES
+if __name__ == "__main__":
+    failures = 0
+    for content, expected in REPAIR_EXAMPLES:
+        parsed = repair(content)
+        score = parsed[1] if parsed is not None else None
+        if score != expected:
+            failures += 1
+            print(f"{content!r}: got {score}, expected {expected}")
+    print(f"{len(REPAIR_EXAMPLES) - failures}/{len(REPAIR_EXAMPLES)} repair examples correct")
@@ -0,0 +1,128 @@
+import os
+import re
+import json
+import mmap
+import hashlib
+
+# Strings are skipped whole so that brackets inside utterances are never counted
+JSON_TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]', re.DOTALL)
+CONV_ID = re.compile(rb'"conv_id"\s*:\s*("(?:[^"\\]|\\.)*")', re.DOTALL)
+
+# Stable shard of a conversation (Python's hash() is salted per process)
+def conv_id_shard(conv_id, num_shards):
+    return int(hashlib.md5(conv_id.encode('utf-8')).hexdigest(), 16) % num_shards
+
+# Byte span of every dialogue object of a KoED file (a top-level JSON array of objects) and its conv_id
+def build_index(buffer):
+    conv_ids, offsets = [], []
+    depth = 0
+    start = None
+    for match in JSON_TOKEN.finditer(buffer):
+        token = match.group()[:1]
+        if token == b'"':
+            continue
+        if token in (b'[', b'{'):
+            depth += 1
+            if depth == 2 and token == b'{':
+                start = match.start()
+        else:
+            if depth == 2 and token == b'}':
+                conv_id = CONV_ID.search(buffer, start, match.end())
+                conv_ids.append(json.loads(conv_id.group(1)) if conv_id else None)
+                offsets.append([start, match.end()])
+            depth -= 1
+    return conv_ids, offsets
+
+# Lazy, indexed view of a KoED dataset file.
+# A byte-offset index per conv_id is built on first use and persisted next to the data file ('<file>.idx.json');
+# the file is memory-mapped and dialogues are only parsed when accessed, so startup and memory stay flat.
+class KoEDDataset:
+    def __init__(self, path, rows=None, _shared=None):
+        self.path = path
+        if _shared is None:
+            _shared = self._open(path)
+        self._shared = _shared
+        self.rows = list(range(len(_shared["conv_ids"]))) if rows is None else rows
+        self._row_set = None
+
+    @staticmethod
+    def _open(path):
+        index_path = path + '.idx.json'
+        stat = os.stat(path)
+        index = None
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get("size") != stat.st_size or index.get("mtime_ns") != stat.st_mtime_ns:
+                index = None
+
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if index is None:
+            conv_ids, offsets = build_index(buffer)
+            index = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "conv_ids": conv_ids, "offsets": offsets}
+            try:
+                with open(index_path, 'w', encoding='utf-8') as f:
+                    json.dump(index, f, ensure_ascii=False)
+            except OSError:
+                pass
+
+        return {
+            "buffer": buffer,
+            "conv_ids": index["conv_ids"],
+            "offsets": index["offsets"],
+            "positions": {conv_id: row for row, conv_id in enumerate(index["conv_ids"])},
+        }
+
+    def _parse(self, row):
+        start, end = self._shared["offsets"][row]
+        return json.loads(self._shared["buffer"][start:end])
+
+    # conv_ids in file order, without parsing any dialogue
+    @property
+    def conv_ids(self):
+        return [self._shared["conv_ids"][row] for row in self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self._parse(row)
+
+    # Integer index returns one dialogue, a slice returns a lazy sub-dataset
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return KoEDDataset(self.path, self.rows[item], self._shared)
+        return self._parse(self.rows[item])
+
+    # Row of a conv_id within this (sub-)dataset, or None
+    def _row_of(self, conv_id):
+        row = self._shared["positions"].get(conv_id)
+        if row is None or len(self.rows) == len(self._shared["conv_ids"]):
+            return row
+        if self._row_set is None:
+            self._row_set = set(self.rows)
+        return row if row in self._row_set else None
+
+    def __contains__(self, conv_id):
+        return self._row_of(conv_id) is not None
+
+    # Dialogue with the given conv_id (None if absent)
+    def get(self, conv_id):
+        row = self._row_of(conv_id)
+        return None if row is None else self._parse(row)
+
+    # Sub-dataset of the given conv_ids, in that order
+    def select(self, conv_ids):
+        positions = self._shared["positions"]
+        return KoEDDataset(self.path, [positions[conv_id] for conv_id in conv_ids if conv_id in positions], self._shared)
+
+    # Shard `index` of `num_shards`, assigned by a stable hash of the conv_id
+    def shard(self, index, num_shards):
+        return KoEDDataset(
+            self.path,
+            [row for row in self.rows if conv_id_shard(self._shared["conv_ids"][row], num_shards) == index],
+            self._shared,
+        )
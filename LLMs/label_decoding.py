@@ -0,0 +1,121 @@
+import torch
+from transformers import LogitsProcessor
+
+# Label-constrained decoding for the emotion-identification step (step 1).
+# Instead of a free-form answer that postprocessing.py later searches for labels, the model may only write labels of
+# the 34-emotion list separated by ", " and then stop: every decode step is masked to the tokens that continue a
+# label (token trie), start the next label or end the answer. Step 1 then takes a few decode steps instead of up to
+# MAX_NEW_TOKENS, and the labels are known from the trie walk without any parsing.
+
+# The 34 labels of the identification scenarios (same spelling as thirty_four_emotions in postprocessing.py)
+EMOTION_LABELS = [
+    "Afraid", "Angry", "Annoyed", "Anticipating", "Anxious", "Apprehensive", "Ashamed", "Caring", "Confident",
+    "Content", "Devastated", "Disappointed", "Disgusted", "Embarrassed", "Excited", "Faithful", "Furious", "Grateful",
+    "Guilty", "Hopeful", "Impressed", "Jealous", "Joyful", "Lonely", "Nostalgic", "Prepared", "Proud", "Sad",
+    "Sentimental", "Surprised", "Terrified", "Trusting", "정", "한",
+]
+
+# Number of labels each identification scenario may answer with
+SCENARIO_LABEL_LIMITS = {
+    "34개의 단일 감정": 1,
+    "34개의 멀티 감정": 4,
+}
+
+LABEL_SEPARATOR = ", "
+
+# Trie node over token ids; `label` is set where a label ends and `labels` holds every label below the node
+class TrieNode:
+    __slots__ = ("children", "label", "labels")
+
+    def __init__(self):
+        self.children = {}
+        self.label = None
+        self.labels = set()
+
+def build_trie(sequences):
+    root = TrieNode()
+    for label, token_ids in sequences:
+        node = root
+        node.labels.add(label)
+        for token_id in token_ids:
+            node = node.children.setdefault(token_id, TrieNode())
+            node.labels.add(label)
+        node.label = label
+    return root
+
+def trie_depth(node):
+    return max([1 + trie_depth(child) for child in node.children.values()], default=0)
+
+# Token tries of the labels for one tokenizer: the first label is encoded on its own, every further label together
+# with its separator (so that the separator merges with the label the way the tokenizer would write it)
+class LabelTrie:
+    def __init__(self, tokenizer, labels=EMOTION_LABELS, separator=LABEL_SEPARATOR):
+        self.first = build_trie([(label, tokenizer.encode(label, add_special_tokens=False)) for label in labels])
+        self.next = build_trie([(label, tokenizer.encode(separator + label, add_special_tokens=False)) for label in labels])
+        self.separator = separator
+
+    # Decode steps needed for the longest answer of `limit` labels and the end token
+    def max_new_tokens(self, limit):
+        return trie_depth(self.first) + (limit - 1) * trie_depth(self.next) + 1
+
+# Walk of one generated sequence through the tries: the labels written so far, the current node and whether the
+# answer has ended
+def walk(trie, token_ids, limit, eos_token_ids):
+    labels = []
+    node = trie.first
+    for token_id in token_ids:
+        if token_id in node.children:
+            node = node.children[token_id]
+            continue
+        if node.label is not None:
+            labels.append(node.label)
+            if token_id in eos_token_ids:
+                return labels, None, True
+            if len(labels) < limit and token_id in trie.next.children:
+                node = trie.next.children[token_id]
+                continue
+        # Not reachable under the constraint (e.g. padding after the end token)
+        return labels, None, True
+    return labels, node, False
+
+# Logits processor restricting every row of a batch to the answers of its trie; prompt_width is the width of the
+# (padded) prompt, so the tokens after it are the answer
+class LabelLogitsProcessor(LogitsProcessor):
+    def __init__(self, trie, limit, prompt_width, eos_token_ids):
+        self.trie = trie
+        self.limit = limit
+        self.prompt_width = prompt_width
+        self.eos_token_ids = list(eos_token_ids)
+
+    def allowed_tokens(self, token_ids):
+        labels, node, ended = walk(self.trie, token_ids, self.limit, self.eos_token_ids)
+        if ended:
+            return self.eos_token_ids
+        used = set(labels)
+        allowed = [token_id for token_id, child in node.children.items() if child.labels - used]
+        if node.label is not None and node.label not in used:
+            used.add(node.label)
+            allowed += self.eos_token_ids
+            if len(labels) + 1 < self.limit:
+                allowed += [token_id for token_id, child in self.trie.next.children.items() if child.labels - used]
+        return allowed
+
+    def __call__(self, input_ids, scores):
+        mask = torch.full_like(scores, float("-inf"))
+        for row, token_ids in enumerate(input_ids[:, self.prompt_width:].tolist()):
+            mask[row, self.allowed_tokens(token_ids)] = 0
+        return scores + mask
+
+    # Labels of a finished answer
+    def labels(self, token_ids):
+        labels, node, _ = walk(self.trie, token_ids, self.limit, self.eos_token_ids)
+        if node is not None and node.label is not None and node.label not in labels:
+            labels.append(node.label)
+        return labels
+
+# End-of-answer token ids of a model (the generation config may list several, e.g. <|eot_id|> for Llama 3)
+def eos_token_ids(model, tokenizer):
+    eos = getattr(model.generation_config, "eos_token_id", None)
+    if eos is None:
+        eos = tokenizer.eos_token_id
+    return eos if isinstance(eos, list) else [eos]
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import multiprocessing
+
+# Data-parallel run of open_source.py: the dataset is split into NUM_SHARDS shards by a stable hash of the conv_id
+# and every shard is generated by its own worker process with its own model instances. Each worker checkpoints into
+# its own results_{model}_{lang}.shard{i}of{n}.json, so a shard can be rerun on its own; once every worker has
+# finished, the shards are merged into the usual results_{model}_{lang}.json files.
+
+NUM_SHARDS = 2
+
+# One device per worker, cycled if there are fewer devices than shards (CUDA_VISIBLE_DEVICES values, e.g. ["0", "1"]).
+# None runs the workers on CPU, each pinned to its own set of cores.
+DEVICES = None
+
+# CPU threads (and cores) per worker; None splits the available cores evenly
+THREADS_PER_WORKER = None
+
+# Restrict the current process to a device or to a CPU-core budget. Must run before torch is imported.
+def pin_worker(shard_index, num_shards, device, threads):
+    if device is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+    else:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+        threads = threads or max(1, len(cores) // num_shards)
+        start = (shard_index * threads) % len(cores)
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores[start:start + threads] or cores)
+        for variable in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+            os.environ[variable] = str(threads)
+        return threads
+    return None
+
+# Worker process: pin, then run open_source.py on one shard
+def run_shard(shard_index, num_shards, device, threads):
+    threads = pin_worker(shard_index, num_shards, device, threads)
+
+    import torch
+    import open_source
+    if threads is not None:
+        torch.set_num_threads(threads)
+    print(f"Shard {shard_index}/{num_shards}: device {device}, threads {torch.get_num_threads()}")
+    open_source.main(shard=(shard_index, num_shards))
+
+# Start one worker per shard (spawned, so that each one imports torch after it has been pinned), wait for all of them
+# and merge the results of the successful ones. Failed shards are reported and keep their checkpoint for the next run
+# (their files are left out of the merge, which deletes the shard files it merged).
+def launch(num_shards=NUM_SHARDS, devices=DEVICES, threads_per_worker=THREADS_PER_WORKER, target=run_shard, merge=True):
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    start = time.perf_counter()
+    for shard_index in range(num_shards):
+        device = devices[shard_index % len(devices)] if devices else None
+        worker = context.Process(target=target, args=(shard_index, num_shards, device, threads_per_worker), name=f"shard-{shard_index}")
+        worker.start()
+        workers.append(worker)
+
+    failed = []
+    for shard_index, worker in enumerate(workers):
+        worker.join()
+        if worker.exitcode != 0:
+            failed.append(shard_index)
+    print(f"{num_shards} shards finished in {time.perf_counter() - start:.1f} s")
+    if failed:
+        print(f"Shards {failed} failed; rerun to resume them.")
+
+    if merge:
+        import open_source
+        open_source.merge_shard_results(num_shards, [index for index in range(num_shards) if index not in failed])
+    return failed
+
+if __name__ == "__main__":
+    sys.exit(1 if launch() else 0)
@@ -0,0 +1,217 @@
+import os
+import re
+import csv
+import json
+import time
+import asyncio
+import threading
+import contextlib
+
+# Lightweight metrics and tracing for claude.py, open_source.py and eval.py.
+# Timings (API calls, queueing, generation batches, file writes, whole stages) and counters (tokens, retries, cache
+# hits) are aggregated per name and label set and written as a Prometheus textfile (or as CSV for a .csv path);
+# optionally, every timed span is also written as a Chrome-trace JSON (chrome://tracing or https://ui.perfetto.dev).
+# Everything is off until enable() is called with a file: spans are then a shared no-op context manager and
+# observe()/count() return immediately.
+#
+#     metrics.enable(METRICS_FILE, TRACE_FILE)
+#     with metrics.span("api_call", api="openai"):
+#         ...
+#     metrics.count("tokens", 120, kind="input")
+#     metrics.write()
+
+QUANTILES = [0.5, 0.9, 0.99]
+METRIC_PREFIX = "koed_"
+
+NULL_SPAN = contextlib.nullcontext()
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+# Path with a suffix inserted before the extension (e.g. one metrics file per shard worker)
+def with_suffix(path, suffix):
+    if not path or not suffix:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.{suffix}{extension}"
+
+# Timed block; on exit its duration is recorded as a timing and, with tracing, as a trace event
+class Span:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.metrics._finish(self, time.perf_counter())
+        return False
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.metrics_file = None
+        self.trace_file = None
+        self.timings = {}
+        self.counters = {}
+        self.events = []
+        self._thread_ids = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    # Start a new run (earlier measurements are dropped)
+    def enable(self, metrics_file=None, trace_file=None):
+        self.metrics_file = metrics_file
+        self.trace_file = trace_file
+        self.enabled = bool(metrics_file or trace_file)
+        self.timings = {}
+        self.counters = {}
+        self.events = []
+        self._thread_ids = {}
+        self._origin = time.perf_counter()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def span(self, name, **labels):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, labels)
+
+    # Record a duration measured by the caller
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self.timings.setdefault(key, []).append(seconds)
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled or not value:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # Wrap a function so that each call is a span (the function itself when metrics are off)
+    def timed(self, name, function, **labels):
+        if not self.enabled:
+            return function
+
+        def wrapper(*args, **kwargs):
+            with self.span(name, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+
+    # Trace row of the current asyncio task, or of the current thread outside an event loop
+    def _thread_id(self):
+        try:
+            owner = asyncio.current_task()
+        except RuntimeError:
+            owner = None
+        owner = ("task", id(owner)) if owner is not None else ("thread", threading.get_ident())
+        if owner not in self._thread_ids:
+            self._thread_ids[owner] = len(self._thread_ids) + 1
+        return self._thread_ids[owner]
+
+    def _finish(self, span, end):
+        key = self._key(span.name, span.labels)
+        with self._lock:
+            self.timings.setdefault(key, []).append(end - span.start)
+            if self.trace_file:
+                self.events.append({
+                    "name": span.name,
+                    "ph": "X",
+                    "ts": (span.start - self._origin) * 1e6,
+                    "dur": (end - span.start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": self._thread_id(),
+                    "args": span.labels,
+                })
+
+    # One row per timing and counter: (type, name, labels, count, sum, quantiles, max)
+    def rows(self):
+        rows = []
+        for (name, labels), values in sorted(self.timings.items()):
+            rows.append(("timing", name, labels, len(values), sum(values), [percentile(values, q) for q in QUANTILES], max(values)))
+        for (name, labels), value in sorted(self.counters.items()):
+            rows.append(("counter", name, labels, None, value, None, None))
+        return rows
+
+    def _write_prometheus(self, f):
+        def metric_name(name):
+            return METRIC_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+        def label_text(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ""
+            escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels]
+            return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+        declared = set()
+        for kind, name, labels, count, total, quantiles, _ in self.rows():
+            if kind == "timing":
+                name = metric_name(name) + "_seconds"
+                if name not in declared:
+                    f.write(f"# TYPE {name} summary\n")
+                    declared.add(name)
+                for q, value in zip(QUANTILES, quantiles):
+                    f.write(f"{name}{label_text(labels, [('quantile', str(q))])} {value:.6f}\n")
+                f.write(f"{name}_sum{label_text(labels)} {total:.6f}\n")
+                f.write(f"{name}_count{label_text(labels)} {count}\n")
+            else:
+                name = metric_name(name) + "_total"
+                if name not in declared:
+                    f.write(f"# TYPE {name} counter\n")
+                    declared.add(name)
+                f.write(f"{name}{label_text(labels)} {total}\n")
+
+    def _write_csv(self, f):
+        writer = csv.writer(f)
+        writer.writerow(["type", "name", "labels", "count", "sum"] + [f"p{int(q * 100)}" for q in QUANTILES] + ["max"])
+        for kind, name, labels, count, total, quantiles, maximum in self.rows():
+            writer.writerow([kind, name, ";".join(f"{key}={value}" for key, value in labels), count, total] + (quantiles or [None] * len(QUANTILES)) + [maximum])
+
+    # Write a file atomically (a textfile collector must never read a half-written file)
+    @staticmethod
+    def _write_file(path, write):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+            write(f)
+        os.replace(tmp_path, path)
+
+    # Write the metrics file and the trace (if enabled) and print where the time went
+    def write(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.metrics_file:
+                write = self._write_csv if self.metrics_file.endswith('.csv') else self._write_prometheus
+                self._write_file(self.metrics_file, write)
+            if self.trace_file:
+                self._write_file(self.trace_file, lambda f: json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f, ensure_ascii=False))
+        self.report()
+
+    # Timings by total time, and counters
+    def report(self):
+        rows = self.rows()
+        for kind, name, labels, count, total, quantiles, _ in sorted(rows, key=lambda row: (row[0] != "timing", -row[4])):
+            label_text = ", ".join(f"{key}={value}" for key, value in labels)
+            if kind == "timing":
+                print(f"{name} [{label_text}]: {count} x, total {total:.2f} s, p50 {quantiles[0] * 1000:.1f} ms, p99 {quantiles[-1] * 1000:.1f} ms")
+            else:
+                print(f"{name} [{label_text}]: {total}")
+
+# Shared by every module of a run
+metrics = Metrics()
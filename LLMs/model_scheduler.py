@@ -0,0 +1,172 @@
+import os
+import gc
+import time
+import weakref
+import threading
+import torch
+
+# Weight and config files read ahead of loading (the sharded safetensors that from_pretrained uses, not the duplicate
+# consolidated checkpoints some repositories also ship)
+PREFETCH_PATTERNS = ["*.json", "model*.safetensors", "*.model", "*.py", "*.txt"]
+PREFETCH_BLOCK_SIZE = 64 * 1024 * 1024
+
+# Host memory currently available to the page cache, in bytes (None if unknown)
+def available_host_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# Peak resident set size of this process since the last reset, in bytes
+def peak_host_memory():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def reset_peak_memory():
+    # Linux only: resets VmHWM to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    if torch.cuda.is_available():
+        for device in range(torch.cuda.device_count()):
+            torch.cuda.reset_peak_memory_stats(device)
+
+def peak_device_memory():
+    if not torch.cuda.is_available():
+        return 0
+    return sum(torch.cuda.max_memory_allocated(device) for device in range(torch.cuda.device_count()))
+
+# Free everything that is no longer referenced: Python objects first, then the cached CUDA blocks
+def release_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.empty_cache()
+        torch.cuda.ipc_collect()
+
+# Read the weight files of a model from cache_dir (downloading them if needed) so that they sit in the page cache
+# when from_pretrained loads them. Skipped when the files would not fit in the available host memory.
+def prefetch_weights(model_id, cache_dir):
+    from huggingface_hub import snapshot_download
+    snapshot = snapshot_download(model_id, cache_dir=cache_dir, allow_patterns=PREFETCH_PATTERNS)
+    paths = [os.path.join(root, name) for root, _, names in os.walk(snapshot) for name in names]
+    total = sum(os.path.getsize(path) for path in paths)
+
+    available = available_host_memory()
+    if available is not None and total > available:
+        print(f"Prefetch of {model_id} skipped: {total / 2**30:.1f} GiB of weights, {available / 2**30:.1f} GiB available")
+        return 0
+
+    for path in paths:
+        with open(path, 'rb') as f:
+            while f.read(PREFETCH_BLOCK_SIZE):
+                pass
+    return total
+
+# Runs the models of a sweep one after another.
+# While a model generates, the next model's weights are prefetched into host memory on a background thread; when the
+# caller moves on, the finished model is torn down (gc + empty_cache) before the next one is loaded, and the load
+# time, generation time and peak host/device memory of every model are recorded.
+#
+#     scheduler = ModelScheduler(model_ids, load_model, cache_dir)
+#     for model_id, model, tokenizer in scheduler:
+#         ...
+#         del model, tokenizer  # and anything else holding the model
+#     scheduler.report()
+class ModelScheduler:
+    def __init__(self, model_ids, load_model, cache_dir=None, prefetch=True):
+        self.model_ids = list(model_ids)
+        self.load_model = load_model
+        self.cache_dir = cache_dir
+        self.prefetch = prefetch
+        self.stats = []
+        self._prefetches = {}
+
+    def _start_prefetch(self, model_id):
+        if not self.prefetch or model_id in self._prefetches:
+            return
+        result = {"bytes": 0, "seconds": 0.0, "error": None}
+
+        def run():
+            start = time.perf_counter()
+            try:
+                result["bytes"] = prefetch_weights(model_id, self.cache_dir)
+            except Exception as e:
+                result["error"] = str(e)
+            result["seconds"] = time.perf_counter() - start
+
+        thread = threading.Thread(target=run, name=f"prefetch-{model_id}", daemon=True)
+        thread.start()
+        self._prefetches[model_id] = (thread, result)
+
+    # Wait for the prefetch of a model (if any) and return its result
+    def _finish_prefetch(self, model_id):
+        if model_id not in self._prefetches:
+            return None
+        thread, result = self._prefetches.pop(model_id)
+        wait_start = time.perf_counter()
+        thread.join()
+        result["wait_seconds"] = time.perf_counter() - wait_start
+        if result["error"] is not None:
+            print(f"Prefetch of {model_id} failed, loading without it: {result['error']}")
+        return result
+
+    def __iter__(self):
+        if self.model_ids:
+            self._start_prefetch(self.model_ids[0])
+
+        for index, model_id in enumerate(self.model_ids):
+            prefetch = self._finish_prefetch(model_id)
+
+            release_memory()
+            reset_peak_memory()
+            load_start = time.perf_counter()
+            model, tokenizer = self.load_model(model_id)
+            load_seconds = time.perf_counter() - load_start
+            model_ref = weakref.ref(model)
+
+            # Read the next model's weights while this one generates
+            if index + 1 < len(self.model_ids):
+                self._start_prefetch(self.model_ids[index + 1])
+
+            generation_start = time.perf_counter()
+            yield model_id, model, tokenizer
+            generation_seconds = time.perf_counter() - generation_start
+
+            # Tear the model down before the next one is loaded
+            del model, tokenizer
+            stats = {
+                "model_id": model_id,
+                "load_seconds": load_seconds,
+                "generation_seconds": generation_seconds,
+                "prefetch_seconds": prefetch["seconds"] if prefetch else None,
+                "prefetch_wait_seconds": prefetch["wait_seconds"] if prefetch else None,
+                "peak_host_bytes": peak_host_memory(),
+                "peak_device_bytes": peak_device_memory(),
+            }
+            release_memory()
+            stats["released"] = model_ref() is None
+            if not stats["released"]:
+                print(f"Warning: {model_id} is still referenced after generation and could not be freed")
+            self.stats.append(stats)
+
+    # Per-model timings and peak memory of the sweep
+    def report(self):
+        total = sum(stats["load_seconds"] + stats["generation_seconds"] + (stats["prefetch_wait_seconds"] or 0.0) for stats in self.stats)
+        generation = sum(stats["generation_seconds"] for stats in self.stats)
+        for stats in self.stats:
+            prefetch = "-" if stats["prefetch_seconds"] is None else f"{stats['prefetch_seconds']:.1f} s (waited {stats['prefetch_wait_seconds']:.1f} s)"
+            print(f"{stats['model_id']}: load {stats['load_seconds']:.1f} s, generation {stats['generation_seconds']:.1f} s, "
+                  f"prefetch {prefetch}, peak host {stats['peak_host_bytes'] / 2**30:.2f} GiB, "
+                  f"peak device {stats['peak_device_bytes'] / 2**30:.2f} GiB, freed: {stats['released']}")
+        if total:
+            print(f"Sweep: {total:.1f} s, of which generation {generation:.1f} s ({generation / total:.1%})")
@@ -1,9 +1,18 @@
 import os
 import json
 import transformers
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, LogitsProcessorList
 import torch
 from tqdm import tqdm
+from checkpoint import CheckpointStore
+from prefix_cache import PrefixCache, common_prefix_length
+from model_scheduler import ModelScheduler
+from prompt_corpus import LANGUAGES, open_prompt_corpus, add_identified_emotions
+from koed_dataset import conv_id_shard
+from metrics import metrics, with_suffix
+from label_decoding import SCENARIO_LABEL_LIMITS, LabelTrie, LabelLogitsProcessor, eos_token_ids
+from assisted_decoding import DRAFT_MODELS, AssistedDecoder
+from token_cache import open_token_cache
 
 
 
@@ -15,19 +24,255 @@ model_ids = [
     "mistralai/Mistral-7B-Instruct-v0.3"
 ]
 
-# Load dialogue data from the JSON file
+MAX_NEW_TOKENS = 256
+
+# Batched generation: pending prompts are bucketed by tokenized length and generated in padded batches
+BATCHED_GENERATION = True
+BATCH_SIZE = 8
+# Number of dialogues generated (both steps) between two checkpoints in batched mode
+DIALOGUES_PER_CHUNK = 64
+
+# Hugging Face cache holding the model weights
+MODEL_CACHE_DIR = "/data"
+# Read the next model's weights into host memory on a background thread while the current model generates
+PREFETCH_NEXT_MODEL = True
+
+# Prefill the shared system prompt of each scenario and language once per model and reuse its past-key-values
+PREFIX_CACHE = True
+
+# Step 1 answers with labels of the 34-emotion list only (one for the single scenario, up to four for the multi
+# scenario) through label-constrained decoding (see label_decoding.py); the labels are stored as parsed in
+# identified_emotions["labels"]. Off: free-form step-1 answers, searched for labels by postprocessing.py.
+CONSTRAINED_IDENTIFICATION = False
+
+# Step 2 with assisted (speculative) generation: the draft model of DRAFT_MODELS (see assisted_decoding.py) proposes
+# tokens that the target model verifies. Assisted generation handles one chat at a time without the prefix cache;
+# models without a draft decode as usual, and so do models whose draft has another vocabulary size (dropped by
+# AssistedDecoder). Outputs only match plain decoding under greedy decoding: the models' generation configs sample, so
+# assisted responses follow the same distribution without being the same text.
+ASSISTED_GENERATION = False
+
+# Take the token ids of the step-1 chats from the persistent token cache of the prompt corpus (see token_cache.py),
+# built once per tokenizer, instead of tokenizing them on every run
+TOKEN_CACHE = True
+
+# Per-call metrics (Prometheus textfile, or CSV for a .csv path) and Chrome-trace JSON of the run; None disables them.
+# Shard workers write their own files (suffixed like their results files).
+METRICS_FILE = None
+TRACE_FILE = None
+
+# Prompts of every dialogue, rendered once from the data file (see prompt_corpus.py)
 current_dir = os.path.dirname(os.path.abspath(__file__))
 data_file_path = os.path.join(current_dir, '..', 'data', 'KoED_sample_100.json')
-with open(data_file_path, 'r', encoding='utf-8') as f:
-    dialogues_data = json.load(f)
+prompt_corpus = open_prompt_corpus(data_file_path)
+
+
+# Chat of a scenario record of the prompt corpus
+def build_chat(scenario):
+    system_prompt, user_prompt = prompt_corpus.prompts(scenario)
+    return [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
+
+# Extend a step-1 chat into the step-2 chat with the emotions identified in step 1
+def add_step_two(scenario_name, chat, identified_emotions, lang):
+    if identified_emotions:
+        chat[1]["content"] = add_identified_emotions(scenario_name, chat[1]["content"], identified_emotions['content'], lang)
+
+# Label tries per tokenizer (name and vocabulary size)
+label_tries = {}
+
+def get_label_trie(tokenizer):
+    key = (tokenizer.name_or_path, len(tokenizer))
+    if key not in label_tries:
+        label_tries[key] = LabelTrie(tokenizer)
+    return label_tries[key]
+
+# Generate the assistant message for a single chat with the text generation pipeline
+# (label-constrained answers and prefix-cached generation go through generate_batched)
+def generate(text_generation_pipeline, chat, prefix_cache=None, label_limit=None, assistant=None, encoded=None):
+    if prefix_cache is not None or label_limit is not None or assistant is not None:
+        return generate_batched(text_generation_pipeline.model, text_generation_pipeline.tokenizer, [chat], 1, prefix_cache, label_limit, assistant, [encoded])[0]
+
+    with metrics.span("generate", mode="pipeline"):
+        output = text_generation_pipeline(
+            chat,
+            max_new_tokens=MAX_NEW_TOKENS,
+        )
+    return output[0]['generated_text'][-1]
+
+# Generate the assistant messages for many chats in padded batches.
+# Chats are grouped by system message and sorted by tokenized length so that each batch holds prompts of similar
+# length (little padding); the generated text is decoded the same way the text generation pipeline does it.
+# With a prefix cache, the shared system prompt is not prefilled again: the batch reuses its cached past-key-values
+# and the padding goes between the prefix and the per-dialogue suffix.
+# With a label limit, the answers are restricted to that many emotion labels and returned with their parsed "labels".
+# With an assistant (AssistedDecoder), every chat is generated on its own with the draft model.
+# Chats whose token ids are given in `encoded` (from the token cache) are not tokenized again.
+def generate_batched(model, tokenizer, chats, batch_size=BATCH_SIZE, prefix_cache=None, label_limit=None, assistant=None, encoded=None):
+    if assistant is not None:
+        batch_size, prefix_cache = 1, None
+    with metrics.span("prompt_build"):
+        encoded = [
+            ids if ids is not None else tokenizer.apply_chat_template(chat, add_generation_prompt=True)
+            for chat, ids in zip(chats, encoded or [None] * len(chats))
+        ]
+    order = sorted(range(len(chats)), key=lambda i: (chats[i][0]["content"], len(encoded[i])))
+    outputs = [None] * len(chats)
+
+    buckets = []
+    for i in order:
+        if buckets and len(buckets[-1]) < batch_size and chats[buckets[-1][0]][0]["content"] == chats[i][0]["content"]:
+            buckets[-1].append(i)
+        else:
+            buckets.append([i])
+
+    for bucket in buckets:
+        prefix_length = 0
+        if prefix_cache is not None:
+            prefix_ids, past = prefix_cache.lookup(chats[bucket[0]][0])
+            # At least one token of every prompt is left to prefill
+            prefix_length = min(min(common_prefix_length(encoded[i], prefix_ids), len(encoded[i]) - 1) for i in bucket)
+            prefix_ids = prefix_ids[:prefix_length]
+
+        if prefix_length > 0:
+            suffix_width = max(len(encoded[i]) - prefix_length for i in bucket)
+            input_ids, attention_mask = [], []
+            for i in bucket:
+                padding = suffix_width - (len(encoded[i]) - prefix_length)
+                input_ids.append(prefix_ids + [tokenizer.pad_token_id] * padding + encoded[i][prefix_length:])
+                attention_mask.append([1] * prefix_length + [0] * padding + [1] * (len(encoded[i]) - prefix_length))
+            batch = {
+                "input_ids": torch.tensor(input_ids, device=model.device),
+                "attention_mask": torch.tensor(attention_mask, device=model.device),
+                "past_key_values": prefix_cache.expand(past, len(bucket), prefix_length),
+            }
+            prefix_cache.prefill_tokens_saved += prefix_length * len(bucket)
+            metrics.count("prefix_cache_tokens_saved", prefix_length * len(bucket))
+        else:
+            batch = tokenizer.pad({"input_ids": [encoded[i] for i in bucket]}, padding=True, return_tensors="pt").to(model.device)
+        if prefix_cache is not None:
+            metrics.count("prefix_cache", 1, result="hit" if prefix_length > 0 else "miss")
+
+        prompt_width = batch["input_ids"].shape[1]
+        generation_kwargs = {"max_new_tokens": MAX_NEW_TOKENS}
+        if label_limit is not None:
+            label_trie = get_label_trie(tokenizer)
+            label_processor = LabelLogitsProcessor(label_trie, label_limit, prompt_width, eos_token_ids(model, tokenizer))
+            generation_kwargs = {
+                "max_new_tokens": min(MAX_NEW_TOKENS, label_trie.max_new_tokens(label_limit)),
+                "logits_processor": LogitsProcessorList([label_processor]),
+                "eos_token_id": label_processor.eos_token_ids,
+            }
+
+        if assistant is not None:
+            with metrics.span("generate", mode="assisted"), torch.no_grad():
+                generated = assistant.generate(**batch, pad_token_id=tokenizer.pad_token_id, **generation_kwargs)
+        else:
+            with metrics.span("generate", mode="batched" if label_limit is None else "labels"), torch.no_grad():
+                generated = model.generate(
+                    **batch,
+                    pad_token_id=tokenizer.pad_token_id,
+                    **generation_kwargs,
+                )
+
+        metrics.count("tokens", sum(len(encoded[i]) for i in bucket), api="local", kind="input_tokens")
+        metrics.count("tokens", prompt_width * len(bucket) - sum(len(encoded[i]) for i in bucket), api="local", kind="padding_tokens")
+        for row, i in enumerate(bucket):
+            new_tokens = generated[row, prompt_width:].tolist()
+            metrics.count("tokens", sum(1 for token in new_tokens if token != tokenizer.pad_token_id), api="local", kind="output_tokens")
+            if label_limit is not None:
+                labels = label_processor.labels(new_tokens)
+                outputs[i] = {"role": "assistant", "content": label_trie.separator.join(labels), "labels": labels}
+                continue
+            prompt_text = tokenizer.decode(encoded[i], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+            full_text = tokenizer.decode(encoded[i] + new_tokens, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+            outputs[i] = {"role": "assistant", "content": full_text[len(prompt_text):]}
+
+    return outputs
+
+# Process the scenarios of one dialogue chat by chat
+def process_dialogue(text_generation_pipeline, record, lang, prefix_cache=None, assistant=None, token_cache=None):
+    # Initialize a dictionary to store dialogue results
+    dialogue_results = {
+        "conv_id": record["conv_id"],
+        "dialogue": record["dialogue"],
+        "scenarios": []
+    }
+
+    # Process each scenario
+    for scenario_name, scenario in [(scenario["scenario"], build_chat(scenario)) for scenario in record["scenarios"]]:
+        encoded = token_cache.token_ids(lang, record["conv_id"], scenario_name) if token_cache is not None else None
 
+        # Step 1: Identify emotions using the model
+        if scenario_name in ["34개의 단일 감정", "34개의 멀티 감정"]:
+            label_limit = SCENARIO_LABEL_LIMITS[scenario_name] if CONSTRAINED_IDENTIFICATION else None
+            identified_emotions = generate(text_generation_pipeline, scenario, prefix_cache, label_limit, encoded=encoded)
+        else:
+            identified_emotions = None
 
-# Iterate through each model
-for model_id in model_ids:
+        # Step 2: Generate empathetic response based on identified emotions (the step-1 chat if nothing was identified)
+        add_step_two(scenario_name, scenario, identified_emotions, lang)
+        empathetic_response = generate(text_generation_pipeline, scenario, prefix_cache, assistant=assistant,
+                                       encoded=encoded if not identified_emotions else None)
 
+        # Append scenario results to dialogue results
+        dialogue_results["scenarios"].append({
+            "scenario": scenario_name,
+            "identified_emotions": identified_emotions,
+            "empathetic_response": f"Listener: {empathetic_response}"
+        })
+
+    return dialogue_results
+
+# Process the scenarios of many dialogues at once: all step-1 chats are generated in batches,
+# then the step-2 chats built from their results are batched the same way
+def process_dialogues_batched(model, tokenizer, records, lang, prefix_cache=None, assistant=None, token_cache=None):
+    pending = []  # (dialogue index, scenario name, chat)
+    for dialogue_index, record in enumerate(records):
+        for scenario in record["scenarios"]:
+            pending.append((dialogue_index, scenario["scenario"], build_chat(scenario)))
+    encoded = [
+        token_cache.token_ids(lang, records[dialogue_index]["conv_id"], scenario_name) if token_cache is not None else None
+        for dialogue_index, scenario_name, _ in pending
+    ]
+
+    # Step 1: Identify emotions for every scenario of every dialogue
+    step_one = [i for i, (_, scenario_name, _) in enumerate(pending) if scenario_name in ["34개의 단일 감정", "34개의 멀티 감정"]]
+    identified = [None] * len(pending)
+    if CONSTRAINED_IDENTIFICATION:
+        # One constrained run per scenario, as the number of labels differs
+        for scenario_name, label_limit in SCENARIO_LABEL_LIMITS.items():
+            indices = [i for i in step_one if pending[i][1] == scenario_name]
+            for i, output in zip(indices, generate_batched(model, tokenizer, [pending[i][2] for i in indices], prefix_cache=prefix_cache, label_limit=label_limit, encoded=[encoded[i] for i in indices])):
+                identified[i] = output
+    else:
+        for i, output in zip(step_one, generate_batched(model, tokenizer, [pending[i][2] for i in step_one], prefix_cache=prefix_cache, encoded=[encoded[i] for i in step_one])):
+            identified[i] = output
+
+    # Step 2: Generate empathetic responses based on identified emotions
+    for (_, scenario_name, scenario), identified_emotions in zip(pending, identified):
+        add_step_two(scenario_name, scenario, identified_emotions, lang)
+    # (chats without a step 1 are still the cached step-1 chats)
+    responses = generate_batched(model, tokenizer, [scenario for _, _, scenario in pending], prefix_cache=prefix_cache, assistant=assistant,
+                                 encoded=[ids if not identified_emotions else None for ids, identified_emotions in zip(encoded, identified)])
+
+    results = [
+        {"conv_id": record["conv_id"], "dialogue": record["dialogue"], "scenarios": []}
+        for record in records
+    ]
+    for (dialogue_index, scenario_name, _), identified_emotions, empathetic_response in zip(pending, identified, responses):
+        results[dialogue_index]["scenarios"].append({
+            "scenario": scenario_name,
+            "identified_emotions": identified_emotions,
+            "empathetic_response": f"Listener: {empathetic_response}"
+        })
+
+    return results
+
+# Load the 4-bit model and its tokenizer
+def load_model(model_id):
     # Set up quantization configuration for 4-bit loading
     quantization_config = BitsAndBytesConfig(
-        load_in_4bit=True, 
+        load_in_4bit=True,
     )
 
     # Load the model and tokenizer for the current model ID
@@ -35,151 +280,155 @@ for model_id in model_ids:
         model_id,
         torch_dtype=torch.bfloat16,
         quantization_config=quantization_config,
-        cache_dir="/data",
+        cache_dir=MODEL_CACHE_DIR,
         device_map="auto",
-        trust_remote_code=True  
+        trust_remote_code=True
     )
-    
-    tokenizer = AutoTokenizer.from_pretrained(model_id, cache_dir="/data")
-    
-    # Create a text generation pipeline for each model
-    text_generation_pipeline = transformers.pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
+
+    tokenizer = AutoTokenizer.from_pretrained(model_id, cache_dir=MODEL_CACHE_DIR)
+
+    # Batched and prefix-cached generation pad on the left so that new tokens follow every prompt directly
+    if BATCHED_GENERATION or PREFIX_CACHE:
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
+    return model, tokenizer
+
+# Load the draft model of a target model (small enough to stay unquantized, next to the target on its device)
+def load_draft_model(draft_id, model):
+    draft_model = AutoModelForCausalLM.from_pretrained(
+        draft_id,
+        torch_dtype=torch.bfloat16,
+        cache_dir=MODEL_CACHE_DIR,
     )
+    return draft_model.to(model.device)
+
+# Results file of a model and language; a worker of a sharded run (shard = (index, number of shards)) writes its own file
+def get_output_file(model_name, lang, shard=None):
+    file_name = f'results_{model_name}_{lang}.json' if shard is None else f'results_{model_name}_{lang}.shard{shard[0]}of{shard[1]}.json'
+    return os.path.join(current_dir, '..', 'output', 'eval_results', 'sample', file_name)
+
+# conv_ids already in the merged results file (read only, shard workers never write it)
+def load_completed(output_file):
+    if not os.path.exists(output_file):
+        return set()
+    with open(output_file, 'r', encoding='utf-8') as f:
+        return set(json.load(f))
 
-   
-    # Generate empathetic dialogues in (KoED & ED)
-    for lang, lang_key in [("Korean", "ko_utter"), ("English", "utter")]:
+# Merge the per-shard results of a sharded run (all shards, or the given shard indices) into the usual results files,
+# in dataset order
+def merge_shard_results(num_shards, shards=None):
+    shards = range(num_shards) if shards is None else shards
+    for model_id in model_ids:
         model_name = model_id.split("/")[-1]
-        output_file = os.path.join(current_dir, '..', 'output', 'eval_results', 'sample', f'results_{model_name}_{lang}.json')
+        for lang, _ in LANGUAGES:
+            shard_files = [get_output_file(model_name, lang, (index, num_shards)) for index in shards]
+            shard_files = [path for path in shard_files if os.path.exists(path) or os.path.exists(os.path.splitext(path)[0] + '.jsonl')]
+            if not shard_files:
+                continue
 
-        # Load existing results if available
-        try:
-            with open(output_file, 'r', encoding='utf-8') as f:
-                outputs_summary = json.load(f)
-        except FileNotFoundError:
-            outputs_summary = {}
+            output_file = get_output_file(model_name, lang)
+            outputs_summary = CheckpointStore(output_file)
+            for path in shard_files:
+                shard_summary = CheckpointStore(path)
+                for conv_id, dialogue_results in shard_summary.data.items():
+                    if not outputs_summary.has(conv_id):
+                        outputs_summary.add(dialogue_results, conv_id)
+                shard_summary.close(compact=False)
+            outputs_summary.compact(order=prompt_corpus.conv_ids)
+            outputs_summary.close(compact=False)
 
-        # Define the common task instruction for the model to follow
-        common_task_definition = f"""Task Definition: This is a/an {lang.lower()} empathetic dialogue task: The first worker (Speaker) is given an emotion label and writes his own description of a situation when he has felt that way. Then, Speaker tells his story in a conversation with a second worker (Listener). The emotion label and situation of Speaker are invisible to Listener. Listener should recognize and acknowledge others' feelings in a conversation as much as possible. Guideline Instruction: Now you play the role of Listener, please give the corresponding response according to the existing context. You only need to provide the next round of response of Listener."""
+            # The merged file is on disk, so the shard files are no longer needed
+            for path in shard_files:
+                for shard_path in [path, os.path.splitext(path)[0] + '.jsonl']:
+                    if os.path.exists(shard_path):
+                        os.remove(shard_path)
+            print(f"Merged {len(shard_files)} shards into {output_file}.")
 
-        # Process each dialogue in the JSON file (using tqdm for progress tracking)
-        for index, dialogue_data in enumerate(tqdm(dialogues_data, desc=f"Processing {lang} Dialogues for {model_name}")):
-            conv_id = dialogue_data['conv_id']
+# Generate the results of every model; with a shard, only the dialogues whose conv_id hashes to it (see launch_shards.py)
+# on_result(model_id, lang, dialogue_results) is called after every dialogue is checkpointed; a caller passing it
+# (streaming.py) owns the metrics of the run
+def main(shard=None, on_result=None):
+    shard_suffix = f"shard{shard[0]}of{shard[1]}" if shard is not None else None
+    if on_result is None:
+        metrics.enable(with_suffix(METRICS_FILE, shard_suffix), with_suffix(TRACE_FILE, shard_suffix))
 
-            # Skip previously processed dialogues or specific ones (re-experiment parts)
-            if conv_id in outputs_summary:
-                continue
+    # Iterate through each model; the scheduler loads them one at a time and frees each one before the next
+    scheduler = ModelScheduler(model_ids, metrics.timed("model_load", load_model), MODEL_CACHE_DIR, prefetch=PREFETCH_NEXT_MODEL)
+    for model_id, model, tokenizer in scheduler:
+
+        # Create a text generation pipeline for each model
+        text_generation_pipeline = transformers.pipeline(
+            "text-generation",
+            model=model,
+            tokenizer=tokenizer,
+        )
+        prefix_cache = PrefixCache(model, tokenizer) if PREFIX_CACHE else None
+        token_cache = open_token_cache(prompt_corpus, model_id, tokenizer) if TOKEN_CACHE else None
+
+        # Draft model for assisted step-2 generation, if the model has one
+        assistant = None
+        if ASSISTED_GENERATION:
+            draft_id = DRAFT_MODELS.get(model_id)
+            if draft_id is None:
+                print(f"No draft model for {model_id}; decoding without assistance.")
+            else:
+                assistant = AssistedDecoder(model, load_draft_model(draft_id, model))
 
-            # Initialize the dialogue text with alternating turns between Speaker and Listener
-            dialogue_text = ""
-            speaker_turn = True 
-
-            for utterance in dialogue_data['dialogue']:
-                if lang_key in utterance and utterance[lang_key]:  
-                    if speaker_turn:
-                        dialogue_text += f"Speaker: {utterance[lang_key]}\n"
-                    else:
-                        dialogue_text += f"Listener: {utterance[lang_key]}\n"
-                    speaker_turn = not speaker_turn  
-
-            # Count the number of utterances
-            num_utterances = dialogue_text.count('\n')
-
-            # If even number of utterances, remove the last one for balance
-            if num_utterances % 2 == 0:
-                dialogue_text = '\n'.join(dialogue_text.split('\n')[:-2]) + '\n'
-
-            multi_turn_dialogue = f"\n    Multi-Turn Dialogue:\n        {dialogue_text}"
-
-            ## Scenario generation
-            scenarios = [
-                ("34개의 단일 감정", [ # 34-Single
-                    {"role": "system", "content": common_task_definition + """
-                        List of 34 Emotions:
-                            Afraid (두려움), Angry (화남), Annoyed (짜증남), Anticipating (기대됨), Anxious (불안함), Apprehensive (염려됨), Ashamed (부끄러움), Caring (보살핌), Confident (자신감), Content (만족함), Devastated (충격받음), Disappointed (실망함), Disgusted (역겨움), Embarrassed (당황함), Excited (흥분됨), Faithful (충실함), Furious (격노함), Grateful (감사함), Guilty (죄책감), Hopeful (희망적), Impressed (감명받음), Jealous (질투남), Joyful (기쁨), Lonely (외로움), Nostalgic (향수에 젖음), Prepared (준비됨), Proud (자랑스러움), Sad (슬픔), Sentimental (감상적), Surprised (놀람), Terrified (겁에 질림), Trusting (신뢰함), 정 (a feeling that arises in one's heart, or a feeling of love or affinity), 한 (a feeling of bitter resentment, injustice, pity, or sadness)
-
-                        Important Guidelines:
-                            - Do not use any emotion terms other than the 34 basic emotions listed above.
-                            - Combinations or mixtures of emotions are not allowed. Choose and use only one emotion.
-                            - Even for complex or subtle emotions, you must express them using only one of the 34 emotions that is closest in meaning."""},
-                    {"role": "user", "content": f"""
-                        {multi_turn_dialogue}
-
-                    Step-by-Step Instructions:
-                        1. Analyze the given dialogue to identify the Speaker's emotional state.
-                        2. Specify the identified emotion using only one of the 34 basic emotions listed above.
-                        (STOP HERE. Do NOT proceed to steps 3 and 4 yet. Only identify the emotion at this stage.)
-                    """},
-                ]),
-                ("34개의 멀티 감정", [ # 34-Multi
-                    {"role": "system", "content": common_task_definition + """
-                        List of 34 Emotions:
-                            Afraid (두려움), Angry (화남), Annoyed (짜증남), Anticipating (기대됨), Anxious (불안함), Apprehensive (염려됨), Ashamed (부끄러움), Caring (보살핌), Confident (자신감), Content (만족함), Devastated (충격받음), Disappointed (실망함), Disgusted (역겨움), Embarrassed (당황함), Excited (흥분됨), Faithful (충실함), Furious (격노함), Grateful (감사함), Guilty (죄책감), Hopeful (희망적), Impressed (감명받음), Jealous (질투남), Joyful (기쁨), Lonely (외로움), Nostalgic (향수에 젖음), Prepared (준비됨), Proud (자랑스러움), Sad (슬픔), Sentimental (감상적), Surprised (놀람), Terrified (겁에 질림), Trusting (신뢰함), 정 (a feeling that arises in one's heart, or a feeling of love or affinity), 한 (a feeling of bitter resentment, injustice, pity, or sadness)
-
-                        Important Guidelines:
-                            - Combinations or mixtures of emotions are allowed.
-                            - Select up to 4 emotions that best describe the Speaker's emotional state."""},
-                    {"role": "user", "content": f"""
-                        {multi_turn_dialogue}
-
-                    Step-by-Step Instructions:
-                        1. Analyze the given dialogue to identify the Speaker's complex emotional state.
-                        2. Specify the identified emotions using multiple labels from the 34 emotions listed above. Select all that apply, with no minimum or maximum limit.
-                        (STOP HERE. Do NOT proceed to steps 3 and 4 yet. Only identify the emotion at this stage.)
-                    """},
-                ]),
+        # Generate empathetic dialogues in (KoED & ED)
+        for lang, _ in LANGUAGES:
+            model_name = model_id.split("/")[-1]
+            output_file = get_output_file(model_name, lang, shard)
+
+            # Load existing results and the checkpoint log if available
+            outputs_summary = CheckpointStore(output_file)
+            completed = load_completed(get_output_file(model_name, lang)) if shard is not None else set()
+
+            # Skip previously processed dialogues or specific ones (re-experiment parts), and other shards' dialogues
+            pending = [
+                record for record in prompt_corpus.records(lang)
+                if (shard is None or conv_id_shard(record["conv_id"], shard[1]) == shard[0])
+                and not outputs_summary.has(record["conv_id"]) and record["conv_id"] not in completed
             ]
 
-            # Initialize a dictionary to store dialogue results
-            dialogue_results = {
-                "conv_id": conv_id,
-                "dialogue": dialogue_text,
-                "scenarios": []
-            }
+            if BATCHED_GENERATION:
+                progress = tqdm(total=len(pending), desc=f"Processing {lang} Dialogues for {model_name}")
+                for start in range(0, len(pending), DIALOGUES_PER_CHUNK):
+                    chunk = pending[start:start + DIALOGUES_PER_CHUNK]
+                    for dialogue_results in process_dialogues_batched(model, tokenizer, chunk, lang, prefix_cache, assistant, token_cache):
+                        outputs_summary.add(dialogue_results, dialogue_results['conv_id'])
+                        if on_result is not None:
+                            on_result(model_id, lang, dialogue_results)
+                    progress.update(len(chunk))
+                progress.close()
+            else:
+                # Process each dialogue in the JSON file (using tqdm for progress tracking)
+                for record in tqdm(pending, desc=f"Processing {lang} Dialogues for {model_name}"):
+                    dialogue_results = process_dialogue(text_generation_pipeline, record, lang, prefix_cache, assistant, token_cache)
 
-            scenario_next_steps = {
-                "34개의 단일 감정" : 3,
-                "34개의 멀티 감정": 3
-            }
+                    # Append the current dialogue results to the checkpoint log to avoid data loss
+                    outputs_summary.add(dialogue_results, dialogue_results['conv_id'])
+                    if on_result is not None:
+                        on_result(model_id, lang, dialogue_results)
 
-            # Process each scenario
-            for scenario_name, scenario in scenarios:
-                # Step 1: Identify emotions using the model
-                if scenario_name in ["34개의 단일 감정", "34개의 멀티 감정"]:
-                    emotion_output = text_generation_pipeline(
-                        scenario,
-                        max_new_tokens=256,
-                    )
-                    identified_emotions = emotion_output[0]['generated_text'][-1]
-                else:
-                    identified_emotions = None
-                
-                # Step 2: Generate empathetic response based on identified emotions
-                if identified_emotions:
-                    scenario[1]["content"] += f"\n\nIdentified Emotions: {identified_emotions}\n\n{scenario_next_steps[scenario_name]}. Generate the next {lang} empathetic response based on the identified emotions."
-
-                empathetic_response_output = text_generation_pipeline(
-                    scenario,
-                    max_new_tokens=256,
-                )
-                empathetic_response = empathetic_response_output[0]['generated_text'][-1]
-                
-                # Append scenario results to dialogue results
-                dialogue_results["scenarios"].append({
-                    "scenario": scenario_name,
-                    "identified_emotions": identified_emotions,
-                    "empathetic_response": f"Listener: {empathetic_response}"
-                })
-
-            # Add the current dialogue results to the summary
-            outputs_summary[conv_id] = dialogue_results
-
-            # Save the results immediately to avoid data loss
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(outputs_summary, f, ensure_ascii=False, indent=4)
-
-        # Notify the user of successful save
-        print(f"Results saved to {output_file} successfully.")
+            # Rewrite the results file from the checkpoint log
+            outputs_summary.compact(order=prompt_corpus.conv_ids)
+            outputs_summary.close(compact=False)
+
+            # Notify the user of successful save
+            print(f"Results saved to {output_file} successfully.")
+
+        if assistant is not None:
+            assistant.report(model_id.split("/")[-1])
+            assistant.close()
+
+        # Drop every reference to the model so that the scheduler can free it
+        del text_generation_pipeline, prefix_cache, token_cache, assistant, model, tokenizer
+
+    scheduler.report()
+    if on_result is None:
+        metrics.write()
+
+if __name__ == "__main__":
+    main()
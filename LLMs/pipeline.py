@@ -0,0 +1,426 @@
+import os
+import sys
+import ast
+import json
+import asyncio
+import hashlib
+from checkpoint import CheckpointStore, read_results
+from prompt_corpus import LANGUAGES, open_prompt_corpus, add_identified_emotions, scenario_next_steps
+from rate_limiter import estimate_tokens
+from token_cache import find_token_cache
+import eval as judge
+
+# Postprocessing scripts of the experiment and evaluation results
+LLMS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.join(LLMS_DIR, '..')
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'output', 'experiment_results'))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'output', 'eval_results'))
+import postprocessing
+import eval_postprocessing
+from postprocess_runner import run_file_jobs
+
+# Incremental runner of the whole pipeline:
+#   generate (claude.py, open_source.py) -> postprocess (output/experiment_results/postprocessing.py)
+#   -> evaluate (eval.py) -> eval_postprocess (output/eval_results/eval_postprocessing.py)
+# Every (dataset record, model, language, scenario) unit has a content hash per stage:
+#   generate:    model, generation settings and the rendered step-1 prompts and step-2 template of the scenario
+#   postprocess: the generate hash and the label lists of postprocessing.py
+#   evaluate:    per criterion, the judge settings, the criterion's rubric and prompt template, and the dialogue and
+#                final empathetic statement being judged
+# The manifest keeps the hashes each unit's outputs were produced with. A unit is recomputed when its output is
+# missing or its hash changed (or, for evaluation, when it has failed scores); everything else is left alone, and an
+# evaluation survives a regeneration that produced the same statement. Stale units are removed from the results
+# files, and the stage scripts then fill in exactly the missing units as they do on resume.
+#
+#     python pipeline.py            dry run: stale units per stage and the API calls they would cost
+#     python pipeline.py run        recompute the stale units stage by stage
+#     python pipeline.py adopt      record the hashes of the existing outputs (first use on an existing tree)
+
+MANIFEST_FILE = os.path.join(PROJECT_ROOT, 'output', 'pipeline_manifest.json')
+DATA_FILE = judge.DATA_FILE
+EXPERIMENT_DIR = os.path.join(PROJECT_ROOT, 'output', 'experiment_results', 'sample')
+EVAL_DIR = os.path.join(PROJECT_ROOT, 'output', 'eval_results', judge.EVAL_OUTPUT_NAME)
+
+# Module-level settings of each generation script that change its outputs
+GENERATION_SETTINGS = {
+    "claude.py": ["CLAUDE_MODEL", "MAX_TOKENS"],
+    "open_source.py": ["MAX_NEW_TOKENS", "CONSTRAINED_IDENTIFICATION"],
+}
+
+# Scenario fields that only exist before postprocessing
+RAW_FIELDS = ["identified_emotions", "empathetic_response"]
+
+STAGES = ["generate", "postprocess", "evaluate"]
+
+def digest(*parts):
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+# Literal module-level assignments of a script, read without importing it (open_source.py imports torch)
+def script_constants(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            try:
+                constants[node.targets[0].id] = ast.literal_eval(node.value)
+            except (ValueError, TypeError, SyntaxError):
+                continue
+    return constants
+
+def experiment_file(model_name, lang):
+    return os.path.join(EXPERIMENT_DIR, f'results_{model_name}_{lang}.json')
+
+# Generation backends: script, model ids, settings, whether it calls an API, postprocessing step and the results file
+# of a model and language as the script writes it (open_source.py writes next to the evaluation results)
+def generation_backends():
+    backends = []
+    for script in GENERATION_SETTINGS:
+        constants = script_constants(os.path.join(LLMS_DIR, script))
+        settings = {name: constants.get(name) for name in GENERATION_SETTINGS[script]}
+        if script == "claude.py":
+            backends.append({"script": script, "models": [constants["CLAUDE_MODEL"]], "settings": settings, "api": True,
+                             "postprocess": postprocessing.claude_process_json, "output": experiment_file})
+        else:
+            backends.append({"script": script, "models": constants.get("model_ids", []), "settings": settings, "api": False,
+                             "postprocess": postprocessing.process_file,
+                             "output": lambda model_name, lang: os.path.join(PROJECT_ROOT, 'output', 'eval_results', 'sample', f'results_{model_name}_{lang}.json')})
+    return backends
+
+# Hash of what decides the extracted labels: the compiled label matcher of each emotion list (its pattern holds the
+# labels and every boundary rule) and the label order
+def postprocess_fingerprint():
+    matchers = [postprocessing.compile_emotion_matcher(emotion_list) for emotion_list in (postprocessing.thirty_four_emotions, postprocessing.seven_emotions)]
+    return digest([[matcher.pattern, labels] for matcher, labels in matchers])
+
+# Hash of the judge request of every criterion for a language (without the dialogue and statement)
+def criterion_fingerprints(language):
+    criteria_prompts = judge.build_criteria_prompts(language)
+    settings = [judge.JUDGE_MODEL, judge.MAX_TOKENS, judge.FUSED_JUDGE]
+    fused = judge.build_fused_prompts("{dialogue}", "{empathetic_response}", judge.CRITERIA, criteria_prompts) if judge.FUSED_JUDGE else None
+    return {
+        criterion: digest(settings, judge.COMMON_PROMPT + criteria_prompts[criterion], judge.build_user_prompt("{dialogue}", "{empathetic_response}", criterion), fused)
+        for criterion in judge.CRITERIA
+    }
+
+def evaluation_file(model_name, lang):
+    model_name, lang = judge.sanitize_filename(model_name), judge.sanitize_filename(lang)
+    return os.path.join(EVAL_DIR, model_name, lang, f"{model_name}_{lang}_evaluation.json")
+
+def unit_key(unit):
+    return "|".join([unit["model_name"], unit["lang"], unit["conv_id"], unit["scenario"]])
+
+def find_scenario(conv_data, scenario_name):
+    for scenario in (conv_data or {}).get("scenarios", []):
+        if scenario.get("scenario") == scenario_name:
+            return scenario
+    return None
+
+def load_manifest(path=MANIFEST_FILE):
+    manifest = {stage: {} for stage in STAGES}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest.update(json.load(f))
+    return manifest
+
+def save_manifest(manifest, path=MANIFEST_FILE):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+# Every unit with its hashes and the status of each stage ("done" or the reason it is stale)
+def build_plan(manifest):
+    corpus = open_prompt_corpus(DATA_FILE)
+    records = {lang: list(corpus.records(lang)) for lang, _ in LANGUAGES}
+    postprocess_hash = postprocess_fingerprint()
+    fingerprints = {lang: criterion_fingerprints(lang) for lang, _ in LANGUAGES}
+    criteria_prompts = {lang: judge.build_criteria_prompts(lang) for lang, _ in LANGUAGES}
+    # Exact step-1 prompt lengths of the local models that have a token cache of the corpus
+    token_caches = {}
+    units = []
+
+    for backend in generation_backends():
+        for model_id in backend["models"]:
+            model_name = model_id.split("/")[-1]
+            if not backend["api"]:
+                token_caches[model_id] = find_token_cache(corpus, model_id)
+            for lang, lang_key in LANGUAGES:
+                results = read_results(experiment_file(model_name, lang))
+                generated = read_results(backend["output"](model_name, lang)) if backend["output"] is not experiment_file else results
+                evaluated = model_name in judge.EVAL_MODELS and lang in judge.EVAL_LANGUAGES
+                evaluations = read_results(evaluation_file(model_name, lang)) if evaluated else {}
+
+                for record in records[lang]:
+                    conv_id = record["conv_id"]
+                    conv_data = results.get(conv_id) or generated.get(conv_id)
+                    for scenario in record["scenarios"]:
+                        scenario_name = scenario["scenario"]
+                        system_prompt, user_prompt = corpus.prompts(scenario)
+                        step_two = add_identified_emotions(scenario_name, "", "{identified_emotions}", lang) if scenario_name in scenario_next_steps else None
+                        unit = {
+                            "backend": backend, "model_id": model_id, "model_name": model_name, "lang": lang, "lang_key": lang_key,
+                            "conv_id": conv_id, "scenario": scenario_name, "prompts": (system_prompt, user_prompt),
+                            "steps": 2 if step_two is not None else 1,
+                            "prompt_tokens": token_caches[model_id].length(lang, conv_id, scenario_name) if token_caches.get(model_id) else None,
+                            "generate_hash": digest(model_id, backend["settings"], system_prompt, user_prompt, step_two),
+                        }
+                        unit["postprocess_hash"] = digest(unit["generate_hash"], postprocess_hash)
+                        key = unit_key(unit)
+                        output = find_scenario(conv_data, scenario_name)
+
+                        # Generation
+                        recorded = manifest["generate"].get(key)
+                        if output is None:
+                            unit["generate"] = "missing"
+                        elif recorded is None:
+                            unit["generate"] = "untracked"
+                        elif recorded != unit["generate_hash"]:
+                            unit["generate"] = "changed"
+                        else:
+                            unit["generate"] = "done"
+
+                        # Postprocessing rewrites the raw answers in place, so a unit postprocessed with other label
+                        # lists can only be redone by regenerating it
+                        recorded = manifest["postprocess"].get(key)
+                        if unit["generate"] != "done":
+                            unit["postprocess"] = "upstream"
+                        elif any(field in output for field in RAW_FIELDS):
+                            unit["postprocess"] = "pending"
+                        elif recorded is not None and recorded != unit["postprocess_hash"]:
+                            unit["postprocess"] = "outdated"
+                        else:
+                            unit["postprocess"] = "done"
+
+                        # Evaluation, per criterion
+                        statement = output.get("final_empathetic_statement") if output else None
+                        dialogue = (conv_data or {}).get("dialogue", record["dialogue"])
+                        unit["evaluate_hashes"] = {criterion: digest(fingerprint, dialogue, statement) for criterion, fingerprint in fingerprints[lang].items()}
+                        unit["judge_prompts"] = {
+                            criterion: judge.COMMON_PROMPT + criteria_prompts[lang][criterion] + judge.build_user_prompt(dialogue, statement, criterion)
+                            for criterion in judge.CRITERIA
+                        } if evaluated else {}
+                        unit["changed_criteria"] = list(judge.CRITERIA)
+                        evaluation = evaluations.get(conv_id, {}).get(scenario_name)
+                        recorded = manifest["evaluate"].get(key)
+                        if not evaluated:
+                            unit["evaluate"] = "skipped"
+                        elif unit["postprocess"] in ("upstream", "pending"):
+                            unit["evaluate"] = "upstream"
+                        elif evaluation is None:
+                            unit["evaluate"] = "missing"
+                        elif any(not isinstance(score, int) for score in evaluation.get("scores", {}).values()):
+                            unit["evaluate"] = "failed"
+                        elif recorded is None:
+                            unit["evaluate"] = "untracked"
+                        else:
+                            unit["changed_criteria"] = [criterion for criterion, value in unit["evaluate_hashes"].items() if recorded.get(criterion) != value]
+                            unit["evaluate"] = "changed" if unit["changed_criteria"] else "done"
+                        unit["failed_scores"] = evaluation is not None and any(not isinstance(score, int) for score in evaluation.get("scores", {}).values())
+                        units.append(unit)
+
+    # Generation resumes whole dialogues: a stale scenario takes the other scenarios of its dialogue with it
+    stale_dialogues = {(unit["model_name"], unit["lang"], unit["conv_id"]) for unit in units if unit["generate"] != "done"}
+    for unit in units:
+        if unit["generate"] == "done" and (unit["model_name"], unit["lang"], unit["conv_id"]) in stale_dialogues:
+            unit["generate"] = "dialogue"
+            unit["postprocess"] = "upstream"
+            if unit["evaluate"] != "skipped":
+                unit["evaluate"] = "upstream"
+    return units
+
+def is_stale(unit, stage):
+    return unit[stage] not in ("done", "skipped", "outdated")
+
+# API calls and estimated input tokens of recomputing a unit's stage
+def unit_cost(unit, stage):
+    if stage == "generate":
+        if not unit["backend"]["api"]:
+            return 0, 0
+        system_prompt, user_prompt = unit["prompts"]
+        return unit["steps"], unit["steps"] * estimate_tokens(system_prompt + user_prompt)
+    if stage == "evaluate":
+        # Criteria whose request did not change are answered from the judge cache
+        criteria = unit["changed_criteria"] if unit["evaluate"] == "changed" and judge.JUDGE_CACHE_PATH else judge.CRITERIA
+        tokens = sum(estimate_tokens(unit["judge_prompts"][criterion]) for criterion in criteria)
+        return (1 if judge.FUSED_JUDGE else len(criteria)), tokens
+    return 0, 0
+
+def print_plan(units):
+    total_calls = total_tokens = 0
+    for stage in STAGES:
+        rows = {}
+        for unit in units:
+            if not is_stale(unit, stage) and unit[stage] != "outdated":
+                continue
+            row = rows.setdefault((unit["model_name"], unit["lang"]), {"units": 0, "reasons": {}, "calls": 0, "tokens": 0, "local": 0, "local_tokens": 0})
+            row["units"] += 1
+            row["reasons"][unit[stage]] = row["reasons"].get(unit[stage], 0) + 1
+            if is_stale(unit, stage):
+                calls, tokens = unit_cost(unit, stage)
+                row["calls"] += calls
+                row["tokens"] += tokens
+                if stage == "generate" and not unit["backend"]["api"]:
+                    row["local"] += unit["steps"]
+                    row["local_tokens"] += unit["steps"] * (unit["prompt_tokens"] or 0)
+        print(f"== {stage}: {sum(row['units'] for row in rows.values())} units")
+        for (model_name, lang), row in sorted(rows.items()):
+            reasons = ", ".join(f"{reason} {count}" for reason, count in sorted(row["reasons"].items()))
+            local = f", {row['local']} local generations" if row["local"] else ""
+            if row["local_tokens"]:
+                local += f" (~{row['local_tokens']} prompt tokens from the token cache)"
+            print(f"   {model_name:<30} {lang:<8} {row['units']:>6} units ({reasons}): {row['calls']} API calls, ~{row['tokens']} input tokens{local}")
+            total_calls += row["calls"]
+            total_tokens += row["tokens"]
+
+    outdated = sum(unit["postprocess"] == "outdated" for unit in units)
+    if outdated:
+        print(f"{outdated} units were postprocessed with other label lists; their raw answers are not kept, so they are only redone when regenerated.")
+    if any(unit["generate"] == "untracked" or unit["evaluate"] == "untracked" for unit in units):
+        print("Untracked units have outputs but no recorded hashes; `python pipeline.py adopt` records them as they are.")
+    failed = sum(unit["failed_scores"] for unit in units)
+    print(f"Total: {total_calls} API calls, ~{total_tokens} input tokens (evaluation units with failed scores: {failed})")
+
+# Record the hashes of the units whose stage output is now in place
+def record(manifest, units, stage, only=None):
+    for unit in units:
+        key = unit_key(unit)
+        if only is not None and key not in only:
+            continue
+        if stage == "generate" and unit["generate"] != "missing":
+            manifest["generate"][key] = unit["generate_hash"]
+        elif stage == "postprocess" and unit["postprocess"] == "done":
+            manifest["postprocess"][key] = unit["postprocess_hash"]
+        elif stage == "evaluate" and unit["evaluate"] not in ("missing", "upstream", "skipped"):
+            manifest["evaluate"][key] = unit["evaluate_hashes"]
+
+# Copy the dialogues of one results file into another (those it does not have yet, except `skip`)
+def copy_results(source_path, target_path, skip=()):
+    source = read_results(source_path)
+    target = CheckpointStore(target_path)
+    for conv_id, conv_data in source.items():
+        if conv_id not in skip and not target.has(conv_id):
+            target.add(conv_data, conv_id)
+    target.close()
+
+def run_generation(units):
+    stale = [unit for unit in units if is_stale(unit, "generate")]
+    if not stale:
+        return
+    dialogues = {}
+    for unit in stale:
+        dialogues.setdefault((unit["backend"]["script"], unit["model_name"], unit["lang"]), set()).add(unit["conv_id"])
+    backends = {unit["backend"]["script"]: unit["backend"] for unit in stale}
+
+    # Invalidate the stale dialogues; open_source.py resumes from its own results files, so those are first brought
+    # up to date with the dialogues that are kept
+    for (script, model_name, lang), conv_ids in dialogues.items():
+        backend = backends[script]
+        paths = {experiment_file(model_name, lang), backend["output"](model_name, lang)}
+        for path in paths:
+            store = CheckpointStore(path)
+            for conv_id in conv_ids:
+                store.remove(conv_id)
+            store.close()
+        if backend["output"] is not experiment_file:
+            copy_results(experiment_file(model_name, lang), backend["output"](model_name, lang), skip=conv_ids)
+
+    if "claude.py" in backends:
+        import claude
+        if claude.GENERATION_MODE == "batch":
+            claude.main_batch()
+        else:
+            asyncio.run(claude.main())
+    if "open_source.py" in backends:
+        import open_source
+        open_source.main()
+        # Downstream stages read the experiment results
+        for (script, model_name, lang) in dialogues:
+            if script == "open_source.py":
+                copy_results(backends[script]["output"](model_name, lang), experiment_file(model_name, lang))
+
+def run_postprocessing(units):
+    jobs = []
+    published = set()
+    for unit in units:
+        if unit["postprocess"] == "pending":
+            path = experiment_file(unit["model_name"], unit["lang"])
+
+            # Dialogues generated by open_source.py but not yet in the experiment results
+            output = unit["backend"]["output"](unit["model_name"], unit["lang"])
+            if output != path and output not in published:
+                copy_results(output, path)
+                published.add(output)
+
+            job = (path, unit["backend"]["postprocess"], (unit["model_id"], unit["lang"], unit["lang_key"], None))
+            if job not in jobs:
+                jobs.append(job)
+    if jobs:
+        run_file_jobs(jobs, postprocessing.STATE_FILE)
+
+def run_evaluation(units):
+    stale = [unit for unit in units if is_stale(unit, "evaluate")]
+    if not stale:
+        return
+    stores = {}
+    for unit in stale:
+        store = stores.get((unit["model_name"], unit["lang"]))
+        if store is None:
+            store = stores[(unit["model_name"], unit["lang"])] = judge.open_evaluation_store(EVAL_DIR, unit["model_name"], unit["lang"])
+        store.remove(unit["conv_id"], unit["scenario"])
+    for store in stores.values():
+        store.close()
+    asyncio.run(judge.main())
+
+    # Failed scores are recovered from the judge feedback where possible
+    eval_postprocessing.process_all_files(EVAL_DIR, judge.EVAL_MODELS, judge.EVAL_LANGUAGES)
+
+# Recompute the stale units stage by stage, recording the hashes of each stage once its outputs are in place
+def run(manifest):
+    units = build_plan(manifest)
+    print_plan(units)
+
+    run_generation(units)
+    regenerated = {unit_key(unit) for unit in units if is_stale(unit, "generate")}
+    units = build_plan(manifest)
+    record(manifest, units, "generate", only=regenerated)
+    # The postprocessing hashes of regenerated units belong to their previous answers
+    for key in regenerated:
+        manifest["postprocess"].pop(key, None)
+    save_manifest(manifest)
+
+    units = build_plan(manifest)
+    pending = {unit_key(unit) for unit in units if unit["postprocess"] == "pending"}
+    run_postprocessing(units)
+    units = build_plan(manifest)
+    record(manifest, units, "postprocess", only=pending | {unit_key(unit) for unit in units if unit_key(unit) not in manifest["postprocess"]})
+    save_manifest(manifest)
+
+    units = build_plan(manifest)
+    run_evaluation(units)
+    record(manifest, build_plan(manifest), "evaluate")
+    save_manifest(manifest)
+
+    print("== after the run")
+    print_plan(build_plan(manifest))
+
+# Record the current outputs as up to date (e.g. outputs produced before the manifest existed)
+def adopt(manifest):
+    units = build_plan(manifest)
+    record(manifest, units, "generate")
+    units = build_plan(manifest)
+    record(manifest, units, "postprocess")
+    units = build_plan(manifest)
+    record(manifest, units, "evaluate")
+    save_manifest(manifest)
+    print_plan(build_plan(manifest))
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "dry-run"
+    manifest = load_manifest()
+    if mode == "run":
+        run(manifest)
+    elif mode == "adopt":
+        adopt(manifest)
+    else:
+        print_plan(build_plan(manifest))
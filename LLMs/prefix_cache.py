@@ -0,0 +1,54 @@
+import torch
+from transformers import DynamicCache
+
+# Number of leading tokens two id sequences have in common
+def common_prefix_length(a, b):
+    length = 0
+    while length < min(len(a), len(b)) and a[length] == b[length]:
+        length += 1
+    return length
+
+# Cache of the past-key-values of the shared system prompts, keyed by the system message of a scenario and language.
+# Every chat of a scenario and language starts with the same system message, so its tokens are prefilled once
+# per model and only the per-dialogue suffix is prefilled for each generation.
+class PrefixCache:
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.entries = {}
+        self.prefill_tokens_saved = 0
+
+    # Token ids the chat template renders before any user message following this system message
+    # (the last tokens may still merge with the user message; callers use the longest common prefix)
+    def _prefix_ids(self, system_message):
+        probes = [
+            self.tokenizer.apply_chat_template([system_message, {"role": "user", "content": content}], add_generation_prompt=True)
+            for content in ["\nA", "\nB"]
+        ]
+        return probes[0][:common_prefix_length(probes[0], probes[1])]
+
+    # Prefix ids and past-key-values (legacy tuple) for a system message
+    def lookup(self, system_message):
+        entry = self.entries.get(system_message["content"])
+        if entry is None:
+            prefix_ids = self._prefix_ids(system_message)
+            past = DynamicCache() if getattr(self.model, "_supports_cache_class", False) else None
+            with torch.no_grad():
+                output = self.model(torch.tensor([prefix_ids], device=self.model.device), past_key_values=past, use_cache=True)
+            past = output.past_key_values
+            if isinstance(past, DynamicCache):
+                past = past.to_legacy_cache()
+            entry = (prefix_ids, past)
+            self.entries[system_message["content"]] = entry
+        return entry
+
+    # Fresh cache for a batch of chats sharing the first `length` prefix tokens
+    # (generation appends to it, the stored tensors stay untouched)
+    def expand(self, past, batch_size, length):
+        legacy = tuple(
+            (k[:, :, :length].expand(batch_size, -1, -1, -1), v[:, :, :length].expand(batch_size, -1, -1, -1))
+            for k, v in past
+        )
+        if getattr(self.model, "_supports_cache_class", False):
+            return DynamicCache.from_legacy_cache(legacy)
+        return legacy
@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import hashlib
+from koed_dataset import KoEDDataset
+
+# Render stage: every prompt of a dataset is built once into a prompt corpus ('<data file>.prompts.jsonl') that both
+# generation backends stream from, so prompt construction is out of the generation loop and claude.py and
+# open_source.py send exactly the same prompts.
+#
+# Corpus layout: the first line is a header with the deduplicated system prompts and the byte range of each
+# language's records; every other line is one dialogue of one language:
+#     {"conv_id": ..., "lang": ..., "dialogue": ..., "scenarios": [{"scenario": ..., "system": <system id>, "user": ...}]}
+
+# Languages of the experiments (KoED & ED) and the utterance field holding each of them
+LANGUAGES = [("Korean", "ko_utter"), ("English", "utter")]
+
+# Alternating Speaker/Listener turns; with an even number of turns the last one is dropped for balance
+def build_dialogue_text(dialogue_data, lang_key):
+    turns = [utterance[lang_key] for utterance in dialogue_data['dialogue'] if lang_key in utterance and utterance[lang_key]]
+    if len(turns) % 2 == 0:
+        turns = turns[:-1]
+    lines = [f"{'Speaker' if index % 2 == 0 else 'Listener'}: {turn}" for index, turn in enumerate(turns)]
+    return "\n".join(lines) + "\n"
+
+# Task definition shared by every scenario of a language
+def build_common_task_definition(lang):
+    return f"""Task Definition: This is a/an {lang.lower()} empathetic dialogue task: The first worker (Speaker) is given an emotion label and writes his own description of a situation when he has felt that way. Then, Speaker tells his story in a conversation with a second worker (Listener). The emotion label and situation of Speaker are invisible to Listener. Listener should recognize and acknowledge others' feelings in a conversation as much as possible. Guideline Instruction: Now you play the role of Listener, please give the corresponding response according to the existing context. You only need to provide the next round of response of Listener."""
+
+## Scenario generation
+def build_scenarios(common_task_definition, multi_turn_dialogue):
+    scenarios = [
+        ("34개의 단일 감정", [ # 34-Single
+            common_task_definition + """
+                List of 34 Emotions:
+                    Afraid (두려움), Angry (화남), Annoyed (짜증남), Anticipating (기대됨), Anxious (불안함), Apprehensive (염려됨), Ashamed (부끄러움), Caring (보살핌), Confident (자신감), Content (만족함), Devastated (충격받음), Disappointed (실망함), Disgusted (역겨움), Embarrassed (당황함), Excited (흥분됨), Faithful (충실함), Furious (격노함), Grateful (감사함), Guilty (죄책감), Hopeful (희망적), Impressed (감명받음), Jealous (질투남), Joyful (기쁨), Lonely (외로움), Nostalgic (향수에 젖음), Prepared (준비됨), Proud (자랑스러움), Sad (슬픔), Sentimental (감상적), Surprised (놀람), Terrified (겁에 질림), Trusting (신뢰함), 정 (a feeling that arises in one's heart, or a feeling of love or affinity), 한 (a feeling of bitter resentment, injustice, pity, or sadness)
+
+                Important Guidelines:
+                    - Do not use any emotion terms other than the 34 basic emotions listed above.
+                    - Combinations or mixtures of emotions are not allowed. Choose and use only one emotion.
+                    - Even for complex or subtle emotions, you must express them using only one of the 34 emotions that is closest in meaning.""",
+            f"""
+                    {multi_turn_dialogue}
+
+                Step-by-Step Instructions:
+                    1. Analyze the given dialogue to identify the Speaker's emotional state.
+                    2. Specify the identified emotion using only one of the 34 basic emotions listed above.
+                    (STOP HERE. Do NOT proceed to steps 3 and 4 yet. Only identify the emotion at this stage.)
+                """,
+        ]),
+        ("34개의 멀티 감정", [ # 34-Multi
+            common_task_definition + """
+                List of 34 Emotions:
+                    Afraid (두려움), Angry (화남), Annoyed (짜증남), Anticipating (기대됨), Anxious (불안함), Apprehensive (염려됨), Ashamed (부끄러움), Caring (보살핌), Confident (자신감), Content (만족함), Devastated (충격받음), Disappointed (실망함), Disgusted (역겨움), Embarrassed (당황함), Excited (흥분됨), Faithful (충실함), Furious (격노함), Grateful (감사함), Guilty (죄책감), Hopeful (희망적), Impressed (감명받음), Jealous (질투남), Joyful (기쁨), Lonely (외로움), Nostalgic (향수에 젖음), Prepared (준비됨), Proud (자랑스러움), Sad (슬픔), Sentimental (감상적), Surprised (놀람), Terrified (겁에 질림), Trusting (신뢰함), 정 (a feeling that arises in one's heart, or a feeling of love or affinity), 한 (a feeling of bitter resentment, injustice, pity, or sadness)
+
+                Important Guidelines:
+                    - Do not use any emotion terms other than the 34 basic emotions listed above.
+                    - Combinations or mixtures of emotions are allowed. Select up to 4 emotions that best describe the Speaker's emotional state.""",
+            f"""
+                {multi_turn_dialogue}
+
+                Step-by-Step Instructions:
+                    1. Analyze the given dialogue to identify the Speaker's complex emotional state.
+                    2. Specify the identified emotions using multiple labels from the 34 emotions listed above. Select all that apply, with no minimum or maximum limit.
+                    (STOP HERE. Do NOT proceed to steps 3 and 4 yet. Only identify the emotion at this stage.)
+                """
+        ]),
+    ]
+    return scenarios
+
+scenario_next_steps = {
+    "34개의 단일 감정": 3,
+    "34개의 멀티 감정": 3
+}
+
+
+# User prompt of step 2: the step-1 prompt followed by the emotions identified in step 1
+def add_identified_emotions(scenario_name, user_prompt, identified_emotions, lang):
+    return user_prompt + f"\n\nIdentified Emotions: {identified_emotions}\n\n{scenario_next_steps[scenario_name]}. Proceeding with the next {lang} empathetic response based on the identified emotions."
+
+# Fingerprint of the prompt templates: a corpus rendered with other templates is stale
+def template_fingerprint():
+    probe = build_dialogue_text({"dialogue": [{"utter": "A"}, {"utter": "B"}, {"utter": "C"}]}, "utter")
+    prompts = [build_scenarios(build_common_task_definition(lang), probe) for lang, _ in LANGUAGES]
+    prompts.append(add_identified_emotions(prompts[0][0][0], "", "X", "Y"))
+    return hashlib.sha256(json.dumps(prompts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+# Render the prompt corpus of a dataset file
+def render_corpus(data_file_path, corpus_path):
+    dataset = KoEDDataset(data_file_path)
+    stat = os.stat(data_file_path)
+    systems = []
+    system_ids = {}
+    lines = {lang: [] for lang, _ in LANGUAGES}
+
+    for dialogue_data in dataset:
+        for lang, lang_key in LANGUAGES:
+            dialogue_text = build_dialogue_text(dialogue_data, lang_key)
+            multi_turn_dialogue = f"\n    Multi-Turn Dialogue:\n        {dialogue_text}"
+            scenarios = []
+            for scenario_name, (system_prompt, user_prompt) in build_scenarios(build_common_task_definition(lang), multi_turn_dialogue):
+                if system_prompt not in system_ids:
+                    system_ids[system_prompt] = len(systems)
+                    systems.append(system_prompt)
+                scenarios.append({"scenario": scenario_name, "system": system_ids[system_prompt], "user": user_prompt})
+            record = {"conv_id": dialogue_data['conv_id'], "lang": lang, "dialogue": dialogue_text, "scenarios": scenarios}
+            lines[lang].append((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+
+    # Byte ranges are relative to the end of the header line
+    ranges = {}
+    position = 0
+    for lang, _ in LANGUAGES:
+        size = sum(len(line) for line in lines[lang])
+        ranges[lang] = [position, position + size]
+        position += size
+
+    header = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "templates": template_fingerprint(),
+        "conv_ids": dataset.conv_ids,
+        "ranges": ranges,
+        "systems": systems,
+    }
+    tmp_path = corpus_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write((json.dumps(header, ensure_ascii=False) + '\n').encode('utf-8'))
+        for lang, _ in LANGUAGES:
+            f.writelines(lines[lang])
+    os.replace(tmp_path, corpus_path)
+
+# Read side of a rendered prompt corpus
+class PromptCorpus:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header_line = f.readline()
+        self.header = json.loads(header_line)
+        self.body_offset = len(header_line)
+        self.systems = self.header["systems"]
+        self.conv_ids = self.header["conv_ids"]
+
+    def system(self, system_id):
+        return self.systems[system_id]
+
+    # Stream the records of one language in dataset order
+    def records(self, lang):
+        start, end = self.header["ranges"][lang]
+        with open(self.path, 'rb') as f:
+            f.seek(self.body_offset + start)
+            position = start
+            while position < end:
+                line = f.readline()
+                position += len(line)
+                yield json.loads(line)
+
+    # (system prompt, user prompt) of a scenario record
+    def prompts(self, scenario):
+        return self.systems[scenario["system"]], scenario["user"]
+
+# Prompt corpus of a dataset file, rendered first if missing or out of date
+def open_prompt_corpus(data_file_path):
+    corpus_path = data_file_path + '.prompts.jsonl'
+    stale = True
+    if os.path.exists(corpus_path):
+        stat = os.stat(data_file_path)
+        with open(corpus_path, 'rb') as f:
+            header = json.loads(f.readline())
+        stale = (header.get("size") != stat.st_size or header.get("mtime_ns") != stat.st_mtime_ns
+                 or header.get("templates") != template_fingerprint())
+    if stale:
+        render_corpus(data_file_path, corpus_path)
+    return PromptCorpus(corpus_path)
+
+# Render the prompt corpus of the given dataset files ahead of a run
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        corpus = open_prompt_corpus(path)
+        print(f"{corpus.path}: {len(corpus.conv_ids)} dialogues, {len(corpus.systems)} distinct system prompts")
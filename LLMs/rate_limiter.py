@@ -0,0 +1,83 @@
+import time
+import random
+import asyncio
+
+# Rough token estimate used to reserve rate-limit budget before a request is sent
+def estimate_tokens(text):
+    return len(text) // 3 + 1
+
+# Token bucket that refills continuously up to a per-minute capacity
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.refill_rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    # Seconds to wait until the requested amount is available
+    def wait_time(self, amount):
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_rate
+
+    def consume(self, amount):
+        self.level -= min(amount, self.capacity)
+
+# Requests-per-minute and tokens-per-minute limiter shared by all coroutines of a run
+# (must be created inside the running event loop)
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._lock = asyncio.Lock()
+
+    # Wait until one request and the estimated number of tokens can be spent
+    async def acquire(self, tokens=0):
+        async with self._lock:
+            while True:
+                wait = 0.0
+                if self.request_bucket is not None:
+                    wait = max(wait, self.request_bucket.wait_time(1))
+                if self.token_bucket is not None:
+                    wait = max(wait, self.token_bucket.wait_time(tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            if self.request_bucket is not None:
+                self.request_bucket.consume(1)
+            if self.token_bucket is not None:
+                self.token_bucket.consume(tokens)
+
+    # Correct the token bucket once the real usage of a request is known
+    def adjust(self, estimated_tokens, actual_tokens):
+        if self.token_bucket is not None:
+            self.token_bucket.refill()
+            self.token_bucket.level -= actual_tokens - estimated_tokens
+
+# Seconds to wait before retry number `attempt` (0-based): exponential backoff with full jitter,
+# unless the server asked for a specific delay with a Retry-After header
+def backoff_delay(attempt, retry_after=None, base=1.0, maximum=60.0):
+    if retry_after is not None:
+        return min(retry_after, maximum)
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+# Retry-After (or retry-after-ms) of an error response in seconds, if present
+def parse_retry_after(headers):
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers.get("retry-after-ms")) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        pass
+    return None
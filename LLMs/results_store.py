@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import glob
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Columnar store of every judge score written by eval.py, with vectorized aggregation.
+# ingest() flattens output/eval_results/<dataset>/<model>/<language>/*_evaluation.json into one row per
+# (dataset, model, language, scenario, criterion, conv_id) with its score; key columns are dictionary-encoded (integer
+# codes plus the list of values) and failed scores ("Error") are NaN. The table is saved as Parquet, so reports never
+# walk the nested JSON again. Group means come from bincount over the combined group code, and bootstrap confidence
+# intervals draw the score counts of every resample of every group at once from a multinomial (scores take a handful
+# of values, so this is the same distribution as resampling the rows themselves).
+#
+#     table = ScoresTable.load(STORE_FILE)
+#     rows = table.where(language="Korean").bootstrap_ci(("model", "criterion"))
+
+EVAL_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'output', 'eval_results')
+STORE_FILE = os.path.join(EVAL_RESULTS_DIR, 'scores.parquet')
+
+KEY_COLUMNS = ("dataset", "model", "language", "scenario", "criterion", "conv_id")
+
+BOOTSTRAP_RESAMPLES = 10000
+CONFIDENCE = 0.95
+
+def encode(values):
+    categories, codes = np.unique(np.asarray(values, dtype=object).astype(str), return_inverse=True)
+    return codes.astype(np.int32), categories.tolist()
+
+class ScoresTable:
+    def __init__(self, codes, categories, scores):
+        self.codes = codes
+        self.categories = categories
+        self.scores = scores
+
+    @classmethod
+    def from_rows(cls, rows):
+        codes, categories = {}, {}
+        for index, column in enumerate(KEY_COLUMNS):
+            codes[column], categories[column] = encode([row[index] for row in rows])
+        scores = np.array([row[-1] for row in rows], dtype=np.float64)
+        return cls(codes, categories, scores)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def values(self, column):
+        return np.asarray(self.categories[column], dtype=object)[self.codes[column]]
+
+    # Rows matching every condition; a condition is one value or a list of values of a key column
+    def where(self, **conditions):
+        mask = np.ones(len(self), dtype=bool)
+        for column, wanted in conditions.items():
+            wanted = [wanted] if isinstance(wanted, str) else list(wanted)
+            wanted_codes = [self.categories[column].index(value) for value in wanted if value in self.categories[column]]
+            mask &= np.isin(self.codes[column], wanted_codes)
+        return ScoresTable({column: codes[mask] for column, codes in self.codes.items()}, self.categories, self.scores[mask])
+
+    # Group of every row for the key columns `by`: (group index per row, key tuple of every group)
+    def groups(self, by):
+        if not by:
+            return np.zeros(len(self), dtype=np.int64), [()]
+        combined = np.ravel_multi_index([self.codes[column] for column in by], [len(self.categories[column]) for column in by])
+        group_codes, group_index = np.unique(combined, return_inverse=True)
+        unravelled = np.unravel_index(group_codes, [len(self.categories[column]) for column in by])
+        keys = list(zip(*[[self.categories[column][code] for code in codes] for column, codes in zip(by, unravelled)]))
+        return group_index, keys
+
+    # Per group of `by`: number of valid scores, failed scores and mean score
+    def mean(self, by):
+        group_index, keys = self.groups(by)
+        valid = ~np.isnan(self.scores)
+        counts = np.bincount(group_index[valid], minlength=len(keys))
+        failed = np.bincount(group_index[~valid], minlength=len(keys))
+        sums = np.bincount(group_index[valid], weights=self.scores[valid], minlength=len(keys))
+        means = np.divide(sums, counts, out=np.full(len(keys), np.nan), where=counts > 0)
+        return [
+            dict(zip(by, key), n=int(n), failed=int(f), mean=float(m))
+            for key, n, f, m in zip(keys, counts, failed, means)
+        ]
+
+    # Group means with percentile bootstrap confidence intervals over `resamples` resamples of each group's scores
+    def bootstrap_ci(self, by, resamples=BOOTSTRAP_RESAMPLES, confidence=CONFIDENCE, seed=0):
+        rows = self.mean(by)
+        group_index, keys = self.groups(by)
+        valid = ~np.isnan(self.scores)
+        score_values, score_index = np.unique(self.scores[valid], return_inverse=True)
+        # No score at all (empty selection, or only failed evaluations): nothing to resample
+        if len(score_values) == 0:
+            for row in rows:
+                row["ci_low"] = row["ci_high"] = float("nan")
+            return rows
+
+        # Frequency of every score value in every group; the counts of a resample are multinomial over them
+        frequencies = np.zeros((len(keys), len(score_values)))
+        np.add.at(frequencies, (group_index[valid], score_index), 1)
+        sizes = frequencies.sum(axis=1)
+        probabilities = np.divide(frequencies, sizes[:, None], out=np.zeros_like(frequencies), where=sizes[:, None] > 0)
+        probabilities[sizes == 0, 0] = 1.0
+
+        generator = np.random.default_rng(seed)
+        resampled = generator.multinomial(sizes.astype(np.int64), probabilities, size=(resamples, len(keys)))
+        resampled_means = (resampled @ score_values) / np.maximum(sizes, 1)
+        low, high = np.percentile(resampled_means, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+        for row, n, ci_low, ci_high in zip(rows, sizes, low, high):
+            row["ci_low"] = float(ci_low) if n else float("nan")
+            row["ci_high"] = float(ci_high) if n else float("nan")
+        return rows
+
+    def to_arrow(self):
+        columns = {
+            column: pa.DictionaryArray.from_arrays(pa.array(self.codes[column]), pa.array(self.categories[column], pa.string()))
+            for column in KEY_COLUMNS
+        }
+        columns["score"] = pa.array(self.scores, pa.float64(), mask=np.isnan(self.scores))
+        return pa.table(columns)
+
+    @classmethod
+    def from_arrow(cls, table):
+        table = table.unify_dictionaries().combine_chunks()
+        codes, categories = {}, {}
+        for column in KEY_COLUMNS:
+            array = table.column(column).chunk(0) if table.num_rows else pa.array([], pa.dictionary(pa.int32(), pa.string()))
+            if not pa.types.is_dictionary(array.type):
+                array = array.dictionary_encode()
+            codes[column] = array.indices.to_numpy(zero_copy_only=False).astype(np.int32)
+            categories[column] = array.dictionary.to_pylist()
+        scores = table.column("score").to_numpy().astype(np.float64) if table.num_rows else np.zeros(0)
+        return cls(codes, categories, scores)
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        pq.write_table(self.to_arrow(), tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        return cls.from_arrow(pq.read_table(path, read_dictionary=list(KEY_COLUMNS)))
+
+# Rows (dataset, model, language, scenario, criterion, conv_id, score) of one evaluation file
+def evaluation_rows(path, dataset, model_name, language):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    rows = []
+    for conv_id, scenarios in data.items():
+        for scenario_name, evaluation in scenarios.items():
+            for criterion, score in evaluation.get("scores", {}).items():
+                score = score if isinstance(score, (int, float)) and not isinstance(score, bool) else np.nan
+                rows.append((dataset, model_name, language, scenario_name, criterion, conv_id, score))
+    return rows
+
+# Flatten the evaluation files of the given datasets (run directories; all of them by default) into one table
+def ingest(eval_results_dir=EVAL_RESULTS_DIR, datasets=None):
+    rows = []
+    for path in sorted(glob.glob(os.path.join(eval_results_dir, '*', '*', '*', '*_evaluation.json'))):
+        language_dir = os.path.dirname(path)
+        model_dir = os.path.dirname(language_dir)
+        dataset = os.path.basename(os.path.dirname(model_dir))
+        if datasets and dataset not in datasets:
+            continue
+        rows += evaluation_rows(path, dataset, os.path.basename(model_dir), os.path.basename(language_dir))
+    return ScoresTable.from_rows(rows)
+
+def print_report(rows, by):
+    header = "".join(f"{column:<34}" for column in by)
+    print(f"{header}{'n':>7} {'failed':>7} {'mean':>7} {'95% CI':>17}")
+    for row in rows:
+        keys = "".join(f"{str(row[column]):<34}" for column in by)
+        interval = f"[{row['ci_low']:.3f}, {row['ci_high']:.3f}]" if "ci_low" in row else ""
+        print(f"{keys}{row['n']:>7} {row['failed']:>7} {row['mean']:>7.3f} {interval:>17}")
+
+if __name__ == "__main__":
+    # python results_store.py ingest [dataset ...]   -> (re)build STORE_FILE from the evaluation files
+    # python results_store.py [column ...]           -> means and bootstrap CIs grouped by the columns
+    if len(sys.argv) > 1 and sys.argv[1] == "ingest":
+        start = time.perf_counter()
+        table = ingest(datasets=sys.argv[2:] or None)
+        table.save(STORE_FILE)
+        print(f"Ingested {len(table)} scores into {STORE_FILE} in {time.perf_counter() - start:.2f} s")
+    else:
+        by = tuple(sys.argv[1:]) or ("dataset", "model", "language", "criterion")
+        start = time.perf_counter()
+        table = ScoresTable.load(STORE_FILE)
+        rows = table.bootstrap_ci(by)
+        print_report(rows, by)
+        print(f"{len(table)} scores, {len(rows)} groups, {BOOTSTRAP_RESAMPLES} resamples in {time.perf_counter() - start:.2f} s")
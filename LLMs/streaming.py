@@ -0,0 +1,256 @@
+import os
+import sys
+import copy
+import time
+import asyncio
+import aiohttp
+import openai
+from tqdm import tqdm
+from checkpoint import CheckpointStore, read_results
+from prompt_corpus import LANGUAGES
+from rate_limiter import RateLimiter
+from judge_cache import JudgeCache
+from metrics import metrics
+import claude
+import eval as judge
+
+# Per-scenario cleaning of the experiment postprocessing (output/experiment_results/postprocessing.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'output', 'experiment_results'))
+import postprocessing
+
+# Streaming run of generation -> postprocessing -> evaluation, so that generation time (API or GPU) and judge time
+# overlap instead of adding up.
+# Every dialogue is cleaned as soon as it is generated (claude_process_json / process_file, one scenario at a time),
+# recorded in its experiment results file and put on a bounded queue; judge workers take the dialogues off the queue
+# and evaluate their scenarios right away. A full queue holds generation back (the Claude workers stop taking new
+# dialogues, the GPU thread of open_source.py waits), so a slow judge never piles up generated dialogues in memory.
+# Dialogues already in the results files whose evaluation is missing are queued first. The results and evaluation
+# files are written in their usual layout (experiment results already postprocessed) when the run completes, and
+# an interrupted run resumes from their checkpoint logs.
+#
+#     python streaming.py                       Claude and the open-source models
+#     python streaming.py claude.py             one backend only
+
+STREAM_BACKENDS = ["claude.py", "open_source.py"]
+
+# Generated dialogues waiting for the judges
+STREAM_QUEUE_SIZE = 16
+# Claude dialogues generated at once (their calls still share claude.py's concurrency cap and rate limits)
+GENERATION_WORKERS = 8
+# Dialogues judged at once (their calls still share eval.py's concurrency cap and rate limits)
+EVAL_WORKERS = 8
+
+# Per-call metrics (Prometheus textfile, or CSV for a .csv path) and Chrome-trace JSON of the run; None disables them
+METRICS_FILE = None
+TRACE_FILE = None
+
+EVAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'output', 'eval_results', judge.EVAL_OUTPUT_NAME)
+
+# Postprocessing of one scenario per backend
+SCENARIO_CLEANERS = {
+    "claude.py": postprocessing.claude_process_scenario,
+    "open_source.py": postprocessing.process_scenario,
+}
+
+# Results files of the run and the queue between generation and evaluation
+class Stream:
+    def __init__(self, queue_size):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.results = {}
+        self.evaluations = {}
+        self.progress = tqdm(total=0, desc="Generated dialogues", unit="dialogue", position=1)
+
+    def results_store(self, model_id, lang):
+        key = (model_id.split("/")[-1], lang)
+        if key not in self.results:
+            self.results[key] = CheckpointStore(postprocessing.result_file_path(model_id, lang))
+        return self.results[key]
+
+    def evaluation_store(self, model_name, lang):
+        key = (model_name, lang)
+        if key not in self.evaluations:
+            self.evaluations[key] = judge.open_evaluation_store(EVAL_DIR, model_name, lang)
+        return self.evaluations[key]
+
+    # Clean a generated dialogue, record it and queue it for the judges (waits while the queue is full)
+    async def publish(self, model_id, lang, dialogue_results, clean):
+        conv_data = copy.deepcopy(dialogue_results)
+        for scenario in conv_data['scenarios']:
+            clean(scenario)
+        self.results_store(model_id, lang).add(conv_data, conv_data['conv_id'])
+        self.progress.total += 1
+        self.progress.update(1)
+        await self.enqueue(model_id.split("/")[-1], lang, conv_data)
+
+    async def enqueue(self, model_name, lang, conv_data):
+        queued = time.perf_counter()
+        await self.queue.put((model_name, lang, conv_data))
+        metrics.observe("stream_backpressure", time.perf_counter() - queued)
+
+    # Rewrite every results and evaluation file from its checkpoint log in dataset order
+    def close(self, conv_ids):
+        self.progress.close()
+        for (model_name, lang), store in self.results.items():
+            order = [conv_id for conv_id in conv_ids if store.has(conv_id)]
+            store.compact(order=conv_ids)
+            store.close(compact=False)
+            evaluations = self.evaluations.get((model_name, lang))
+            if evaluations is not None:
+                evaluations.compact(order=order)
+                evaluations.close(compact=False)
+        print(f"Results saved to {len(self.results)} results files and {len(self.evaluations)} evaluation files.")
+
+def evaluated(model_name, lang):
+    return model_name in judge.EVAL_MODELS and lang in judge.EVAL_LANGUAGES
+
+# Dialogues of earlier runs: those open_source.py generated that never reached the experiment results, and those not
+# (fully) evaluated yet. Dialogues left unprocessed in the results files are cleaned on the way. Taken before
+# generation starts, so that nothing generated by this run is queued twice.
+def collect_backlog(stream, backends, models):
+    unpublished, unevaluated = [], []
+    for script in backends:
+        clean = SCENARIO_CLEANERS[script]
+        for model_id in models[script]:
+            model_name = model_id.split("/")[-1]
+            for lang, _ in LANGUAGES:
+                store = stream.results_store(model_id, lang)
+                if script == "open_source.py":
+                    import open_source
+                    for conv_id, dialogue_results in read_results(open_source.get_output_file(model_name, lang)).items():
+                        if not store.has(conv_id):
+                            unpublished.append((model_id, lang, dialogue_results, clean))
+
+                for conv_id in list(store.data):
+                    conv_data = store.get(conv_id)
+                    if any(field in scenario for scenario in conv_data['scenarios'] for field in ("identified_emotions", "empathetic_response")):
+                        conv_data = copy.deepcopy(conv_data)
+                        for scenario in conv_data['scenarios']:
+                            clean(scenario)
+                        store.add(conv_data, conv_id)
+                    if not evaluated(model_name, lang):
+                        continue
+                    evaluations = stream.evaluation_store(model_name, lang)
+                    if not all(evaluations.has(conv_id, scenario['scenario']) for scenario in conv_data['scenarios']):
+                        unevaluated.append((model_name, lang, conv_data))
+    return unpublished, unevaluated
+
+async def queue_backlog(stream, unpublished, unevaluated):
+    for item in unevaluated:
+        await stream.enqueue(*item)
+    for item in unpublished:
+        await stream.publish(*item)
+
+# Claude dialogues of every language, GENERATION_WORKERS at a time
+async def generate_claude(stream):
+    semaphore = asyncio.Semaphore(claude.MAX_CONCURRENCY)
+    limiter = RateLimiter(claude.REQUESTS_PER_MINUTE, claude.TOKENS_PER_MINUTE)
+    clean = SCENARIO_CLEANERS["claude.py"]
+    pending = iter([
+        (record, lang) for lang, _ in LANGUAGES for record in claude.prompt_corpus.records(lang)
+        if not stream.results_store(claude.CLAUDE_MODEL, lang).has(record["conv_id"])
+    ])
+
+    # Each worker takes the next dialogue only once its last one is queued
+    async def worker():
+        for record, lang in pending:
+            try:
+                dialogue_results = await claude.process_dialogue(record, lang, semaphore, limiter)
+            except Exception as e:
+                # Failed dialogues are left out of the file so that the next run retries them
+                tqdm.write(f"Error generating dialogue for Claude ({lang}): {e}")
+                continue
+            await stream.publish(claude.CLAUDE_MODEL, lang, dialogue_results, clean)
+
+    await asyncio.gather(*[worker() for _ in range(GENERATION_WORKERS)])
+
+# open_source.py on a worker thread; every dialogue it checkpoints is published from the event loop, and the thread
+# waits until the dialogue is queued
+async def generate_open_source(stream):
+    import open_source
+    loop = asyncio.get_running_loop()
+    clean = SCENARIO_CLEANERS["open_source.py"]
+
+    def on_result(model_id, lang, dialogue_results):
+        asyncio.run_coroutine_threadsafe(stream.publish(model_id, lang, dialogue_results, clean), loop).result()
+
+    await loop.run_in_executor(None, open_source.main, None, on_result)
+
+# Evaluate the pending scenarios of one dialogue (all of them concurrently)
+async def judge_dialogue(stream, runner, model_name, lang, conv_data):
+    conv_id = conv_data['conv_id']
+    evaluations = stream.evaluation_store(model_name, lang)
+    pending = [scenario for scenario in conv_data['scenarios'] if not evaluations.has(conv_id, scenario['scenario'])]
+    runner.progress.total += len(pending) * len(judge.CRITERIA)
+    runner.progress.refresh()
+
+    async def run_scenario(scenario):
+        evaluation_result = await judge.evaluate_scenario(
+            runner,
+            conv_id=conv_id,
+            dialogue=conv_data.get("dialogue", ""),
+            scenario_name=scenario['scenario'],
+            empathetic_response=scenario.get("final_empathetic_statement"),
+            criteria=judge.CRITERIA,
+            language=lang
+        )
+        evaluations.add(evaluation_result, conv_id, scenario['scenario'])
+
+    await asyncio.gather(*[run_scenario(scenario) for scenario in pending])
+
+async def judge_worker(stream, runner):
+    while True:
+        item = await stream.queue.get()
+        if item is None:
+            return
+        model_name, lang, conv_data = item
+        if not evaluated(model_name, lang):
+            continue
+        try:
+            await judge_dialogue(stream, runner, model_name, lang, conv_data)
+        except Exception as e:
+            # The scenarios left unevaluated are picked up by the next run
+            tqdm.write(f"Error evaluating {model_name} ({lang}) conv_id {conv_data['conv_id']}: {e}")
+
+async def main(backends=STREAM_BACKENDS):
+    metrics.enable(METRICS_FILE, TRACE_FILE)
+    models = {"claude.py": [claude.CLAUDE_MODEL]}
+    if "open_source.py" in backends:
+        import open_source
+        models["open_source.py"] = open_source.model_ids
+
+    stream = Stream(STREAM_QUEUE_SIZE)
+    cache = JudgeCache(judge.JUDGE_CACHE_PATH, judge.JUDGE_CACHE_MAX_ENTRIES, judge.JUDGE_CACHE_MAX_AGE_DAYS) if judge.JUDGE_CACHE_PATH else None
+    runner = judge.JudgeRunner(total_calls=0, cache=cache)
+
+    # One pooled HTTP session shared by every judge call
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=judge.MAX_CONCURRENCY)) as session:
+        openai.aiosession.set(session)
+        judges = [asyncio.ensure_future(judge_worker(stream, runner)) for _ in range(EVAL_WORKERS)]
+
+        with metrics.span("stage", stage="stream"):
+            unpublished, unevaluated = collect_backlog(stream, backends, models)
+            print(f"Backlog: {len(unevaluated)} dialogues to evaluate, {len(unpublished)} open-source dialogues to publish")
+            producers = [queue_backlog(stream, unpublished, unevaluated)]
+            if "claude.py" in backends:
+                producers.append(generate_claude(stream))
+            if "open_source.py" in backends:
+                producers.append(generate_open_source(stream))
+            await asyncio.gather(*producers)
+
+            # Generation is done: every judge worker stops after the dialogues still queued
+            for _ in judges:
+                await stream.queue.put(None)
+            await asyncio.gather(*judges)
+
+    runner.progress.close()
+    print(f"Judge answers: {runner.repaired} repaired locally, {runner.requeried} re-queried")
+    if cache is not None:
+        print(f"Judge cache: {cache.stats()}")
+        cache.close()
+
+    stream.close(claude.prompt_corpus.conv_ids)
+    metrics.write()
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:] or STREAM_BACKENDS))
+    print(f"Token usage: {claude.usage_totals}")
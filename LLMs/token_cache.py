@@ -0,0 +1,138 @@
+import os
+import sys
+import glob
+import json
+import hashlib
+import numpy as np
+from prompt_corpus import LANGUAGES, open_prompt_corpus
+
+# Persistent token cache of a prompt corpus per tokenizer.
+# The step-1 chat of every (language, dialogue, scenario) of a corpus (system and user prompt, rendered with the chat
+# template and the generation prompt as open_source.py does it) is tokenized once per tokenizer and stored as:
+#   <base>.ids.npy        every token id of every chat, one flat int32 array (memory-mapped on load)
+#   <base>.offsets.npy    start of every chat's ids in it, plus the total (row i spans offsets[i]:offsets[i + 1])
+#   <base>.index.json     model id, tokenizer and corpus fingerprints, and the key "lang|conv_id|scenario" of every row
+# with <base> = TOKEN_CACHE_DIR/<model name>-<tokenizer hash>/<corpus name>-<corpus hash>. A change of the tokenizer
+# (vocabulary, normalisation, special tokens, chat template) or of the corpus gets a new cache, so a repeated sweep
+# tokenizes none of the step-1 chats, and prompt lengths can be looked up without loading any tokenizer.
+# Step-2 chats hold the step-1 answer and are still tokenized during generation.
+
+TOKEN_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'token_cache')
+
+# Chats tokenized per apply_chat_template call while building a cache
+TOKENIZE_BATCH_SIZE = 512
+
+def sha256(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+# Fingerprint of everything that decides the token ids of a chat
+def tokenizer_fingerprint(tokenizer):
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    vocabulary = backend.to_str() if backend is not None else json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False)
+    return sha256(type(tokenizer).__name__, vocabulary, tokenizer.chat_template, json.dumps(tokenizer.special_tokens_map, sort_keys=True, ensure_ascii=False))
+
+def corpus_fingerprint(corpus):
+    digest = hashlib.sha256()
+    with open(corpus.path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def model_directory_name(model_id):
+    return model_id.split("/")[-1]
+
+def corpus_name(corpus):
+    return os.path.basename(corpus.path)[:-len('.prompts.jsonl')]
+
+def cache_key(lang, conv_id, scenario_name):
+    return f"{lang}|{conv_id}|{scenario_name}"
+
+# Read side of a token cache
+class TokenCache:
+    def __init__(self, base):
+        with open(base + '.index.json', 'r', encoding='utf-8') as f:
+            self.index = json.load(f)
+        self.rows = {key: row for row, key in enumerate(self.index["keys"])}
+        self.ids = np.load(base + '.ids.npy', mmap_mode='r')
+        self.offsets = np.load(base + '.offsets.npy')
+
+    def row(self, lang, conv_id, scenario_name):
+        return self.rows.get(cache_key(lang, conv_id, scenario_name))
+
+    # Token ids of the step-1 chat of a scenario (a list, as the generation code uses them), or None if not cached
+    def token_ids(self, lang, conv_id, scenario_name):
+        row = self.row(lang, conv_id, scenario_name)
+        if row is None:
+            return None
+        return self.ids[self.offsets[row]:self.offsets[row + 1]].tolist()
+
+    def length(self, lang, conv_id, scenario_name):
+        row = self.row(lang, conv_id, scenario_name)
+        return None if row is None else int(self.offsets[row + 1] - self.offsets[row])
+
+    # Length of every cached chat, in row order
+    def lengths(self):
+        return np.diff(self.offsets)
+
+# Tokenize the step-1 chats of a corpus and write the cache files (index last, so that a cache is never seen half
+# written)
+def build_token_cache(corpus, tokenizer, base, metadata):
+    keys, chats = [], []
+    for lang, _ in LANGUAGES:
+        for record in corpus.records(lang):
+            for scenario in record["scenarios"]:
+                system_prompt, user_prompt = corpus.prompts(scenario)
+                keys.append(cache_key(lang, record["conv_id"], scenario["scenario"]))
+                chats.append([{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}])
+
+    encoded = []
+    for start in range(0, len(chats), TOKENIZE_BATCH_SIZE):
+        encoded += tokenizer.apply_chat_template(chats[start:start + TOKENIZE_BATCH_SIZE], add_generation_prompt=True)
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(ids) for ids in encoded])
+    ids = np.fromiter((token for chat_ids in encoded for token in chat_ids), dtype=np.int32, count=int(offsets[-1]))
+
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    for suffix, array in [('.ids.npy', ids), ('.offsets.npy', offsets)]:
+        tmp_path = f"{base}{suffix}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, base + suffix)
+    tmp_path = f"{base}.index.json.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(dict(metadata, keys=keys, tokens=int(offsets[-1])), f, ensure_ascii=False)
+    os.replace(tmp_path, base + '.index.json')
+
+# Token cache of a corpus for a model's tokenizer, built first if there is none yet
+def open_token_cache(corpus, model_id, tokenizer, cache_dir=TOKEN_CACHE_DIR):
+    tokenizer_hash = tokenizer_fingerprint(tokenizer)
+    corpus_hash = corpus_fingerprint(corpus)
+    base = os.path.join(cache_dir, f"{model_directory_name(model_id)}-{tokenizer_hash[:16]}", f"{corpus_name(corpus)}-{corpus_hash[:16]}")
+    if not os.path.exists(base + '.index.json'):
+        print(f"Tokenizing the prompt corpus {corpus.path} for {model_id}")
+        build_token_cache(corpus, tokenizer, base, {"model_id": model_id, "tokenizer": tokenizer_hash, "corpus": corpus_hash})
+    return TokenCache(base)
+
+# Most recent token cache of a corpus for a model, without loading its tokenizer (for length queries); None if the
+# model has none
+def find_token_cache(corpus, model_id, cache_dir=TOKEN_CACHE_DIR):
+    corpus_hash = corpus_fingerprint(corpus)
+    pattern = os.path.join(cache_dir, f"{glob.escape(model_directory_name(model_id))}-*", f"{glob.escape(corpus_name(corpus))}-{corpus_hash[:16]}.index.json")
+    indexes = sorted(glob.glob(pattern), key=os.path.getmtime)
+    if not indexes:
+        return None
+    return TokenCache(indexes[-1][:-len('.index.json')])
+
+# Build the token caches of a dataset for the given models ahead of a run, and print their prompt lengths
+if __name__ == "__main__":
+    from transformers import AutoTokenizer
+    data_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'KoED_sample_100.json')
+    corpus = open_prompt_corpus(data_file_path)
+    for model_id in sys.argv[1:]:
+        token_cache = open_token_cache(corpus, model_id, AutoTokenizer.from_pretrained(model_id))
+        lengths = token_cache.lengths()
+        print(f"{model_id}: {len(lengths)} chats, {int(lengths.sum())} tokens (mean {lengths.mean():.0f}, max {lengths.max()})")
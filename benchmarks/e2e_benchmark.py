@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import asyncio
+import inspect
+import tempfile
+import functools
+import importlib
+import multiprocessing
+
+# Offline end-to-end benchmark: generation (claude.py against the mock server, open_source.py with the tiny model)
+# -> postprocessing -> evaluation (eval.py against the mock server) -> evaluation postprocessing, on each dataset.
+# Every dataset runs in a fresh interpreter on a throwaway copy of the project, so real results are never touched.
+# Reports items/sec, p50/p99 latency of the API (or generate_batched) calls and the time spent writing result files,
+# per stage.
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.join(BENCHMARK_DIR, '..')
+sys.path.insert(0, BENCHMARK_DIR)
+
+from mock_server import start_mock_server, EMOTION_LABELS
+
+DATASETS = ["KoED_sample_100.json", "KoED_full_1360.json"]
+
+# Mock API behaviour (see mock_server.DEFAULT_CONFIG)
+MOCK_CONFIG = {
+    "latency": {"distribution": "lognormal", "median": 0.05, "sigma": 0.5},
+    "rate_limit_rate": 0.01,
+    "error_rate": 0.005,
+    "retry_after": 0.2,
+    "labels": EMOTION_LABELS,
+    "scores": [2, 3, 4, 5],
+    "seed": 0,
+}
+
+# Generation mode of claude.py ("online" or "batch") and its limits (the mock has no quota)
+CLAUDE_GENERATION_MODE = "online"
+CLAUDE_LIMITS = {"MAX_CONCURRENCY": 16, "REQUESTS_PER_MINUTE": 100000, "TOKENS_PER_MINUTE": 10 ** 9, "BATCH_POLL_INTERVAL": 0.2}
+EVAL_LIMITS = {"MAX_CONCURRENCY": 32, "REQUESTS_PER_MINUTE": 100000, "TOKENS_PER_MINUTE": 10 ** 9}
+
+# Tiny-model generation runs on CPU, so open_source.py only gets the first dialogues of each dataset
+OPEN_SOURCE_DIALOGUES = 16
+OPEN_SOURCE_MAX_NEW_TOKENS = 16
+
+# Optional JSON file for the full report
+REPORT_FILE = None
+
+CLAUDE_MODEL_NAME = "claude-3-5-sonnet-20240620"
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+# Copy of the scripts and one dataset laid out like the repository (the scripts always read KoED_sample_100.json)
+def create_workspace(dataset):
+    workspace = tempfile.mkdtemp(prefix="koed-bench-")
+    shutil.copytree(os.path.join(PROJECT_ROOT, 'LLMs'), os.path.join(workspace, 'LLMs'), ignore=shutil.ignore_patterns('__pycache__'))
+    for directory in ['experiment_results', 'eval_results']:
+        os.makedirs(os.path.join(workspace, 'output', directory, 'sample'))
+    shutil.copy(os.path.join(PROJECT_ROOT, 'output', 'postprocess_runner.py'), os.path.join(workspace, 'output'))
+    shutil.copy(os.path.join(PROJECT_ROOT, 'output', 'experiment_results', 'postprocessing.py'), os.path.join(workspace, 'output', 'experiment_results'))
+    shutil.copy(os.path.join(PROJECT_ROOT, 'output', 'eval_results', 'eval_postprocessing.py'), os.path.join(workspace, 'output', 'eval_results'))
+    os.makedirs(os.path.join(workspace, 'data'))
+    shutil.copy(os.path.join(PROJECT_ROOT, 'data', dataset), os.path.join(workspace, 'data', 'KoED_sample_100.json'))
+    return workspace
+
+# Measurements of one stage: call latencies and time spent in result-file writes
+class StageRecorder:
+    def __init__(self):
+        self.stages = []
+        self.current = None
+
+    # io: whether the stage's file writes happen in this process and can be timed
+    def start(self, name, unit, io=True):
+        self.current = {"stage": name, "unit": unit, "items": 0, "latencies": [], "io_seconds": 0.0 if io else None, "start": time.perf_counter()}
+
+    def finish(self, items):
+        stage = self.current
+        seconds = time.perf_counter() - stage.pop("start")
+        latencies = stage.pop("latencies")
+        stage.update({
+            "items": items,
+            "seconds": seconds,
+            "throughput": items / seconds if seconds else None,
+            "calls": len(latencies),
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+        })
+        self.stages.append(stage)
+        self.current = None
+
+    def add_latency(self, seconds):
+        if self.current is not None:
+            self.current["latencies"].append(seconds)
+
+    def add_io(self, seconds):
+        if self.current is not None and self.current["io_seconds"] is not None:
+            self.current["io_seconds"] += seconds
+
+    # Wrap a function (sync or async) so that its duration is recorded as call latency or file I/O
+    def timed(self, function, io=False):
+        record = self.add_io if io else self.add_latency
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    record(time.perf_counter() - start)
+        else:
+            # SDK methods wrapped by decorators return their coroutine from a plain function
+            async def await_result(result, start):
+                try:
+                    return await result
+                finally:
+                    record(time.perf_counter() - start)
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                result = function(*args, **kwargs)
+                if inspect.isawaitable(result):
+                    return await_result(result, start)
+                record(time.perf_counter() - start)
+                return result
+        return wrapper
+
+def count_results(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'r', encoding='utf-8') as f:
+        return len(json.load(f))
+
+# Whole pipeline on one dataset (runs in its own interpreter); writes the report to report_path
+def run_dataset(dataset, report_path):
+    workspace = create_workspace(dataset)
+    server = start_mock_server(config=MOCK_CONFIG)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["ANTHROPIC_BASE_URL"] = base_url
+    os.environ["OPENAI_API_BASE"] = f"{base_url}/v1"
+    sys.path.insert(0, os.path.join(workspace, 'LLMs'))
+
+    import checkpoint
+    recorder = StageRecorder()
+    for method in ["add", "flush", "compact"]:
+        setattr(checkpoint.CheckpointStore, method, recorder.timed(getattr(checkpoint.CheckpointStore, method), io=True))
+
+    # Generation with Claude (mock Anthropic API)
+    import claude
+    for name, value in CLAUDE_LIMITS.items():
+        setattr(claude, name, value)
+    # Latency of the API calls themselves (without the wait for a concurrency slot or rate-limit budget)
+    for messages_api in [claude.claude_client.messages, claude.claude_client.beta.prompt_caching.messages]:
+        messages_api.create = recorder.timed(messages_api.create)
+    languages = [lang for lang, _ in claude.LANGUAGES]
+    recorder.start("generation (claude.py, mock API)", "dialogues")
+    if CLAUDE_GENERATION_MODE == "batch":
+        claude.main_batch()
+    else:
+        asyncio.run(claude.main())
+    recorder.finish(sum(count_results(claude.get_output_file(lang)) for lang in languages))
+
+    # Generation with the tiny model standing in for the open-source models
+    from tiny_model import build_tiny_model, load_tiny_model
+    import open_source
+    from prompt_corpus import open_prompt_corpus
+    subset_path = os.path.join(workspace, 'data', 'open_source_subset.json')
+    with open(os.path.join(workspace, 'data', 'KoED_sample_100.json'), 'r', encoding='utf-8') as f:
+        subset = json.load(f)[:OPEN_SOURCE_DIALOGUES]
+    with open(subset_path, 'w', encoding='utf-8') as f:
+        json.dump(subset, f, ensure_ascii=False)
+    model_dir = build_tiny_model(os.path.join(PROJECT_ROOT, 'data', 'KoED_sample_100.json'))
+    open_source.prompt_corpus = open_prompt_corpus(subset_path)
+    open_source.load_model = load_tiny_model(model_dir)
+    open_source.model_ids = ["benchmark/tiny-model"]
+    open_source.MAX_NEW_TOKENS = OPEN_SOURCE_MAX_NEW_TOKENS
+    open_source.PREFETCH_NEXT_MODEL = False
+    open_source.generate_batched = recorder.timed(open_source.generate_batched)
+    recorder.start("generation (open_source.py, tiny model)", "dialogues")
+    open_source.main()
+    recorder.finish(sum(count_results(open_source.get_output_file("tiny-model", lang)) for lang in languages))
+
+    # Postprocessing of the generated results
+    sys.path.insert(0, os.path.join(workspace, 'output', 'experiment_results'))
+    import postprocessing
+    # Files are rewritten in the runner's worker processes, so only the stage time is measured
+    recorder.start("postprocessing", "files", io=False)
+    postprocessing.process_normal()
+    recorder.finish(len(glob.glob(os.path.join(workspace, 'output', 'experiment_results', 'sample', 'results_*.json'))))
+
+    # Evaluation (mock OpenAI API)
+    judge = importlib.import_module("eval")
+    for name, value in EVAL_LIMITS.items():
+        setattr(judge, name, value)
+    judge.DATA_FILE = os.path.join(workspace, 'data', 'KoED_sample_100.json')
+    judge.openai.ChatCompletion.acreate = recorder.timed(judge.openai.ChatCompletion.acreate)
+    recorder.start("evaluation (eval.py, mock API)", "scenarios")
+    asyncio.run(judge.main())
+    evaluated = 0
+    for lang in languages:
+        evaluation_file = os.path.join(workspace, 'output', 'eval_results', 'sample', CLAUDE_MODEL_NAME, lang, f"{CLAUDE_MODEL_NAME}_{lang}_evaluation.json")
+        if os.path.exists(evaluation_file):
+            with open(evaluation_file, 'r', encoding='utf-8') as f:
+                evaluated += sum(len(scenarios) for scenarios in json.load(f).values())
+    recorder.finish(evaluated)
+
+    # Evaluation postprocessing
+    sys.path.insert(0, os.path.join(workspace, 'output', 'eval_results'))
+    import eval_postprocessing
+    recorder.start("evaluation postprocessing", "files", io=False)
+    eval_postprocessing.process_all_files(os.path.join(workspace, 'output', 'eval_results', 'sample'), [CLAUDE_MODEL_NAME], languages)
+    recorder.finish(len(glob.glob(os.path.join(workspace, 'output', 'eval_results', 'sample', '*', '*', '*_evaluation.json'))))
+
+    server.shutdown()
+    shutil.rmtree(workspace, ignore_errors=True)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({"dataset": dataset, "mock": server.state.stats(), "stages": recorder.stages}, f, ensure_ascii=False, indent=4)
+
+def print_report(report):
+    print(f"\n== {report['dataset']} (mock requests {report['mock']['requests']}, "
+          f"429s {report['mock']['rate_limited']}, 500s {report['mock']['errors']})")
+    print(f"{'stage':<42} {'items':>7} {'time s':>8} {'items/s':>9} {'calls':>7} {'p50 ms':>8} {'p99 ms':>8} {'file I/O s':>10}")
+    for stage in report["stages"]:
+        p50 = "-" if stage["p50"] is None else f"{stage['p50'] * 1000:.1f}"
+        p99 = "-" if stage["p99"] is None else f"{stage['p99'] * 1000:.1f}"
+        io = "-" if stage["io_seconds"] is None else f"{stage['io_seconds']:.3f}"
+        print(f"{stage['stage']:<42} {stage['items']:>7} {stage['seconds']:>8.2f} {stage['throughput'] or 0:>9.2f} "
+              f"{stage['calls']:>7} {p50:>8} {p99:>8} {io:>10}")
+
+def main():
+    context = multiprocessing.get_context("spawn")
+    reports = []
+    for dataset in DATASETS:
+        report_path = os.path.join(tempfile.gettempdir(), f"koed-bench-{os.getpid()}-{dataset}.report.json")
+        worker = context.Process(target=run_dataset, args=(dataset, report_path))
+        worker.start()
+        worker.join()
+        if worker.exitcode != 0 or not os.path.exists(report_path):
+            print(f"Benchmark on {dataset} failed (exit code {worker.exitcode})")
+            continue
+        with open(report_path, 'r', encoding='utf-8') as f:
+            reports.append(json.load(f))
+        os.remove(report_path)
+
+    for report in reports:
+        print_report(report)
+    if REPORT_FILE:
+        with open(REPORT_FILE, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, ensure_ascii=False, indent=4)
+
+if __name__ == "__main__":
+    main()
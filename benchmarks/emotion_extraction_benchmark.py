@@ -0,0 +1,124 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import random
+
+# Make the experiment postprocessing importable
+project_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(project_root, 'output', 'experiment_results'))
+
+import postprocessing
+
+# Number of timing rounds over the whole set of answers
+ROUNDS = 5
+# Number of synthetic answers used when no raw result files are available
+SYNTHETIC_ANSWERS = 20000
+
+# Hangul boundary cases: (answer, expected labels) under the single-pass matcher
+HANGUL_CASES = [
+    ("감정은 정입니다", ["정"]),
+    ("정이다", ["정"]),
+    ("한이에요", ["한"]),
+    ("한에 가까운 감정", ["한"]),
+    ("정을 느끼고 있습니다", ["정"]),
+    ("정과 한", ["정", "한"]),
+    ("한이라는 감정이 보입니다", ["한"]),
+    ("어느 정도 슬퍼 보입니다", []),
+    ("감정을 정의하면", []),
+    ("한국에서 한번 있었던 일", []),
+    ("한 가지 감정은 Sad", ["Sad"]),
+    ("이 상황에서 한 번", []),
+]
+
+# Previous implementation: one re.search per label and per answer
+def extract_emotions_loop(text, emotion_list, single_emotion=False):
+    emotions = []
+    for emotion in emotion_list:
+        if re.search(r'\b' + re.escape(emotion) + r'\b', text, re.IGNORECASE):
+            emotions.append(emotion)
+        if single_emotion and emotions:
+            return emotions[:1]
+    return emotions
+
+# Step-1 answers (scenario, text) of every raw result file (files not postprocessed yet)
+def load_answers():
+    answers = []
+    for path in glob.glob(os.path.join(project_root, 'output', 'experiment_results', '*', 'results_*.json')):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for conv_data in data.values():
+            for scenario in conv_data['scenarios']:
+                identified_emotions = scenario.get('identified_emotions')
+                if isinstance(identified_emotions, dict):
+                    answers.append((scenario['scenario'], identified_emotions.get('content', '')))
+    return answers
+
+# Answers shaped like the models' step-1 outputs, in both languages
+def synthetic_answers(count):
+    generator = random.Random(0)
+    templates = [
+        "{0}",
+        "The speaker seems to be feeling {0}.",
+        "Identified emotion: **{0}**",
+        "Based on the dialogue, the Speaker's emotional state can be described as {0}. The Speaker mentions several events that support this.",
+        "화자의 감정 상태는 {0}입니다. 대화에서 화자는 자신의 경험을 이야기하고 있습니다.",
+        "감정: {0} (Speaker가 느끼는 감정)",
+    ]
+    answers = []
+    for index in range(count):
+        labels = generator.sample(postprocessing.thirty_four_emotions, generator.randint(1, 4))
+        scenario = "34개의 단일 감정" if index % 2 == 0 else "34개의 멀티 감정"
+        answers.append((scenario, generator.choice(templates).format(", ".join(labels[:1] if index % 2 == 0 else labels))))
+    return answers
+
+def run(extract, answers):
+    results = []
+    for scenario, text in answers:
+        results.append(extract(text, postprocessing.thirty_four_emotions, scenario == "34개의 단일 감정"))
+    return results
+
+def best_time(extract, answers):
+    timings = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        run(extract, answers)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+# Number of HANGUL_CASES the single-pass matcher gets right (the failures are printed)
+def check_hangul_cases():
+    correct = 0
+    for text, expected in HANGUL_CASES:
+        found = postprocessing.extract_emotions(text, postprocessing.thirty_four_emotions)
+        if found == expected:
+            correct += 1
+        else:
+            print(f"Hangul case failed: {text!r} -> {found} (expected {expected})")
+    return correct
+
+def main():
+    answers = load_answers()
+    source = "raw result files"
+    if not answers:
+        answers = synthetic_answers(SYNTHETIC_ANSWERS)
+        source = "synthetic answers"
+
+    loop_time = best_time(extract_emotions_loop, answers)
+    single_pass_time = best_time(postprocessing.extract_emotions, answers)
+
+    # The label sets only differ where the boundary rules or the first-hit rule changed the result
+    loop_results = run(extract_emotions_loop, answers)
+    single_pass_results = run(postprocessing.extract_emotions, answers)
+    same = sum(set(a) == set(b) for a, b in zip(loop_results, single_pass_results))
+
+    print(f"{len(answers)} answers ({source}), best of {ROUNDS} rounds")
+    print(f"Per-label loop:   {loop_time * 1000:8.1f} ms ({loop_time / len(answers) * 1e6:6.1f} us/answer)")
+    print(f"Single pass:      {single_pass_time * 1000:8.1f} ms ({single_pass_time / len(answers) * 1e6:6.1f} us/answer)")
+    print(f"Speedup: {loop_time / single_pass_time:.2f}x, identical label sets: {same}/{len(answers)}")
+    print(f"Hangul boundary cases: {check_hangul_cases()}/{len(HANGUL_CASES)} correct")
+
+if __name__ == "__main__":
+    main()
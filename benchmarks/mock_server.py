@@ -0,0 +1,294 @@
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the Anthropic Messages / Message Batches APIs and the OpenAI chat-completions API, so that
+# claude.py and eval.py can be run without API calls.
+# Point claude.py at it with ANTHROPIC_BASE_URL=http://127.0.0.1:<port> and eval.py with
+# OPENAI_API_BASE=http://127.0.0.1:<port>/v1.
+
+# Seconds a batch job stays "in_progress" before it ends
+BATCH_PROCESSING_TIME = 1.0
+
+EMOTION_LABELS = ["Afraid", "Angry", "Annoyed", "Anticipating", "Anxious", "Apprehensive", "Ashamed", "Caring", "Confident",
+                  "Content", "Devastated", "Disappointed", "Disgusted", "Embarrassed", "Excited", "Faithful", "Furious",
+                  "Grateful", "Guilty", "Hopeful", "Impressed", "Jealous", "Joyful", "Lonely", "Nostalgic", "Prepared",
+                  "Proud", "Sad", "Sentimental", "Surprised", "Terrified", "Trusting", "정", "한"]
+
+# Judge answers that miss the requested "Score: n" format but still hold the score
+MALFORMED_ANSWERS = [
+    "Feedback: The response is supportive.\n**Score:** {score}",
+    "Feedback: The response is supportive.\nScore: **{score}**",
+    "Feedback: The response is supportive.\nScore: {score}/5",
+    "**Feedback:** The response is supportive. I would rate it {score} out of 5.",
+    "Feedback: The response is supportive.\n\n{score}",
+]
+
+# Behaviour of the mock (every key is optional):
+#   latency:    {"distribution": "constant", "seconds": s} | {"distribution": "uniform", "low": a, "high": b}
+#               | {"distribution": "exponential", "mean": m} | {"distribution": "lognormal", "median": m, "sigma": s}
+#   rate_limit_rate / error_rate: share of requests answered with 429 (with Retry-After) / 500
+#   retry_after: seconds sent in the Retry-After header of a 429
+#   labels:     emotion labels step-1 answers are drawn from; response: step-2 answer; scores: judge scores drawn from
+#   fused_drop_rate: share of criteria left out of a fused (JSON) judge answer
+#   malformed_rate / unscored_rate: share of per-criterion judge answers in a malformed format that still holds the
+#               score ("**Score:** 4", "4/5", ...) / without any score
+#   seed:       seed of the random draws, for reproducible runs
+DEFAULT_CONFIG = {
+    "latency": {"distribution": "constant", "seconds": 0.0},
+    "rate_limit_rate": 0.0,
+    "error_rate": 0.0,
+    "retry_after": 0.1,
+    "labels": ["Sad"],
+    "response": "Listener: That sounds really hard. How are you feeling about it now?",
+    "scores": [4],
+    "fused_drop_rate": 0.0,
+    "malformed_rate": 0.0,
+    "unscored_rate": 0.0,
+    "seed": 0,
+}
+
+def sample_latency(latency, generator):
+    distribution = latency.get("distribution", "constant")
+    if distribution == "uniform":
+        return generator.uniform(latency["low"], latency["high"])
+    if distribution == "exponential":
+        return generator.expovariate(1.0 / latency["mean"]) if latency["mean"] > 0 else 0.0
+    if distribution == "lognormal":
+        return generator.lognormvariate(math.log(latency["median"]), latency["sigma"])
+    return latency.get("seconds", 0.0)
+
+# Canned answer for a request: step-1 prompts get emotion labels (up to 4 for the multi-label scenario),
+# step-2 prompts an empathetic response, fused judge prompts a JSON object with every criterion and anything else
+# (per-criterion judge prompts) a feedback with a score
+def canned_text(system, prompt, config=None, generator=None):
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    generator = generator or random.Random(config["seed"])
+    if "Identified Emotions:" in prompt:
+        return config["response"]
+    if "34" in str(system):
+        if "Select up to 4" in str(system):
+            return ", ".join(generator.sample(config["labels"], min(len(config["labels"]), generator.randint(1, 4))))
+        return generator.choice(config["labels"])
+    if "JSON object" in prompt:
+        criteria = re.findall(r'\*\*(.+?)\*\* \(1-5\)', str(system) + prompt)
+        return json.dumps({
+            criterion: {"feedback": "The response is supportive.", "score": generator.choice(config["scores"])}
+            for criterion in dict.fromkeys(criteria) if generator.random() >= config["fused_drop_rate"]
+        })
+    score = generator.choice(config["scores"])
+    roll = generator.random()
+    if roll < config["unscored_rate"]:
+        return "Feedback: The response is supportive."
+    if roll < config["unscored_rate"] + config["malformed_rate"]:
+        return generator.choice(MALFORMED_ANSWERS).format(score=score)
+    return f"Feedback: The response is supportive.\nScore: {score}"
+
+def system_text(system):
+    if isinstance(system, list):
+        return "".join(block.get("text", "") for block in system)
+    return system or ""
+
+def messages_text(messages):
+    return "".join(
+        message["content"] if isinstance(message["content"], str) else "".join(block.get("text", "") for block in message["content"])
+        for message in messages
+    )
+
+# Messages API response for one request body
+def build_message(params, prompt_caching=False, config=None, generator=None):
+    system = system_text(params.get("system"))
+    prompt = messages_text(params["messages"])
+    text = canned_text(system, prompt, config, generator)
+    usage = {"input_tokens": (len(system) + len(prompt)) // 3 + 1, "output_tokens": len(text) // 3 + 1}
+
+    # Report cacheable system blocks as cache reads, as the real API does once the cache is warm
+    if prompt_caching:
+        cached = isinstance(params.get("system"), list) and any("cache_control" in block for block in params["system"])
+        usage["cache_creation_input_tokens"] = 0
+        usage["cache_read_input_tokens"] = len(system) // 3 + 1 if cached else 0
+        if cached:
+            usage["input_tokens"] -= usage["cache_read_input_tokens"]
+
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": params.get("model", "mock"),
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": usage,
+    }
+
+# Chat-completions response (OpenAI shape) for one request body
+def build_chat_completion(params, config=None, generator=None):
+    system = "".join(message["content"] for message in params["messages"] if message["role"] == "system")
+    prompt = "".join(message["content"] for message in params["messages"] if message["role"] != "system")
+    text = canned_text(system, prompt, config, generator)
+    prompt_tokens = (len(system) + len(prompt)) // 3 + 1
+    completion_tokens = len(text) // 3 + 1
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": params.get("model", "mock"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+class MockState:
+    def __init__(self, config=None):
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.config = dict(DEFAULT_CONFIG, **(config or {}))
+        self.generator = random.Random(self.config["seed"])
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self.error_count = 0
+
+    # Draw the injected latency and outcome ("ok", "rate_limited" or "error") of a request
+    def draw(self):
+        with self.lock:
+            self.request_count += 1
+            latency = sample_latency(self.config["latency"], self.generator)
+            roll = self.generator.random()
+            if roll < self.config["rate_limit_rate"]:
+                self.rate_limited_count += 1
+                return latency, "rate_limited"
+            if roll < self.config["rate_limit_rate"] + self.config["error_rate"]:
+                self.error_count += 1
+                return latency, "error"
+            return latency, "ok"
+
+    # Canned answers are drawn under the lock so that a seeded run is reproducible
+    def answer(self, build, *args):
+        with self.lock:
+            return build(*args, config=self.config, generator=self.generator)
+
+    def stats(self):
+        return {"requests": self.request_count, "rate_limited": self.rate_limited_count, "errors": self.error_count}
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("content-length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_body(self, status, body, content_type="application/json", headers=None):
+        data = body.encode("utf-8") if isinstance(body, str) else json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", content_type)
+        self.send_header("content-length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Injected 429 / 500 in the error shape of the API being mocked; False if the request should be answered
+    def send_injected_failure(self, outcome, openai_shape):
+        if outcome == "ok":
+            return False
+        if outcome == "rate_limited":
+            status, error_type, message = 429, "rate_limit_error", "Rate limit exceeded (mock)"
+            headers = {"retry-after": str(self.state.config["retry_after"])}
+        else:
+            status, error_type, message = 500, "api_error" if not openai_shape else "server_error", "Internal error (mock)"
+            headers = {}
+        if openai_shape:
+            body = {"error": {"message": message, "type": error_type, "param": None, "code": None}}
+        else:
+            body = {"type": "error", "error": {"type": error_type, "message": message}}
+        self.send_body(status, body, headers=headers)
+        return True
+
+    def prompt_caching(self):
+        return "prompt-caching" in self.headers.get("anthropic-beta", "")
+
+    def batch_object(self, batch):
+        ended = time.time() - batch["created"] >= BATCH_PROCESSING_TIME
+        host = self.headers.get("host")
+        return {
+            "id": batch["id"],
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else len(batch["requests"]),
+                "succeeded": len(batch["requests"]) if ended else 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0,
+            },
+            "results_url": f"http://{host}/v1/messages/batches/{batch['id']}/results" if ended else None,
+        }
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        if path in ("/v1/messages", "/v1/chat/completions"):
+            params = self.read_json()
+            latency, outcome = self.state.draw()
+            time.sleep(latency)
+            if self.send_injected_failure(outcome, path == "/v1/chat/completions"):
+                return
+            if path == "/v1/messages":
+                self.send_body(200, self.state.answer(build_message, params, self.prompt_caching()))
+            else:
+                self.send_body(200, self.state.answer(build_chat_completion, params))
+        elif path == "/v1/messages/batches":
+            batch = {"id": f"msgbatch_{uuid.uuid4().hex[:24]}", "requests": self.read_json()["requests"], "created": time.time(),
+                     "prompt_caching": self.prompt_caching()}
+            with self.state.lock:
+                self.state.batches[batch["id"]] = batch
+            self.send_body(200, self.batch_object(batch))
+        else:
+            self.send_body(404, {"type": "error", "error": {"type": "not_found_error", "message": path}})
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        match = re.fullmatch(r"/v1/messages/batches/([\w-]+)(/results)?", path)
+        batch = self.state.batches.get(match.group(1)) if match else None
+        if batch is None:
+            self.send_body(404, {"type": "error", "error": {"type": "not_found_error", "message": path}})
+        elif match.group(2):
+            lines = [
+                json.dumps({
+                    "custom_id": request["custom_id"],
+                    "result": {"type": "succeeded", "message": self.state.answer(build_message, request["params"], batch["prompt_caching"])},
+                }, ensure_ascii=False)
+                for request in batch["requests"]
+            ]
+            self.send_body(200, "\n".join(lines) + "\n", "application/x-jsonl")
+        else:
+            self.send_body(200, self.batch_object(batch))
+
+# Start the mock server on a background thread; port 0 picks a free port. server.state holds the config and counters.
+def start_mock_server(host="127.0.0.1", port=0, config=None):
+    state = MockState(config)
+    handler = type("BoundMockHandler", (MockHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    config = json.loads(sys.argv[2]) if len(sys.argv) > 2 else None
+    server = start_mock_server(port=port, config=config)
+    print(f"Mock server listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
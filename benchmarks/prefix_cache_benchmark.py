@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+
+# Make the generation scripts importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'LLMs'))
+
+import torch
+import open_source
+from prefix_cache import PrefixCache
+
+# Model to benchmark (any of open_source.model_ids)
+MODEL_ID = "meta-llama/Meta-Llama-3.1-8B-Instruct"
+
+# Step-1 chats of every dialogue of the 100-sample set, for both languages and scenarios
+def build_step_one_chats():
+    chats = []
+    for lang, _ in open_source.LANGUAGES:
+        for record in open_source.prompt_corpus.records(lang):
+            for scenario in record["scenarios"]:
+                chats.append(open_source.build_chat(scenario))
+    return chats
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+# Time-to-first-token of every chat (one new token, batch size 1)
+def measure_ttft(model, tokenizer, chats, prefix_cache=None):
+    latencies = []
+    for chat in chats:
+        synchronize()
+        start = time.perf_counter()
+        open_source.generate_batched(model, tokenizer, [chat], 1, prefix_cache)
+        synchronize()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def summarize(name, latencies):
+    latencies = sorted(latencies)
+    mean = sum(latencies) / len(latencies)
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name:<16} mean {mean * 1000:8.1f} ms   p50 {p50 * 1000:8.1f} ms   p99 {p99 * 1000:8.1f} ms")
+    return mean
+
+def main():
+    open_source.MAX_NEW_TOKENS = 1
+    model, tokenizer = open_source.load_model(MODEL_ID)
+    chats = build_step_one_chats()
+
+    prompt_tokens = sum(len(tokenizer.apply_chat_template(chat, add_generation_prompt=True)) for chat in chats)
+
+    # Warm up kernels and allocator before timing
+    measure_ttft(model, tokenizer, chats[:4])
+
+    baseline = measure_ttft(model, tokenizer, chats)
+
+    prefix_cache = PrefixCache(model, tokenizer)
+    build_start = time.perf_counter()
+    for chat in chats:
+        prefix_cache.lookup(chat[0])
+    build_time = time.perf_counter() - build_start
+    cached = measure_ttft(model, tokenizer, chats, prefix_cache)
+
+    print(f"Model: {MODEL_ID}, chats: {len(chats)}, distinct system prompts: {len(prefix_cache.entries)}")
+    print(f"Prefill tokens without cache: {prompt_tokens}")
+    print(f"Prefill tokens with cache:    {prompt_tokens - prefix_cache.prefill_tokens_saved} "
+          f"({prefix_cache.prefill_tokens_saved / prompt_tokens:.1%} saved, prefixes built once in {build_time:.2f} s)")
+    baseline_mean = summarize("no prefix cache", baseline)
+    cached_mean = summarize("prefix cache", cached)
+    print(f"TTFT speedup: {baseline_mean / cached_mean:.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+
+# Tiny randomly initialised chat model standing in for the 7B models of open_source.py in offline benchmarks.
+# Built locally (no Hub access needed): a byte-level BPE tokenizer trained on the KoED utterances and prompts, with a
+# ChatML chat template, and a 2-layer Qwen2 model. Its outputs are meaningless; only the cost of the pipeline around
+# generation is realistic.
+
+TINY_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tiny_model')
+VOCAB_SIZE = 4000
+CHAT_TEMPLATE = (
+    "{% for message in messages %}{{'<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n'}}"
+    "{% endfor %}{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"
+)
+
+# Texts the tokenizer is trained on: every utterance of the dataset and the prompt templates
+def training_texts(data_file_path):
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'LLMs'))
+    from prompt_corpus import LANGUAGES, build_common_task_definition, build_scenarios
+
+    with open(data_file_path, 'r', encoding='utf-8') as f:
+        dialogues = json.load(f)
+    for dialogue_data in dialogues:
+        for utterance in dialogue_data['dialogue']:
+            for _, lang_key in LANGUAGES:
+                if utterance.get(lang_key):
+                    yield utterance[lang_key]
+    for lang, _ in LANGUAGES:
+        for _, (system_prompt, user_prompt) in build_scenarios(build_common_task_definition(lang), ""):
+            yield system_prompt
+            yield user_prompt
+
+# Build the tiny model (once) and return its directory
+def build_tiny_model(data_file_path, model_dir=TINY_MODEL_DIR):
+    if os.path.exists(os.path.join(model_dir, 'config.json')):
+        return model_dir
+
+    import torch
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+    from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+
+    special_tokens = ["<|endoftext|>", "<|im_start|>", "<|im_end|>"]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=VOCAB_SIZE, special_tokens=special_tokens,
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(training_texts(data_file_path), trainer)
+
+    fast_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token=None,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        chat_template=CHAT_TEMPLATE,
+    )
+
+    torch.manual_seed(0)
+    config = Qwen2Config(
+        vocab_size=len(fast_tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=8192,
+        eos_token_id=fast_tokenizer.eos_token_id,
+        pad_token_id=fast_tokenizer.pad_token_id,
+        tie_word_embeddings=False,
+    )
+    model = Qwen2ForCausalLM(config)
+
+    os.makedirs(model_dir, exist_ok=True)
+    fast_tokenizer.save_pretrained(model_dir)
+    model.save_pretrained(model_dir)
+    return model_dir
+
+# Drop-in for open_source.load_model that loads the tiny model on CPU
+def load_tiny_model(model_dir=TINY_MODEL_DIR):
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    def load_model(model_id):
+        model = AutoModelForCausalLM.from_pretrained(model_dir)
+        tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        return model, tokenizer
+
+    return load_model
+
+if __name__ == "__main__":
+    data_file = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'KoED_sample_100.json')
+    print(f"Tiny model saved to {build_tiny_model(data_file)}")
@@ -1,7 +1,12 @@
 import os
+import sys
 import json
 import re
 
+# Shared postprocessing runner (output/postprocess_runner.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from postprocess_runner import run_file_jobs, atomic_write_json
+
 ### Post-processing to ensure scores are stored as integers ###
 def sanitize_filename(filename):
     # Replace characters not allowed in filenames with '_'
@@ -31,11 +36,11 @@ def process_json_file(file_path):
                                 modified = True
 
     if modified:
-        with open(file_path, 'w', encoding='utf-8') as file:
-            json.dump(data, file, ensure_ascii=False, indent=4)
+        atomic_write_json(file_path, data)
         print(f"Updated file: {os.path.basename(file_path)}")
 
 def process_all_files(output_directory, models, languages):
+    jobs = []
     # Iterate over each model and language combination
     for model in models:
         for language in languages:
@@ -44,11 +49,10 @@ def process_all_files(output_directory, models, languages):
             file_name = f"{sanitize_filename(model)}_{sanitize_filename(language)}_evaluation.json"
             file_path = os.path.join(model_dir, file_name)
             
-            # Process file if it exists
-            if os.path.exists(file_path):
-                process_json_file(file_path)
-            else:
-                print(f"File not found: {file_path}")
+            jobs.append((file_path, process_json_file, (file_path,)))
+
+    # Files are processed in parallel; missing files are reported and files unchanged since the last pass are skipped
+    run_file_jobs(jobs, os.path.join(output_directory, '.postprocess_state.json'))
 
 # Main execution
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import numpy as np
+
+# Label list and result file layout of the experiment postprocessing (postprocessing.py in this directory)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from postprocessing import thirty_four_emotions, result_file_path
+
+### Emotion-inference scoring against the KoED gold labels ###
+# The 'emotion inference' lists written by postprocessing.py and the gold 'emotion' field of the dataset are encoded
+# as 34-column multi-hot matrices (one row per conversation and scenario). Every metric of every
+# (model, language, scenario) group then comes out of a few array operations over all rows at once:
+#   accuracy:       predicted label set equals the gold label set
+#   hit@k:          one of the first k predicted labels is a gold label
+#   micro/macro P/R/F1 over the 34 labels (macro over the labels predicted or gold in the group)
+#   confusion:      34x34 counts of (gold label, predicted label) pairs per row (rows: gold, columns: predicted)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data')
+# Confusion matrices of a run ('{}' is the processing type)
+CONFUSION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'emotion_confusion_{}.npz')
+
+LABELS = thirty_four_emotions
+TOP_K = (1, 2)
+
+# Gold labels are lower-case English ("afraid ", "jeong", "Han"); predictions use the label list ("Afraid", "정")
+LABEL_ALIASES = {"jeong": "정", "han": "한"}
+LABEL_INDEX = {label.lower(): index for index, label in enumerate(LABELS)}
+LABEL_INDEX.update({alias: LABEL_INDEX[label] for alias, label in LABEL_ALIASES.items()})
+
+# Label ids of a label list (or of a single label), in order, without duplicates or unknown labels
+def label_ids(labels):
+    if isinstance(labels, str):
+        labels = [labels]
+    ids = []
+    for label in labels or []:
+        index = LABEL_INDEX.get(str(label).strip().lower())
+        if index is not None and index not in ids:
+            ids.append(index)
+    return ids
+
+# {conv_id: gold label ids} of a dataset file
+def load_gold(dataset_path):
+    with open(dataset_path, 'r', encoding='utf-8') as f:
+        return {record['conv_id']: label_ids(record.get('emotion')) for record in json.load(f)}
+
+# Rows of the result files [(model, language, path), ...]: group keys, predicted and gold label ids
+def collect_rows(result_files, gold):
+    keys, predicted, expected = [], [], []
+    for model_name, language, path in result_files:
+        if not os.path.exists(path):
+            print(f"File {path} does not exist. Skipping.")
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for conv_id, conv_data in data.items():
+            if conv_id not in gold:
+                continue
+            for scenario in conv_data.get('scenarios', []):
+                if 'emotion inference' not in scenario:
+                    continue
+                keys.append((model_name, language, scenario['scenario']))
+                predicted.append(label_ids(scenario['emotion inference']))
+                expected.append(gold[conv_id])
+    return keys, predicted, expected
+
+# Label id lists as an (n, width) array padded with -1
+def padded(id_lists):
+    width = max([len(ids) for ids in id_lists], default=0) or 1
+    array = np.full((len(id_lists), width), -1, dtype=np.int64)
+    for row, ids in enumerate(id_lists):
+        array[row, :len(ids)] = ids
+    return array
+
+def multi_hot(ids):
+    rows, positions = np.nonzero(ids >= 0)
+    matrix = np.zeros((len(ids), len(LABELS)), dtype=bool)
+    matrix[rows, ids[rows, positions]] = True
+    return matrix
+
+def safe_divide(numerator, denominator):
+    return np.divide(numerator, denominator, out=np.zeros(np.broadcast(numerator, denominator).shape), where=denominator > 0)
+
+def f1(precision, recall):
+    return safe_divide(2 * precision * recall, precision + recall)
+
+# Metrics of every group: (list of {model, language, scenario, n, ...}, confusion matrices of shape (groups, 34, 34))
+def score(keys, predicted, expected):
+    if not keys:
+        return [], np.zeros((0, len(LABELS), len(LABELS)), dtype=np.int64)
+    group_keys = sorted(set(keys))
+    group_index = {key: index for index, key in enumerate(group_keys)}
+    group = np.array([group_index[key] for key in keys])
+    predicted_ids, expected_ids = padded(predicted), padded(expected)
+    P, G = multi_hot(predicted_ids), multi_hot(expected_ids)
+
+    # Position of every predicted label in its answer (len(LABELS) where not predicted)
+    rank = np.full(P.shape, len(LABELS))
+    rows, positions = np.nonzero(predicted_ids >= 0)
+    rank[rows, predicted_ids[rows, positions]] = positions
+
+    # Row -> group one-hot, so that per-group sums are one matrix product
+    membership = np.zeros((len(group_keys), len(keys)))
+    membership[group, np.arange(len(keys))] = 1
+    n = membership.sum(axis=1)
+
+    exact = membership @ np.all(P == G, axis=1)
+    empty = membership @ ~P.any(axis=1)
+    hits = {k: membership @ np.any(G & (rank < k), axis=1) for k in TOP_K}
+    true_positives = membership @ (P & G)
+    predicted_counts = membership @ P
+    gold_counts = membership @ G
+
+    micro_precision = safe_divide(true_positives.sum(axis=1), predicted_counts.sum(axis=1))
+    micro_recall = safe_divide(true_positives.sum(axis=1), gold_counts.sum(axis=1))
+    label_precision = safe_divide(true_positives, predicted_counts)
+    label_recall = safe_divide(true_positives, gold_counts)
+    present = (predicted_counts + gold_counts) > 0
+    present_count = np.maximum(present.sum(axis=1), 1)
+    macro_precision = (label_precision * present).sum(axis=1) / present_count
+    macro_recall = (label_recall * present).sum(axis=1) / present_count
+    macro_f1 = (f1(label_precision, label_recall) * present).sum(axis=1) / present_count
+
+    # Every (gold, predicted) label pair of a row counts once in its group's confusion matrix
+    confusion = np.zeros((len(group_keys), len(LABELS), len(LABELS)), dtype=np.int64)
+    gold_pairs = np.broadcast_to(expected_ids[:, :, None], (len(keys), expected_ids.shape[1], predicted_ids.shape[1]))
+    predicted_pairs = np.broadcast_to(predicted_ids[:, None, :], gold_pairs.shape)
+    valid = (gold_pairs >= 0) & (predicted_pairs >= 0)
+    pair_groups = np.broadcast_to(group[:, None, None], gold_pairs.shape)
+    np.add.at(confusion, (pair_groups[valid], gold_pairs[valid], predicted_pairs[valid]), 1)
+
+    results = []
+    for index, (model_name, language, scenario_name) in enumerate(group_keys):
+        row = {
+            "model": model_name,
+            "language": language,
+            "scenario": scenario_name,
+            "n": int(n[index]),
+            "accuracy": exact[index] / n[index],
+        }
+        for k in TOP_K:
+            row[f"hit@{k}"] = hits[k][index] / n[index]
+        row.update({
+            "micro_precision": micro_precision[index],
+            "micro_recall": micro_recall[index],
+            "micro_f1": f1(micro_precision[index], micro_recall[index]),
+            "macro_precision": macro_precision[index],
+            "macro_recall": macro_recall[index],
+            "macro_f1": macro_f1[index],
+            "no_prediction": empty[index] / n[index],
+        })
+        results.append({key: value if isinstance(value, (str, int)) else float(value) for key, value in row.items()})
+    return results, confusion
+
+def print_report(results):
+    columns = ["accuracy"] + [f"hit@{k}" for k in TOP_K] + ["micro_precision", "micro_recall", "micro_f1", "macro_f1", "no_prediction"]
+    headers = ["acc"] + [f"hit@{k}" for k in TOP_K] + ["micro P", "micro R", "micro F1", "macro F1", "empty"]
+    print(f"{'model':<30} {'language':<9} {'scenario':<14} {'n':>5} " + " ".join(f"{header:>8}" for header in headers))
+    for row in results:
+        print(f"{row['model']:<30} {row['language']:<9} {row['scenario']:<14} {row['n']:>5} " + " ".join(f"{row[column]:>8.3f}" for column in columns))
+
+# Confusion matrices with their group keys and the label order
+def save_confusion(path, results, confusion):
+    groups = np.array([f"{row['model']}|{row['language']}|{row['scenario']}" for row in results])
+    np.savez_compressed(path, confusion=confusion, groups=groups, labels=np.array(LABELS))
+
+def score_files(result_files, dataset_path):
+    return score(*collect_rows(result_files, load_gold(dataset_path)))
+
+# Result files of the normal configuration (scored against the sample dataset)
+def normal_files():
+    model_ids = [
+        "claude-3-5-sonnet-20240620",
+        "meta-llama/Meta-Llama-3.1-8B-Instruct",
+        "Qwen/Qwen2-7B-Instruct",
+        "LGAI-EXAONE/EXAONE-3.0-7.8B-Instruct",
+        "mistralai/Mistral-7B-Instruct-v0.3"
+    ]
+    return [(model_id.split("/")[-1], lang, result_file_path(model_id, lang)) for model_id in model_ids for lang in ["Korean", "English"]]
+
+# Result files of the JeongHan configuration; every prompt variant is scored as its own "language"
+def jeonghan_files():
+    model_ids = [
+        "claude-3-5-sonnet-20240620",
+        "meta-llama/Meta-Llama-3.1-8B-Instruct",
+        "Qwen/Qwen2-7B-Instruct",
+        "LGAI-EXAONE/EXAONE-3.0-7.8B-Instruct",
+        "mistralai/Mistral-7B-Instruct-v0.3"
+    ]
+    JeongHan_list = ["un_80", "kr_80", "en_80", "simple_80"]
+    return [(model_id.split("/")[-1], f"Korean_{JeongHan}", result_file_path(model_id, "Korean", JeongHan))
+            for model_id in model_ids for JeongHan in JeongHan_list]
+
+def main(processing_type):
+    if processing_type == "normal":
+        results, confusion = score_files(normal_files(), os.path.join(DATA_DIR, 'KoED_sample_100.json'))
+    elif processing_type == "jeonghan":
+        results, confusion = score_files(jeonghan_files(), os.path.join(DATA_DIR, 'KoED_JeongHan_80.json'))
+    else:
+        print("Invalid processing type. Choose 'normal' or 'jeonghan'.")
+        return
+    print_report(results)
+    confusion_file = CONFUSION_FILE.format(processing_type)
+    save_confusion(confusion_file, results, confusion)
+    print(f"Confusion matrices saved to {confusion_file}")
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else 'normal')
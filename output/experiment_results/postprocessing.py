@@ -1,10 +1,18 @@
 import json
 import re
 import os
+import sys
 
 # Get the current script's directory and project root dynamically
 project_root = os.path.dirname(os.path.abspath(__file__))
 
+# Shared postprocessing runner (output/postprocess_runner.py)
+sys.path.insert(0, os.path.join(project_root, '..'))
+from postprocess_runner import run_file_jobs, atomic_write_json
+
+# Content hashes of the last successful pass over each result file
+STATE_FILE = os.path.join(project_root, '.postprocess_state.json')
+
 # Define emotion lists
 seven_emotions = ["Joy", "Sadness", "Anger", "Fear", "Disgust", "Surprise", "Neutral"]
 thirty_four_emotions = ["Afraid", "Angry", "Annoyed", "Anticipating", "Anxious", "Apprehensive", 
@@ -18,14 +26,71 @@ thirty_four_emotions = ["Afraid", "Angry", "Annoyed", "Anticipating", "Anxious",
 # Create a list of 32 emotions by excluding '정' and '한'
 thirty_two_emotions = [emotion for emotion in thirty_four_emotions if emotion not in ["정", "한"]]
 
-# Extract emotions from text (case-insensitive)
+# Boundary rules per script: Latin labels must not touch another Latin letter or digit (a Hangul neighbour is fine,
+# unlike with \b); the single-syllable Hangul labels must not touch another Hangul syllable (감정, 한국), except for
+# a trailing particle (정을, 한에) or a copula, which may go on (정입니다, 한이라는). Compounds that look like a label
+# with a particle (정도, 정의) are never labels, and neither is a bare syllable followed by another Hangul word, which
+# is the determiner "한" ("한 가지", "한 번") or an adverb rather than an answer.
+HANGUL_PARTICLES = ["으로", "에서", "이나", "이랑", "이", "은", "을", "과", "와", "의", "에", "도", "만"]
+HANGUL_COPULAS = ["입니", "이다", "이에", "이야", "이라", "이며", "이고", "이었", "이지", "이죠", "이네"]
+HANGUL_COMPOUNDS = ["정도", "정의", "한도", "한국", "한번"]
+label_boundaries = {
+    "latin": (r'(?<![A-Za-z0-9_])', r'(?![A-Za-z0-9_])'),
+    "hangul": (
+        r'(?<![가-힣])(?!' + '|'.join(HANGUL_COMPOUNDS) + r')',
+        r'(?=' + '|'.join(HANGUL_COPULAS) + r'|(?:' + '|'.join(HANGUL_PARTICLES) + r')(?![가-힣])|(?![가-힣])(?!\s+[가-힣]))',
+    ),
+    "other": (r'\b', r'\b'),
+}
+
+def label_script(emotion):
+    if re.fullmatch(r'[A-Za-z ]+', emotion):
+        return "latin"
+    if re.fullmatch(r'[가-힣]+', emotion):
+        return "hangul"
+    return "other"
+
+# One alternation regex per emotion list, compiled once: a lookahead on the possible first characters skips most
+# positions cheaply, then one branch per script applies its boundaries around the labels (longest first).
+# Capturing group i holds labels[i - 1].
+emotion_matchers = {}
+
+def compile_emotion_matcher(emotion_list):
+    key = tuple(emotion_list)
+    if key not in emotion_matchers:
+        labels = []
+        branches = []
+        for script, (before, after) in label_boundaries.items():
+            group = sorted([emotion for emotion in emotion_list if label_script(emotion) == script], key=len, reverse=True)
+            if group:
+                labels += group
+                branches.append(before + '(?:' + '|'.join('(' + re.escape(emotion) + ')' for emotion in group) + ')' + after)
+        first_characters = sorted({character for emotion in emotion_list for character in (emotion[0].lower(), emotion[0].upper())})
+        pattern = '(?=[' + ''.join(re.escape(character) for character in first_characters) + '])(?:' + '|'.join(branches) + ')'
+        emotion_matchers[key] = (re.compile(pattern, re.IGNORECASE), labels)
+    return emotion_matchers[key]
+
+# Every label hit in the text as (position, emotion), in a single pass
+def find_emotions(text, emotion_list):
+    if not emotion_list:
+        return []
+    matcher, labels = compile_emotion_matcher(emotion_list)
+    return [(match.start(), labels[match.lastindex - 1]) for match in matcher.finditer(text)]
+
+# Extract emotions from text (case-insensitive): the first label mentioned in single-emotion mode,
+# otherwise every distinct label in order of appearance
 def extract_emotions(text, emotion_list, single_emotion=False):
+    if not emotion_list:
+        return []
+    matcher, labels = compile_emotion_matcher(emotion_list)
+    if single_emotion:
+        match = matcher.search(text)
+        return [labels[match.lastindex - 1]] if match else []
     emotions = []
-    for emotion in emotion_list:
-        if re.search(r'\b' + re.escape(emotion) + r'\b', text, re.IGNORECASE):
+    for match in matcher.finditer(text):
+        emotion = labels[match.lastindex - 1]
+        if emotion not in emotions:
             emotions.append(emotion)
-        if single_emotion and emotions:
-            return emotions[:1]
     return emotions
 
 # Process listener's response by extracting relevant text
@@ -49,17 +114,46 @@ def clean_listener_response(response):
 def clean_listener_statement(statement):
     return re.sub(r'(Listener:\s*)+', 'Listener: ', statement).strip()
 
-# Process files based on the model and language
-def process_file(model_id, lang, lang_key, JeongHan=None):
+# Results file of a model and language (rewritten in place)
+def result_file_path(model_id, lang, JeongHan=None):
     model_name = model_id.split("/")[-1]
 
     # Use relative paths based on project_root
     if JeongHan is None:
-        input_file = os.path.join(project_root, 'sample', f'results_{model_name}_{lang}.json')
-        output_file = input_file
+        return os.path.join(project_root, 'sample', f'results_{model_name}_{lang}.json')
+    return os.path.join(project_root, 'JeongHan', f'results_{model_name}_{lang}_{JeongHan}.json')
+
+# Clean one scenario of an open-source model's results in place
+def process_scenario(scenario):
+    # Process empathetic response
+    if 'empathetic_response' in scenario and scenario['empathetic_response']:
+        raw_statement = process_listener_response(str(scenario['empathetic_response']))
+        scenario['final_empathetic_statement'] = clean_listener_response(raw_statement)
+        del scenario['empathetic_response']
+
+    # Choose appropriate emotion list
+    single_emotion = False
+    if scenario['scenario'] == "34개의 단일 감정":
+        emotions_list = thirty_four_emotions
+        single_emotion = True
+    elif scenario['scenario'] == "34개의 멀티 감정":
+        emotions_list = thirty_four_emotions
     else:
-        input_file = os.path.join(project_root, 'JeongHan', f'results_{model_name}_{lang}_{JeongHan}.json')
-        output_file = input_file
+        return
+
+    # Replace 'identified_emotions' with 'emotion inference'
+    # (label-constrained step-1 answers of open_source.py come with their labels already parsed)
+    if 'identified_emotions' in scenario and scenario['identified_emotions']:
+        if 'labels' in scenario['identified_emotions']:
+            scenario['emotion inference'] = scenario['identified_emotions']['labels']
+        else:
+            scenario['emotion inference'] = extract_emotions(scenario['identified_emotions']['content'], emotions_list, single_emotion)
+        del scenario['identified_emotions']
+
+# Process files based on the model and language
+def process_file(model_id, lang, lang_key, JeongHan=None):
+    input_file = result_file_path(model_id, lang, JeongHan)
+    output_file = input_file
 
     # Check if the file exists
     if not os.path.exists(input_file):
@@ -72,32 +166,13 @@ def process_file(model_id, lang, lang_key, JeongHan=None):
 
     for conv_id, conv_data in data.items():
         for scenario in conv_data['scenarios']:
-            # Process empathetic response
-            if 'empathetic_response' in scenario and scenario['empathetic_response']:
-                raw_statement = process_listener_response(str(scenario['empathetic_response']))
-                scenario['final_empathetic_statement'] = clean_listener_response(raw_statement)
-                del scenario['empathetic_response']
-
-            # Choose appropriate emotion list
-            single_emotion = False
-            if scenario['scenario'] == "34개의 단일 감정":
-                emotions_list = thirty_four_emotions
-                single_emotion = True
-            elif scenario['scenario'] == "34개의 멀티 감정":
-                emotions_list = thirty_four_emotions
-            else:
-                continue
-            
-            # Replace 'identified_emotions' with 'emotion inference'
-            if 'identified_emotions' in scenario and scenario['identified_emotions']:
-                scenario['emotion inference'] = extract_emotions(scenario['identified_emotions']['content'], emotions_list, single_emotion)
-                del scenario['identified_emotions']
+            process_scenario(scenario)
         
         conv_id_count = len(data)
         print(f"{model_id} - {lang} - {JeongHan}: {conv_id_count} conversation IDs processed.")
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    # Rewrite through a temp file so that an interrupted pass never leaves a truncated file
+    atomic_write_json(output_file, data)
 
     print(f"Processed and saved to {output_file}")
 
@@ -122,51 +197,50 @@ def extract_last_listener(text):
         return "Listener: " + matches[-1].strip()
     return text.strip()
 
+# Clean one scenario of Claude's results in place
+def claude_process_scenario(scenario):
+    single_emotion = False
+    if scenario['scenario'] == "34개의 단일 감정":
+        emotions_list = thirty_four_emotions
+        single_emotion = True
+    elif scenario['scenario'] == "34개의 멀티 감정":
+        emotions_list = thirty_four_emotions
+    else:
+        emotions_list = []
+
+    if 'identified_emotions' in scenario and isinstance(scenario['identified_emotions'], dict):
+        emotion_text = scenario['identified_emotions'].get('content', '')
+        scenario['emotion inference'] = extract_emotions(emotion_text, emotions_list, single_emotion)
+
+    if 'empathetic_response' in scenario and isinstance(scenario['empathetic_response'], dict):
+        raw_statement = scenario['empathetic_response'].get('content', '')
+        if count_listeners(raw_statement) >= 2:
+            scenario['final_empathetic_statement'] = extract_last_listener(raw_statement)
+        else:
+            scenario['final_empathetic_statement'] = raw_statement.strip()
+
+    if 'identified_emotions' in scenario:
+        del scenario['identified_emotions']
+    if 'empathetic_response' in scenario:
+        del scenario['empathetic_response']
+
 # Process Claude model output and update empathetic response
 def claude_process_json(model_id, lang, lang_key, JeongHan=None):
-    model_name = model_id.split("/")[-1]
-    if JeongHan is None:
-        input_file = os.path.join(project_root, "sample", f"results_{model_name}_{lang}.json")
-        output_file = input_file
-    else:
-        input_file = os.path.join(project_root, "JeongHan", f"results_{model_name}_{lang}_{JeongHan}.json")
-        output_file = input_file
+    input_file = result_file_path(model_id, lang, JeongHan)
+    output_file = input_file
 
     with open(input_file, 'r', encoding='utf-8') as f:
         data = json.load(f)
 
     for conv_id, conv_data in data.items():
         for scenario in conv_data['scenarios']:
-            single_emotion = False
-            if scenario['scenario'] == "34개의 단일 감정":
-                emotions_list = thirty_four_emotions
-                single_emotion = True
-            elif scenario['scenario'] == "34개의 멀티 감정":
-                emotions_list = thirty_four_emotions
-            else:
-                emotions_list = []
-
-            if 'identified_emotions' in scenario and isinstance(scenario['identified_emotions'], dict):
-                emotion_text = scenario['identified_emotions'].get('content', '')
-                scenario['emotion inference'] = extract_emotions(emotion_text, emotions_list, single_emotion)
-
-            if 'empathetic_response' in scenario and isinstance(scenario['empathetic_response'], dict):
-                raw_statement = scenario['empathetic_response'].get('content', '')
-                if count_listeners(raw_statement) >= 2:
-                    scenario['final_empathetic_statement'] = extract_last_listener(raw_statement)
-                else:
-                    scenario['final_empathetic_statement'] = raw_statement.strip()
-
-            if 'identified_emotions' in scenario:
-                del scenario['identified_emotions']
-            if 'empathetic_response' in scenario:
-                del scenario['empathetic_response']
+            claude_process_scenario(scenario)
 
         conv_id_count = len(data)
         print(f"{model_id} - {lang} - {JeongHan}: {conv_id_count} conversation IDs processed.")
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    # Rewrite through a temp file so that an interrupted pass never leaves a truncated file
+    atomic_write_json(output_file, data)
 
     print(f"Processed and saved to {output_file}")
 
@@ -179,10 +253,14 @@ def process_normal():
         "mistralai/Mistral-7B-Instruct-v0.3"
     ]
 
+    jobs = []
     for model_id in model_ids:
         for lang, lang_key in [("Korean", "ko_utter"), ("English", "utter")]:
-            # process_file(model_id, lang, lang_key, None)
-            claude_process_json('claude-3-5-sonnet-20240620', lang, lang_key, None)
+            # jobs.append((result_file_path(model_id, lang), process_file, (model_id, lang, lang_key, None)))
+            jobs.append((result_file_path('claude-3-5-sonnet-20240620', lang), claude_process_json, ('claude-3-5-sonnet-20240620', lang, lang_key, None)))
+
+    # Every file is processed in its own worker process; unchanged files are skipped
+    run_file_jobs(jobs, STATE_FILE)
 
 # Process all models for JeongHan configuration
 def process_jeonghan():
@@ -200,11 +278,15 @@ def process_jeonghan():
         "simple_80"
     ]
 
+    jobs = []
     for model_id in model_ids:
         for lang, lang_key in [("Korean", "ko_utter")]:
             for JeongHan in JeongHan_list:
-                process_file(model_id, lang, lang_key, JeongHan)
-                claude_process_json('claude-3-5-sonnet-20240620', lang, lang_key, JeongHan)
+                jobs.append((result_file_path(model_id, lang, JeongHan), process_file, (model_id, lang, lang_key, JeongHan)))
+                jobs.append((result_file_path('claude-3-5-sonnet-20240620', lang, JeongHan), claude_process_json, ('claude-3-5-sonnet-20240620', lang, lang_key, JeongHan)))
+
+    # Every file is processed in its own worker process; unchanged files are skipped
+    run_file_jobs(jobs, STATE_FILE)
 
 # Main function to determine processing type and execute the appropriate function
 def main(processing_type):
@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Parallel runner shared by the experiment and evaluation postprocessing scripts.
+# Every result file is handled by one worker process, so a sweep takes as long as its slowest file. The content hash
+# of each file after its last successful pass is kept in a state file, and files that have not changed since are
+# skipped.
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Rewrite a JSON file atomically: write a temp file next to it, fsync, then rename over the original
+def atomic_write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+# Name of the steps applied to a file; a file handled by other steps is not skipped
+def steps_name(calls):
+    return ",".join(function.__name__ for function, _ in calls)
+
+# Worker: apply the steps of one file in order and return the hash of the result
+def run_file_steps(path, calls):
+    for function, args in calls:
+        function(*args)
+    return file_digest(path)
+
+# Run postprocessing jobs [(path, function, args), ...] over a process pool.
+# Jobs on the same file run in order in the same worker; files unchanged since their last successful pass
+# (same content hash, same steps) are skipped unless force is set.
+def run_file_jobs(jobs, state_path, max_workers=None, force=False):
+    files = {}
+    for path, function, args in jobs:
+        calls = files.setdefault(os.path.abspath(path), [])
+        if (function, args) not in calls:
+            calls.append((function, args))
+
+    state = load_state(state_path)
+    summary = {"processed": 0, "skipped": 0, "missing": 0, "failed": 0}
+    pending = {}
+    for path, calls in files.items():
+        if not os.path.exists(path):
+            print(f"File not found: {path}")
+            summary["missing"] += 1
+            continue
+        key = os.path.relpath(path, os.path.dirname(os.path.abspath(state_path)))
+        entry = state.get(key)
+        if not force and entry is not None and entry["steps"] == steps_name(calls) and entry["digest"] == file_digest(path):
+            summary["skipped"] += 1
+            continue
+        pending[path] = (key, calls)
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=max_workers or min(len(pending), os.cpu_count() or 1)) as executor:
+            futures = {executor.submit(run_file_steps, path, calls): path for path, (_, calls) in pending.items()}
+            for future in as_completed(futures):
+                path = futures[future]
+                key, calls = pending[path]
+                try:
+                    digest = future.result()
+                except Exception as e:
+                    print(f"Postprocessing failed for {path}: {e}")
+                    summary["failed"] += 1
+                    continue
+                state[key] = {"steps": steps_name(calls), "digest": digest}
+                atomic_write_json(state_path, state)
+                summary["processed"] += 1
+
+    print(f"Postprocessing: {summary}")
+    return summary